@@ -0,0 +1,60 @@
+"""
+gunicorn configuration for MAH, as an alternative to mod_wsgi. Run with::
+
+    gunicorn -c /var/www/wsgi/gunicorn.conf.py mah.wsgi:application
+
+Settings can be overridden with the following environment variables:
+
+MAH_BIND
+    Address to listen on. Defaults to 127.0.0.1:8000, for a reverse proxy
+    on the same host; set application.proxies in the MAH configuration so
+    that MAH sees the clients' addresses rather than the proxy's.
+MAH_WORKERS
+    Number of worker processes. Defaults to twice the number of CPUs plus
+    one.
+MAH_WORKER_CLASS
+    gthread (the default) serves requests in MAH_THREADS threads per
+    process. gevent serves MAH_WORKER_CONNECTIONS requests at once per
+    process as cooperative greenlets, which suits MAH as most of a request
+    is spent waiting on LDAP, RADIUS or SMTP (needs the gevent package).
+MAH_THREADS
+    Threads per process for the gthread worker class. Defaults to 8.
+MAH_WORKER_CONNECTIONS
+    Concurrent requests per process for the gevent worker class. Defaults to
+    100.
+MAH_TIMEOUT
+    Seconds before a silent worker is killed and restarted. Defaults to 60.
+MAHCONFIG
+    The MAH configuration file. Defaults to mah/mah.conf next to this file.
+"""
+import multiprocessing, os
+
+_here = os.path.dirname(os.path.abspath(__file__))
+
+worker_class = os.environ.get('MAH_WORKER_CLASS', 'gthread')
+if worker_class == 'gevent':
+    # Patch before the app is loaded (see preload_app), so that the locks and
+    # threads MAH creates are cooperative too.
+    from gevent import monkey
+    monkey.patch_all()
+
+bind = os.environ.get('MAH_BIND', '127.0.0.1:8000')
+workers = int(os.environ.get(
+    'MAH_WORKERS', multiprocessing.cpu_count() * 2 + 1
+))
+threads = int(os.environ.get('MAH_THREADS', 8))
+worker_connections = int(os.environ.get('MAH_WORKER_CONNECTIONS', 100))
+timeout = int(os.environ.get('MAH_TIMEOUT', 60))
+pythonpath = os.path.join(_here, 'mah')
+os.environ.setdefault('MAHCONFIG', os.path.join(_here, 'mah', 'mah.conf'))
+
+# Create the app once in the master process, so workers start quickly and
+# share its memory. mah.create_app() leaves no connections open.
+preload_app = True
+
+def post_fork(server, worker):
+    import mah
+    mah.post_fork(
+        processes=workers,
+        threads=worker_connections if worker_class == 'gevent' else threads
+    )
@@ -21,5 +21,91 @@ CREATE TABLE authdb.authentications (
   shared_secret varchar(128) NOT NULL,
   expiry datetime NOT NULL,
   reciprocated tinyint(1) NOT NULL,
-  PRIMARY KEY (auth_id)
-)
+  generation int(11) NOT NULL,
+  PRIMARY KEY (auth_id),
+  UNIQUE KEY uq_authentications_generation (source_uid, dest_uid, generation),
+  KEY ix_authentications_source_uid (source_uid),
+  KEY ix_authentications_dest_uid (dest_uid)
+);
+
+--
+-- Upgrading an existing database: add the indexes used by the index page.
+--
+-- CREATE INDEX ix_authentications_source_uid
+--   ON authdb.authentications (source_uid);
+-- CREATE INDEX ix_authentications_dest_uid
+--   ON authdb.authentications (dest_uid);
+--
+-- Upgrading an existing database: add the generation column, which makes
+-- each non-expired (source_uid, dest_uid) pair unique. Existing rows take
+-- their auth_id as generation, which is unique, and which later
+-- generations of the pair count on from.
+--
+-- ALTER TABLE authdb.authentications
+--   ADD COLUMN generation int(11) NOT NULL DEFAULT 0;
+-- UPDATE authdb.authentications SET generation = auth_id;
+-- ALTER TABLE authdb.authentications
+--   ALTER COLUMN generation DROP DEFAULT,
+--   ADD UNIQUE KEY uq_authentications_generation
+--     (source_uid, dest_uid, generation);
+
+CREATE TABLE authdb.outbox (
+  message_id int(11) NOT NULL AUTO_INCREMENT,
+  sender varchar(200) NOT NULL,
+  recipients text NOT NULL,
+  message text NOT NULL,
+  created datetime NOT NULL,
+  attempts int(11) NOT NULL,
+  next_attempt datetime NOT NULL,
+  claimed_until datetime DEFAULT NULL,
+  sent datetime DEFAULT NULL,
+  failed tinyint(1) NOT NULL,
+  last_error varchar(500) DEFAULT NULL,
+  PRIMARY KEY (message_id),
+  KEY ix_outbox_next_attempt (next_attempt),
+  KEY ix_outbox_sent (sent)
+);
+
+CREATE TABLE authdb.reports (
+  report_id int(11) NOT NULL AUTO_INCREMENT,
+  auth_id int(11) DEFAULT NULL,
+  reporter_uid varchar(32) NOT NULL,
+  reason text NOT NULL,
+  created datetime NOT NULL,
+  source_uid varchar(32) DEFAULT NULL,
+  source_name varchar(200) DEFAULT NULL,
+  dest_uid varchar(32) DEFAULT NULL,
+  dest_name varchar(200) DEFAULT NULL,
+  expiry datetime DEFAULT NULL,
+  digest int(11) DEFAULT NULL,
+  digested datetime DEFAULT NULL,
+  PRIMARY KEY (report_id),
+  KEY ix_reports_auth_id (auth_id),
+  KEY ix_reports_digest (digest),
+  FOREIGN KEY (auth_id) REFERENCES authdb.authentications (auth_id)
+);
+
+CREATE TABLE authdb.audit_events (
+  event_id int(11) NOT NULL AUTO_INCREMENT,
+  source_uid varchar(32) NOT NULL,
+  dest_uid varchar(32) NOT NULL,
+  remote_addr varchar(45) DEFAULT NULL,
+  created datetime NOT NULL,
+  PRIMARY KEY (event_id),
+  KEY ix_audit_events_source_uid (source_uid),
+  KEY ix_audit_events_dest_uid (dest_uid)
+);
+
+CREATE TABLE authdb.rollup_hourly (
+  hour datetime NOT NULL,
+  authentications int(11) NOT NULL,
+  reciprocations int(11) NOT NULL,
+  PRIMARY KEY (hour)
+);
+
+CREATE TABLE authdb.rollup_initiators (
+  day date NOT NULL,
+  source_uid varchar(32) NOT NULL,
+  authentications int(11) NOT NULL,
+  PRIMARY KEY (day, source_uid)
+);
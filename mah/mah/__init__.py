@@ -2,16 +2,33 @@
 """
 This file contains the flask app object and describes the main entry points
 to the web application and maps these to urls.
+
+The app is created by :func:`create_app`, which loads the configuration,
+sets up the database and registers the routes::
+
+    from mah import create_app
+
+    application = create_app()
+
+Importing mah has no side effects. In a server that creates the app once and
+then forks worker processes from it (such as gunicorn with preload_app),
+call :func:`post_fork` in each worker process.
 """
 from datetime import datetime, timedelta
 from distutils.version import LooseVersion as Version
-import traceback
+from contextlib import contextmanager
+import signal, sys, time, traceback
 import flask
-from flask import Flask, make_response, render_template
+from flask import Flask, make_response, render_template, request, url_for
+from werkzeug.exceptions import HTTPException
 from flask_seasurf import SeaSurf
-from mah.config import config
+from mah import assets, metrics, profiler, push, warmup
+from mah.compress import CompressMiddleware
+from mah.config import config, load as load_config, hangup
 from mah.database import database as db
-from mah.log import log
+from mah.worker import worker
+from mah.breaker import CircuitOpenError
+from mah.log import log, post_fork as log_post_fork
 
 class MAH(Flask):
     """
@@ -22,6 +39,10 @@ class MAH(Flask):
         Flask.__init__(self, *args, **kwargs)
         self.unauthenticated_routes = {'static': True}
         self.csrf = SeaSurf(self)
+        self.assets = {}
+        self.startup = None # Set by create_app()
+        self.jinja_env.globals['asset_url'] = self.asset_url
+        metrics.init_app(self)
         if not config.ok:
             log.error("Configuration is not correctly set. Please correct it")
             self.secret_key = "NOT THE REAL SECRET KEY"
@@ -37,11 +58,53 @@ class MAH(Flask):
                 PREFERRED_URL_SCHEME=config.application.preferred_url_scheme
             )
         self.secret_key = config.application.session_key # Do we need this?
+        self.config['USE_X_SENDFILE'] = config.assets.x_sendfile
+        if config.application.template_cache:
+            self.jinja_env.bytecode_cache = warmup.BytecodeCache(
+                config.application.template_cache
+            )
+        if config.application.compress:
+            self.wsgi_app = CompressMiddleware(
+                self.wsgi_app,
+                level=config.application.compress_level,
+                min_size=config.application.compress_min_size
+            )
+        # Background threads don't survive a fork, so they are started in the
+        # process that serves requests.
+        self.before_first_request(worker.start)
         # MAH has it's own logging mechanism, and this should be used for flask
         # extensions (such as seasurf)
         for handler in log.handlers:
             self.logger.addHandler(handler) # pylint: disable=E1101
 
+    def build_assets(self):
+        """
+        Build fingerprinted static assets (see mah.assets), falling back to
+        serving them unfingerprinted if that fails.
+        """
+        try:
+            self.assets = assets.build(
+                self.static_folder, config.assets.build_dir
+            )
+        except Exception:
+            log.error(
+                "Failed to build static assets, serving them "
+                "unfingerprinted. {exc}",
+                exc=traceback.format_exc()
+            )
+
+    def compile_templates(self):
+        """
+        Compile all templates ahead of their first use (see mah.warmup).
+        """
+        try:
+            warmup.compile_templates(self)
+        except Exception:
+            log.error(
+                "Failed to compile templates. {exc}",
+                exc=traceback.format_exc()
+            )
+
     def route(self, rule, **options):
         """
         Modified route decorator that wraps all routes in an error handling
@@ -50,13 +113,30 @@ class MAH(Flask):
         def decorator(f):
             def wrap(*args, **kwargs):
                 try:
-                    return f(*args, **kwargs)
-                except Exception:
+                    return profiler.call(
+                        request, f.__name__, f, *args, **kwargs
+                    )
+                except HTTPException:
+                    raise # abort() is not an error
+                except CircuitOpenError as e:
+                    metrics.EXCEPTIONS.inc(f.__name__, 'CircuitOpenError')
+                    log.warning(
+                        "mah.{name}() failed fast: {err}",
+                        name=f.__name__,
+                        err=e
+                    )
+                    db.done(False)
+                    response = make_response(
+                        render_template('unavailable.html'), 503
+                    )
+                    response.headers['Retry-After'] = e.retry_after
+                    return response
+                except Exception as e:
+                    metrics.EXCEPTIONS.inc(f.__name__, e.__class__.__name__)
                     log.error(
-                        "Unhandled exception in mah.{name}(). {exc}".format(
-                            name=f.__name__,
-                            exc=traceback.format_exc()
-                        )
+                        "Unhandled exception in mah.{name}(). {exc}",
+                        name=f.__name__,
+                        exc=traceback.format_exc()
                     )
                     db.done(False)
                     if self.debug: raise
@@ -65,6 +145,15 @@ class MAH(Flask):
             return Flask.route(self, rule, **options)(wrap)
         return decorator
 
+    def asset_url(self, filename):
+        """
+        Return the URL of a static file, using its fingerprinted name if it
+        has one (see mah.assets). Available to templates as asset_url.
+        """
+        if filename in self.assets:
+            return url_for('asset', filename=self.assets[filename])
+        return url_for('static', filename=filename)
+
     def unauthenticated_route(self, rule, **options):
         """
         Special route decorator that marks this route as unauthenticated.
@@ -78,13 +167,150 @@ class MAH(Flask):
             return self.route(rule, **options)(f)
         return decorator
 
-app = MAH(__name__)
-if not config.ok:
-    import mah.routes.error
-else:
-    import mah.routes.ready
+class _Startup(object):
+    """
+    Records how long each phase of creating the app takes.
+    """
+    def __init__(self):
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.time() - started))
+
+    def report(self):
+        return dict(
+            phases=[
+                dict(name=name, seconds=round(seconds, 4))
+                for name, seconds in self.phases
+            ],
+            seconds=round(sum(seconds for name, seconds in self.phases), 4)
+        )
+
+#: The app, once created by create_app().
+app = None
+
+def _managed_server():
+    # The server which manages this process's signals, if any
+    if 'gunicorn' in sys.modules:
+        return 'gunicorn'
+    try:
+        import mod_wsgi
+        if getattr(mod_wsgi, 'process_group', None) is not None:
+            return 'mod_wsgi'
+    except ImportError:
+        pass
+    return None
+
+def create_app(path=None):
+    """
+    Create the MAH app. This loads the configuration, initialises the login
+    and directory backends, creates any missing database tables, builds the
+    static assets, compiles the templates and registers the routes. If the
+    configuration is invalid, the app only serves an error page.
+
+    The app is created once per process; later calls return the same app.
+    No database connections are left open, so the app may be created before
+    the server forks its worker processes (but see :func:`post_fork`).
+
+    :param path: the configuration file. Defaults to the MAHCONFIG
+                 environment variable, or mah.conf.
+    :return: the app, a :class:`MAH` instance.
+    """
+    global app
+    if app is not None:
+        return app
+    startup = _Startup()
+    with startup.phase('config'):
+        load_config(path)
+    if config.ok:
+        with startup.phase('database'):
+            try:
+                db.init()
+            except Exception as e:
+                config.ok = False
+                config.error = (
+                    'Database initialisation failed - configuration incorrect?'
+                )
+                config.exception = e
+                config.trace = traceback.format_exc()
+    with startup.phase('app'):
+        app = MAH(__name__)
+        if config.ok and config.application.proxies:
+            # Outermost, so every request sees the client's address
+            from werkzeug.middleware.proxy_fix import ProxyFix
+            app.wsgi_app = ProxyFix(
+                app.wsgi_app, x_for=config.application.proxies
+            )
+    if config.ok:
+        if config.assets.fingerprint:
+            with startup.phase('assets'):
+                app.build_assets()
+        if config.application.template_warmup:
+            with startup.phase('templates'):
+                app.compile_templates()
+    with startup.phase('routes'):
+        import mah.routes.health
+        if not config.ok:
+            import mah.routes.error
+        else:
+            import mah.routes.ready
+            import mah.routes.status
+            import mah.routes.assets
+            import mah.routes.metrics
+            import mah.routes.admin
+    server = _managed_server()
+    if config.ok and config.application.reload_signal and server:
+        # Its own handling of SIGHUP would be replaced
+        log.warning(
+            'Not reloading the configuration on SIGHUP under {server}, '
+            'use application.reload_interval instead',
+            server=server
+        )
+    elif config.ok and config.application.reload_signal:
+        try:
+            signal.signal(signal.SIGHUP, hangup)
+        except ValueError as e:
+            # Only the main thread can handle signals
+            log.warning(
+                'Not reloading the configuration on SIGHUP: {err}', err=e
+            )
+    db.dispose()
+    app.startup = startup.report()
+    log.info(
+        'Started in {total:.1f}ms ({phases})',
+        total=app.startup['seconds'] * 1000,
+        phases=', '.join(
+            '{name} {ms:.1f}ms'.format(name=name, ms=seconds * 1000)
+            for name, seconds in startup.phases
+        )
+    )
+    return app
+
+def post_fork(processes=None, threads=None):
+    """
+    Prepare a worker process forked from the process that created the app:
+    drop database connections inherited from the parent, and start the log
+    listener and background worker threads. Call this from the server's
+    post-fork hook.
+
+    :param processes: the number of worker processes, if known.
+    :param threads: the requests each process serves at once, if known.
+    """
+    if processes is not None or threads is not None:
+        push.deployed(processes, threads)
+    db.dispose()
+    log_post_fork()
+    metrics.post_fork()
+    worker.start()
 
 if __name__ == '__main__':
+    from mah import create_app
+    app = create_app()
     app.debug = True
     app.config.update(
         SESSION_COOKIE_SECURE=False,
@@ -0,0 +1,142 @@
+"""
+Fingerprinted, precompressed static assets.
+
+On start up, every file in the static folder is copied to the asset build
+directory under a name containing a hash of its content (for instance
+style.css becomes style.0123456789.css), along with gzip (and, if the brotli
+module is installed, brotli) compressed variants of text files. References to
+other assets in stylesheets are rewritten to their fingerprinted names.
+
+Since a fingerprinted name always refers to the same content, these files are
+served with far-future cache headers, and browsers never request them again.
+Templates refer to assets using the asset_url function::
+
+    <link rel="stylesheet" href="{{ asset_url('style.css') }}">
+
+See the assets section of the :doc:`configuration`.
+"""
+import io, os, re, gzip, hashlib, shutil, tempfile
+try:
+    import brotli
+except ImportError:
+    brotli = None
+from mah.log import log
+
+#: File extensions that are worth compressing.
+COMPRESSIBLE = ('.css', '.js', '.html', '.txt', '.svg', '.json')
+
+_css_url = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+def build(src, dst):
+    """
+    Fingerprint and compress all files in src into dst.
+
+    :param src: the static folder.
+    :param dst: the asset build directory. Created if it doesn't exist.
+    :return: the manifest, a dict mapping original file names (relative to
+             src) to fingerprinted file names (relative to dst).
+    :rtype: dict
+    """
+    if not os.path.isdir(dst):
+        os.makedirs(dst)
+    names = []
+    for root, dirs, files in os.walk(src):
+        for name in files:
+            names.append(
+                os.path.relpath(os.path.join(root, name), src).replace(
+                    os.sep, '/'
+                )
+            )
+    # Stylesheets last, so that the assets they refer to are fingerprinted
+    # by the time they are rewritten.
+    names.sort(key=lambda name: (name.endswith('.css'), name))
+    manifest = {}
+    for name in names:
+        with open(os.path.join(src, name), 'rb') as f:
+            data = f.read()
+        if name.endswith('.css'):
+            data = _rewrite_css(data, name, manifest)
+        base, ext = os.path.splitext(name)
+        fingerprinted = '{base}.{hash}{ext}'.format(
+            base=base,
+            hash=hashlib.sha1(data).hexdigest()[:10],
+            ext=ext
+        )
+        target = os.path.join(dst, fingerprinted)
+        outputs = [(target, None, None)]
+        if ext in COMPRESSIBLE:
+            outputs.append((target + '.gz', _gzip, _gunzip))
+            if brotli is not None:
+                outputs.append(
+                    (target + '.br', brotli.compress, brotli.decompress)
+                )
+        for path, encode, decode in outputs:
+            # Left by an earlier start, unless its content is wrong
+            if not _holds(path, data, decode):
+                _write(path, encode(data) if encode else data)
+        manifest[name] = fingerprinted
+    log.debug(
+        'Built {count} static asset(s) in {dst}',
+        count=len(manifest),
+        dst=dst
+    )
+    return manifest
+
+def encodings(target):
+    """
+    List the precompressed variants of a built asset, most preferred first,
+    as (content encoding, path) tuples.
+    """
+    return [
+        (encoding, target + suffix)
+        for encoding, suffix in (('br', '.br'), ('gzip', '.gz'))
+        if os.path.exists(target + suffix)
+    ]
+
+def _rewrite_css(data, name, manifest):
+    folder = os.path.dirname(name)
+    def replace(match):
+        ref = match.group(2)
+        if ':' in ref or ref.startswith('/'):
+            return match.group(0) # Absolute or data: URLs are left alone
+        path = os.path.normpath(os.path.join(folder, ref)).replace(os.sep, '/')
+        if path not in manifest:
+            return match.group(0)
+        return 'url({quote}{ref}{quote})'.format(
+            quote=match.group(1),
+            ref=os.path.relpath(manifest[path], folder or '.').replace(
+                os.sep, '/'
+            )
+        )
+    return _css_url.sub(replace, data.decode('utf-8')).encode('utf-8')
+
+def _gzip(data):
+    buf = tempfile.SpooledTemporaryFile()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(data)
+    buf.seek(0)
+    return buf.read()
+
+def _gunzip(data):
+    with gzip.GzipFile(fileobj=io.BytesIO(data), mode='rb') as f:
+        return f.read()
+
+def _holds(path, data, decode=None):
+    # Whether path exists and has the content data, once decoded
+    try:
+        with open(path, 'rb') as f:
+            content = f.read()
+        return (decode(content) if decode else content) == data
+    except Exception:
+        return False # Missing, or not validly compressed
+
+def _write(target, data):
+    # Several processes may build at once; never expose a partial file.
+    folder = os.path.dirname(target)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    fd, tmp = tempfile.mkstemp(dir=folder)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.chmod(tmp, 0o644)
+    shutil.move(tmp, target)
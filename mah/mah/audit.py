@@ -0,0 +1,108 @@
+"""
+An asynchronous audit trail of the shared secrets shown in stateless mode
+(see authentication.mode), where no authentication is stored.
+
+Events are added to an in-process queue by the request that showed the
+secret, and written to the audit_events table in batches by the background
+worker (see mah.worker), so the request does no database write. At most
+authentication.audit_queue events are queued; if the database can't keep
+up, further events are dropped, counted and logged.
+
+Usually this will be used like so::
+
+    from mah import audit
+
+    audit.record(src, dst, request.remote_addr)
+"""
+import atexit, collections, threading
+from datetime import datetime
+from traceback import format_exc
+from sqlalchemy import Column, Integer, String, DateTime, Sequence
+from mah.config import config
+from mah.database import database as db
+from mah.worker import worker
+from mah.log import log
+
+Base = db.Base
+
+class AuditEvent(Base):
+    """
+    A shared secret shown to the source of an authentication.
+    """
+    __tablename__ = 'audit_events'
+
+    event_id = Column(Integer, Sequence('audit_event_id_seq'), primary_key=True)
+    source_uid = Column(String(32), nullable=False, index=True)
+    dest_uid = Column(String(32), nullable=False, index=True)
+    remote_addr = Column(String(45), nullable=True)
+    created = Column(DateTime, nullable=False)
+
+_queue = collections.deque()
+_stats_lock = threading.Lock()
+_stats = {'written': 0, 'dropped': 0}
+
+def record(source_uid, dest_uid, remote_addr=None):
+    """
+    Queue an audit event, to be written by the worker.
+    """
+    if len(_queue) >= config.authentication.audit_queue:
+        with _stats_lock:
+            _stats['dropped'] += 1
+        log.warning(
+            u'Audit queue full, dropped event for {src} -> {dst}',
+            src=source_uid,
+            dst=dest_uid
+        )
+        return
+    _queue.append({
+        'source_uid': source_uid,
+        'dest_uid': dest_uid,
+        'remote_addr': remote_addr,
+        'created': datetime.utcnow()
+    })
+    worker.wake(flush)
+
+def flush():
+    """
+    Write queued events to the database, in batches of 500. Run periodically
+    by the worker.
+    """
+    while _queue:
+        batch = []
+        while _queue and len(batch) < 500:
+            batch.append(_queue.popleft())
+        try:
+            db.session.execute( # pylint: disable=E1101
+                AuditEvent.__table__.insert(), batch
+            )
+            db.done(True)
+        except Exception:
+            db.done(False)
+            with _stats_lock:
+                _stats['dropped'] += len(batch)
+            log.error(
+                'Failed to write {count} audit event(s): {trace}',
+                count=len(batch),
+                trace=format_exc()
+            )
+            return
+        with _stats_lock:
+            _stats['written'] += len(batch)
+
+def stats():
+    """
+    Audit queue statistics for this process, for monitoring.
+
+    :rtype: dict
+    """
+    with _stats_lock:
+        result = dict(_stats)
+    result['queued'] = len(_queue)
+    return result
+
+def _flush_at_exit():
+    if _queue and config.ok:
+        flush()
+
+worker.every(5, flush)
+atexit.register(_flush_at_exit)
@@ -1,6 +1,7 @@
 """
 Base classes for authentication services.
 """
+import copy
 
 class Authentication(object):
     """
@@ -85,6 +86,9 @@ class Authentication(object):
                        *mah.config.config.login*.
         :param src:    raw source config as read by ConfigParser
         """
+        # Each configuration load has its own copy (see mah.config)
+        cls.inputs = copy.deepcopy(cls.inputs)
+        cls._template_inputs = None
         cls.inputs['username']['label'] = src.str(
             'username_label', cls.inputs['username']['label']
         )
@@ -112,6 +116,18 @@ class Authentication(object):
         """
         raise NotImplementedError()
 
+    @classmethod
+    def ping(cls, timeout):
+        """
+        Check that the authentication service can be reached, for the /readyz
+        health check. Raise an exception if it can't. The default
+        implementation doesn't check anything.
+
+        :param timeout: seconds to wait for the service.
+        :return: False if the service was not checked.
+        """
+        return False
+
     @classmethod
     def template_inputs(cls):
         """
@@ -26,9 +26,10 @@ class Authentication(AuthBase):
                 field=cls.inputs['username']['label']
             ))
             return None, False # Still need a username, even if no password
-        log.warn(u"Authenticating {user} with no password check".format(
+        log.warn(
+            u"Authenticating {user} with no password check",
             user=username
-        ))
+        )
         return username, True
 
     @staticmethod
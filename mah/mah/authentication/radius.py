@@ -1,14 +1,22 @@
 """
 A simple wrapper around the pyrad API to talk to radius authentication servers.
 """
+import socket
 import pyrad.packet
-from pyrad.client import Client
+from pyrad.client import Client, Timeout
 from pyrad.dictionary import Dictionary
 from flask import flash
 from mah.log import log
+from mah.breaker import breaker, CircuitOpenError
 from mah.authentication import Authentication as AuthBase
 from traceback import format_exc
 
+FAILURES = (Timeout, socket.error)
+"""
+The exceptions which show the radius server is failing, for its circuit
+breaker.
+"""
+
 class Authentication(AuthBase):
     @classmethod
     def init(cls, config, src):
@@ -25,14 +33,53 @@ class Authentication(AuthBase):
             The NAS identifier attribute
         radius_nas_ip_address
             The IP address attribute
+        radius_probe_username, radius_probe_password
+            Optional credentials used by the /readyz health check to probe the
+            radius server. Whether they are accepted does not matter, only
+            that the server replies. Without these, the radius server is not
+            checked.
         """
         config.radius_server = src.str('radius_server')
         config.radius_secret = src.str('radius_secret')
         config.radius_dictionary = src.str('radius_dictionary')
         config.radius_nas_identifier = src.str('radius_nas_identifier')
         config.radius_nas_ip_address = src.str('radius_nas_ip_address')
+        config.radius_probe_username = src.str('radius_probe_username', None)
+        config.radius_probe_password = src.str('radius_probe_password', '')
         super(Authentication, cls).init(config, src)
 
+    @classmethod
+    def _request(cls, username, password):
+        srv = Client(
+            server=cls.config.radius_server,
+            secret=cls.config.radius_secret,
+            dict=Dictionary(dict=cls.config.radius_dictionary)
+        )
+        req = srv.CreateAuthPacket(code=pyrad.packet.AccessRequest)
+        req["User-Name"] = username
+        req["User-Password"] = req.PwCrypt(password)
+        req["NAS-Identifier"] = cls.config.radius_nas_identifier
+        # The IP address config option could be made optional
+        # and determined from radius_nas_identifier
+        req["NAS-IP-Address"] = cls.config.radius_nas_ip_address
+        return srv, req
+
+    @classmethod
+    def ping(cls, timeout):
+        """
+        Send an authentication request for radius_probe_username, if set.
+        Any reply, accept or reject, shows the server is up.
+        """
+        if not cls.config.radius_probe_username:
+            return False
+        srv, req = cls._request(
+            cls.config.radius_probe_username,
+            cls.config.radius_probe_password
+        )
+        srv.timeout = timeout
+        srv.retries = 1
+        breaker('radius', FAILURES).call(srv.SendPacket, req)
+
     @classmethod
     def authenticate(cls, form):
         """
@@ -54,44 +101,36 @@ class Authentication(AuthBase):
             ))
             log.error("Password field missing from authentication form!")
             return username, False
-        srv = Client(
-            server=cls.config.radius_server,
-            secret=cls.config.radius_secret,
-            dict=Dictionary(dict=cls.config.radius_dictionary)
-        )
-        req = srv.CreateAuthPacket(code=pyrad.packet.AccessRequest)
-        req["User-Name"] = username
-        req["User-Password"] = req.PwCrypt(password)
-        req["NAS-Identifier"] = cls.config.radius_nas_identifier
-        # The IP address config option could be made optional
-        # and determined from radius_nas_identifier
-        req["NAS-IP-Address"] = cls.config.radius_nas_ip_address
+        srv, req = cls._request(username, password)
         log.debug(
             "Attempting radius auth: Server: {server}; User-Name: {user}; "
-            "NAS-Identifier {nasid}; NAS-IP: {nasip}; Dictionary {dict}".format(
-                server=srv.server,
-                user=req["User-Name"],
-                nasid=req["NAS-Identifier"],
-                nasip=req["NAS-IP-Address"],
-                dict=cls.config.radius_dictionary
-            )
+            "NAS-Identifier {nasid}; NAS-IP: {nasip}; Dictionary {dict}",
+            server=srv.server,
+            user=req["User-Name"],
+            nasid=req["NAS-Identifier"],
+            nasip=req["NAS-IP-Address"],
+            dict=cls.config.radius_dictionary
         )
         try:
-            reply = srv.SendPacket(req)
+            reply = breaker('radius', FAILURES).call(srv.SendPacket, req)
+        except CircuitOpenError:
+            flash(
+                'The login service is temporarily unavailable. '
+                'Please try again in a few minutes.'
+            )
+            log.warning("Radius circuit breaker is open, login refused.")
+            return username, False
         except pyrad.client.Timeout:
             flash('An error has occurred. Please try again.')
             log.error(
                 "Connection to radius server timed out. This may "
                 "be caused by incorrect sever settings. Check the radius "
-                "server logs for more information. {err}".format(
-                    err=format_exc()
-                )
+                "server logs for more information. {err}",
+                err=format_exc()
             )
             return username, False
         except Exception:
             flash('An error has occurred. Please try again.')
-            log.error("Radius server connect failed. {err}".format(
-                err=format_exc()
-            ))
+            log.error("Radius server connect failed. {err}", err=format_exc())
             return username, False
         return username, reply.code == pyrad.packet.AccessAccept
@@ -0,0 +1,241 @@
+"""
+Circuit breakers for the outbound backends MAH depends on (the directory, the
+login service and the mail relay).
+
+When a backend is down, every request would otherwise discover it by waiting
+out a timeout. A breaker counts consecutive failures of calls made through it
+and, once **failure_threshold** is reached, *opens*: further calls fail
+immediately with :class:`CircuitOpenError` instead of touching the backend.
+After **reset_timeout** seconds the breaker becomes *half-open* and lets a
+limited number of trial calls through. A successful trial closes the breaker
+again, a failed one re-opens it.
+
+Breakers are shared per backend name, and are used like so::
+
+    from mah.breaker import breaker
+
+    reply = breaker('radius', FAILURES).call(client.SendPacket, packet)
+
+where FAILURES is a tuple of the exception types which show the backend
+itself is failing, such as connection errors and timeouts. Other exceptions,
+such as those raised for a malformed request before it is sent, are
+re-raised without counting as failures.
+
+Thresholds are read from the breaker section of the configuration. See the
+:doc:`configuration` section for details.
+"""
+import threading, time
+from mah import metrics
+from mah.log import log
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling a backend while its breaker is open.
+    """
+    def __init__(self, name, retry_after):
+        Exception.__init__(
+            self,
+            'Circuit breaker for {name} is open, retry in {retry} '
+            'second(s)'.format(name=name, retry=retry_after)
+        )
+        self.name = name
+        self.retry_after = retry_after
+
+class CircuitBreaker(object):
+    """
+    A single circuit breaker. Thread safe; all state changes happen under a
+    lock, but backend calls themselves are made without holding it.
+
+    :param name: the backend name, used in logs and monitoring.
+    :param failure_threshold: consecutive failures that open the breaker.
+    :param reset_timeout: seconds to stay open before allowing trial calls.
+    :param half_open_calls: number of concurrent trial calls allowed while
+                            half-open.
+    :param failures: the exception types that count as failures.
+    """
+    def __init__(self, name, failure_threshold=5, reset_timeout=30,
+                 half_open_calls=1, failures=(Exception,)):
+        self.name = name
+        self.failures = failures
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._trials = 0
+        self.calls = 0
+        self.failed_calls = 0
+        self.rejected_calls = 0
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call func(\*args, \*\*kwargs) through the breaker. Exceptions raised
+        by func are re-raised; those of the types in failures count as
+        failures.
+
+        :raises CircuitOpenError: if the breaker is open.
+        """
+        try:
+            self.acquire()
+        except CircuitOpenError:
+            metrics.BACKEND_CALLS.inc(self.name, 'rejected')
+            raise
+        started = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except self.failures:
+            self.failure()
+            metrics.BACKEND_CALLS.inc(self.name, 'failure')
+            raise
+        except Exception:
+            self.release()
+            metrics.BACKEND_CALLS.inc(self.name, 'error')
+            raise
+        finally:
+            metrics.BACKEND_LATENCY.observe(time.time() - started, self.name)
+        self.success()
+        metrics.BACKEND_CALLS.inc(self.name, 'success')
+        return result
+
+    def acquire(self):
+        """
+        Register the start of a backend call, for callers that cannot use
+        :meth:`call`. Must be followed by exactly one of :meth:`success`,
+        :meth:`failure` or :meth:`release`.
+
+        :raises CircuitOpenError: if the breaker is open.
+        """
+        with self._lock:
+            if self._state == OPEN:
+                remaining = self._opened_at + self.reset_timeout - time.time()
+                if remaining > 0:
+                    self.rejected_calls += 1
+                    raise CircuitOpenError(self.name, int(remaining) + 1)
+                self._transition(HALF_OPEN)
+            if self._state == HALF_OPEN:
+                if self._trials >= self.half_open_calls:
+                    self.rejected_calls += 1
+                    raise CircuitOpenError(self.name, 1)
+                self._trials += 1
+            self.calls += 1
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            if self._state == HALF_OPEN:
+                self._trials -= 1
+                self._transition(CLOSED)
+
+    def release(self):
+        """
+        Register the end of a call that says nothing about the backend's
+        health, such as one which failed before reaching it.
+        """
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._trials -= 1
+
+    def failure(self):
+        with self._lock:
+            self.failed_calls += 1
+            self._failures += 1
+            if self._state == HALF_OPEN:
+                self._trials -= 1
+                self._transition(OPEN)
+            elif (self._state == CLOSED and
+                  self._failures >= self.failure_threshold):
+                self._transition(OPEN)
+
+    def _transition(self, state):
+        # Must be called with self._lock held
+        if state == OPEN:
+            self._opened_at = time.time()
+        elif state == CLOSED:
+            self._opened_at = None
+            self._trials = 0
+        log.warning(
+            'Circuit breaker for {name} changed from {old} to {new} after '
+            '{failures} consecutive failure(s)',
+            name=self.name,
+            old=self._state,
+            new=state,
+            failures=self._failures
+        )
+        self._state = state
+
+    @property
+    def state(self):
+        return self._state
+
+    def status(self):
+        """
+        A snapshot of this breaker's state, suitable for monitoring.
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'state': self._state,
+                'consecutive_failures': self._failures,
+                'opened_at': self._opened_at,
+                'calls': self.calls,
+                'failed_calls': self.failed_calls,
+                'rejected_calls': self.rejected_calls
+            }
+
+_defaults = {
+    'failure_threshold': 5,
+    'reset_timeout': 30,
+    'half_open_calls': 1
+}
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def init(config):
+    """
+    Set the thresholds used by all breakers.
+
+    :param config: the breaker subsection of the core configuration object,
+                   also available as **mah.config.config.breaker**. See the
+                   :doc:`configuration` section for details.
+    """
+    with _breakers_lock:
+        for key in _defaults:
+            _defaults[key] = config[key]
+        for cb in _breakers.values():
+            for key, value in _defaults.items():
+                setattr(cb, key, value)
+
+def breaker(name, failures=None):
+    """
+    Return the shared breaker for the named backend, creating it if needed.
+
+    :param name: the backend name, for instance 'ldap', 'radius' or 'smtp'.
+    :param failures: the exception types that count as failures of the
+                     backend, if not every exception.
+    :rtype: CircuitBreaker
+    """
+    try:
+        cb = _breakers[name]
+    except KeyError:
+        with _breakers_lock:
+            if name not in _breakers:
+                _breakers[name] = CircuitBreaker(name, **_defaults)
+            cb = _breakers[name]
+    if failures is not None:
+        cb.failures = failures
+    return cb
+
+def status():
+    """
+    The status of every breaker created so far, keyed by backend name.
+
+    :rtype: dict
+    """
+    return dict((name, cb.status()) for name, cb in _breakers.items())
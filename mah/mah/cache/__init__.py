@@ -0,0 +1,144 @@
+"""
+Base class for cache backends.
+
+Directory lookups and the active authentications of each user are cached
+through the backend chosen with cache.type, available as
+**mah.config.config.cache.backend**::
+
+    from mah.config import config
+
+    person = config.cache.backend.get('user:alice')
+    config.cache.backend.set('user:alice', person, 300)
+
+Keys are strings, starting with the kind of data they hold and a colon.
+Values are pickled, so callers always get their own copy. See the
+:doc:`configuration` section for details.
+"""
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from mah import metrics
+
+class Cache(object):
+    """
+    Base class that cache modules should inherit from. Cache modules MUST
+    expose their child class under the name 'Cache' - therefore, import this
+    like::
+
+        from mah.cache import Cache as CacheBase
+
+        class Cache(CacheBase):
+            pass
+
+    All methods are class methods, as a backend is shared by the whole
+    process; it is set up again by each configuration load.
+    """
+
+    config = None
+    """
+    The cache section of the main app configuration. cls.config is the same
+    as mah.config.config.cache. This is None until the init classmethod is
+    called successfully.
+    """
+
+    shared = False
+    """
+    Whether every process using the backend sees the same entries, so that
+    one process deleting an entry deletes it for all of them.
+    """
+
+    hits = 0
+    misses = 0
+    evictions = 0
+
+    @classmethod
+    def init(cls, config, src):
+        """
+        Do class level initialisation. Should ONLY be called by the mah.config
+        package on startup. config will be the same as mah.config.cache.
+
+        :param config: cache specific configuration object. Once
+                       configuration setup is complete, this will be available
+                       in *mah.config.config.cache*.
+        :param src: raw source config as read by ConfigParser
+        """
+        cls.config = config
+        cls.hits = cls.misses = cls.evictions = 0
+
+    @classmethod
+    def get(cls, key, default=None):
+        """
+        :return: the value stored under key, or default if there is none or
+                 it has expired.
+        """
+        return default
+
+    @classmethod
+    def set(cls, key, value, ttl):
+        """
+        Store value under key for ttl seconds. Entries may be evicted
+        earlier to keep the cache within cache.max_bytes.
+        """
+
+    @classmethod
+    def delete(cls, *keys):
+        """
+        Remove the given keys.
+        """
+
+    @classmethod
+    def delete_prefix(cls, prefix):
+        """
+        Remove the keys starting with prefix, such as all those of a kind.
+        """
+
+    @classmethod
+    def clear(cls):
+        """
+        Remove everything.
+        """
+
+    @classmethod
+    def stats(cls):
+        """
+        :return: a dict of the number of entries and bytes held, the capacity
+                 in bytes, and this process's hits, misses, hit ratio and
+                 evictions.
+        """
+        entries, size = cls._usage()
+        lookups = cls.hits + cls.misses
+        return {
+            'entries': entries,
+            'bytes': size,
+            'capacity': cls.config.max_bytes,
+            'hits': cls.hits,
+            'misses': cls.misses,
+            'hit_ratio': round(float(cls.hits) / lookups, 3)
+                         if lookups else None,
+            'evictions': cls.evictions
+        }
+
+    @classmethod
+    def _usage(cls):
+        return 0, 0
+
+    @classmethod
+    def _counted(cls, key, hit):
+        if hit:
+            cls.hits += 1
+        else:
+            cls.misses += 1
+        metrics.CACHE.inc(key.split(':', 1)[0], 'hit' if hit else 'miss')
+
+    @classmethod
+    def _evicted(cls, count):
+        if count:
+            cls.evictions += count
+            metrics.CACHE_EVICTIONS.add(count)
+
+def dumps(value):
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+def loads(data):
+    return pickle.loads(data)
@@ -0,0 +1,72 @@
+"""
+A cache held in the memory of each process. Every process warms its own
+copy; the least recently used entries are evicted to stay within
+cache.max_bytes.
+"""
+import threading, time
+from collections import OrderedDict
+from mah.cache import Cache as CacheBase, dumps, loads
+
+class Cache(CacheBase):
+    @classmethod
+    def init(cls, config, src):
+        super(Cache, cls).init(config, src)
+        cls._lock = threading.Lock()
+        cls._entries = OrderedDict() # key: (expires, pickled value)
+        cls._bytes = 0
+
+    @classmethod
+    def get(cls, key, default=None):
+        with cls._lock:
+            entry = cls._entries.pop(key, None)
+            if entry is not None and entry[0] > time.time():
+                cls._entries[key] = entry # Most recently used
+            elif entry is not None:
+                cls._bytes -= len(entry[1])
+                entry = None
+        cls._counted(key, entry is not None)
+        return default if entry is None else loads(entry[1])
+
+    @classmethod
+    def set(cls, key, value, ttl):
+        data = dumps(value)
+        if ttl <= 0 or len(data) > cls.config.max_bytes:
+            cls.delete(key)
+            return
+        evicted = 0
+        with cls._lock:
+            old = cls._entries.pop(key, None)
+            if old is not None:
+                cls._bytes -= len(old[1])
+            cls._entries[key] = (time.time() + ttl, data)
+            cls._bytes += len(data)
+            while cls._bytes > cls.config.max_bytes:
+                _, old = cls._entries.popitem(last=False)
+                cls._bytes -= len(old[1])
+                evicted += 1
+        cls._evicted(evicted)
+
+    @classmethod
+    def delete(cls, *keys):
+        with cls._lock:
+            for key in keys:
+                old = cls._entries.pop(key, None)
+                if old is not None:
+                    cls._bytes -= len(old[1])
+
+    @classmethod
+    def delete_prefix(cls, prefix):
+        with cls._lock:
+            for key in [k for k in cls._entries if k.startswith(prefix)]:
+                cls._bytes -= len(cls._entries.pop(key)[1])
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._entries.clear()
+            cls._bytes = 0
+
+    @classmethod
+    def _usage(cls):
+        with cls._lock:
+            return len(cls._entries), cls._bytes
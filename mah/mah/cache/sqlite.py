@@ -0,0 +1,191 @@
+"""
+A cache shared by all processes on the host, in an SQLite database file
+(cache.path) in WAL mode, so that readers never wait for a writer. The file
+is memory mapped (cache.mmap_size), so lookups of warm entries are served
+from the page cache without a system call per page.
+
+When the entries take more than cache.max_bytes, expired entries are
+removed, then those closest to expiring. A failing cache file is logged and
+treated as empty, rather than failing the request.
+"""
+import os, sqlite3, threading, time
+from traceback import format_exc
+from mah.cache import Cache as CacheBase, dumps, loads
+from mah.config import default_dir, private_dir
+from mah.log import log
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    expires REAL NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires);
+CREATE TABLE IF NOT EXISTS usage (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    entries INTEGER NOT NULL,
+    bytes INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO usage VALUES (0, 0, 0);
+CREATE TRIGGER IF NOT EXISTS cache_added AFTER INSERT ON cache BEGIN
+    UPDATE usage SET entries = entries + 1, bytes = bytes + NEW.size;
+END;
+CREATE TRIGGER IF NOT EXISTS cache_removed AFTER DELETE ON cache BEGIN
+    UPDATE usage SET entries = entries - 1, bytes = bytes - OLD.size;
+END;
+"""
+
+class Cache(CacheBase):
+    shared = True
+
+    @classmethod
+    def init(cls, config, src):
+        """
+        Expects the following configuration variables set:
+
+        **path**
+            The cache file, shared by every process using it. Its directory
+            must be writable only by this user, as cached values are
+            unpickled. Defaults to cache.sqlite in this user's directory in
+            the temporary directory.
+        **mmap_size**
+            The number of bytes of the file to memory map. Defaults to
+            67108864.
+        **timeout**
+            Seconds to wait for another process writing to the file.
+            Defaults to 1.
+        """
+        super(Cache, cls).init(config, src)
+        config.path = src.str(
+            'path', os.path.join(default_dir('cache'), 'cache.sqlite')
+        )
+        private_dir(
+            os.path.dirname(os.path.abspath(config.path)), 'cache.path'
+        )
+        config.mmap_size = src.int('mmap_size', 67108864)
+        config.timeout = src.float('timeout', 1.0)
+        cls._local = threading.local()
+
+    @classmethod
+    def _connection(cls):
+        # One connection per thread, and none inherited across a fork
+        local = cls._local
+        if getattr(local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(
+                cls.config.path,
+                timeout=cls.config.timeout,
+                isolation_level=None
+            )
+            conn.text_factory = str
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            conn.execute('PRAGMA mmap_size = {size}'.format(
+                size=int(cls.config.mmap_size)
+            ))
+            conn.executescript(_SCHEMA)
+            local.conn, local.pid = conn, os.getpid()
+        return local.conn
+
+    @classmethod
+    def _failed(cls, action):
+        log.warning(
+            'Cache {action} failed in {path}: {trace}',
+            action=action,
+            path=cls.config.path,
+            trace=format_exc()
+        )
+
+    @classmethod
+    def get(cls, key, default=None):
+        try:
+            row = cls._connection().execute(
+                'SELECT value FROM cache WHERE key = ? AND expires > ?',
+                (key, time.time())
+            ).fetchone()
+        except sqlite3.Error:
+            cls._failed('lookup')
+            row = None
+        cls._counted(key, row is not None)
+        return default if row is None else loads(str(row[0]))
+
+    @classmethod
+    def set(cls, key, value, ttl):
+        data = dumps(value)
+        if ttl <= 0 or len(data) > cls.config.max_bytes:
+            cls.delete(key)
+            return
+        try:
+            conn = cls._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+                conn.execute(
+                    'INSERT INTO cache VALUES (?, ?, ?, ?)',
+                    (key, sqlite3.Binary(data), time.time() + ttl, len(data))
+                )
+                evicted = cls._evict(conn)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        except sqlite3.Error:
+            cls._failed('store')
+            return
+        cls._evicted(evicted)
+
+    @classmethod
+    def _evict(cls, conn):
+        def excess():
+            size = conn.execute('SELECT bytes FROM usage').fetchone()[0]
+            return size - cls.config.max_bytes
+        if excess() <= 0:
+            return 0
+        conn.execute('DELETE FROM cache WHERE expires <= ?', (time.time(),))
+        needed = excess()
+        keys = []
+        for key, size in conn.execute(
+            'SELECT key, size FROM cache ORDER BY expires'
+        ):
+            if needed <= 0:
+                break
+            keys.append((key,))
+            needed -= size
+        conn.executemany('DELETE FROM cache WHERE key = ?', keys)
+        return len(keys)
+
+    @classmethod
+    def delete(cls, *keys):
+        try:
+            conn = cls._connection()
+            for key in keys:
+                conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+        except sqlite3.Error:
+            cls._failed('delete')
+
+    @classmethod
+    def delete_prefix(cls, prefix):
+        try:
+            cls._connection().execute(
+                'DELETE FROM cache WHERE substr(key, 1, ?) = ?',
+                (len(prefix), prefix)
+            )
+        except sqlite3.Error:
+            cls._failed('delete')
+
+    @classmethod
+    def clear(cls):
+        try:
+            cls._connection().execute('DELETE FROM cache')
+        except sqlite3.Error:
+            cls._failed('clear')
+
+    @classmethod
+    def _usage(cls):
+        try:
+            return tuple(cls._connection().execute(
+                'SELECT entries, bytes FROM usage'
+            ).fetchone())
+        except sqlite3.Error:
+            cls._failed('usage')
+            return 0, 0
@@ -0,0 +1,219 @@
+"""
+WSGI middleware compressing HTML (and other text) responses.
+
+Responses are compressed as they are streamed out, so a large page is never
+held in memory twice. Short responses (under application.compress_min_size
+bytes) are sent as they are, since compressing them saves little. brotli is
+used if the brotli module is installed and the browser accepts it, gzip
+otherwise.
+
+This is enabled with the application.compress option. See the
+:doc:`configuration` section for details.
+"""
+import threading, time, zlib
+try:
+    import brotli
+except ImportError:
+    brotli = None
+from mah import metrics
+
+#: Content types that are compressed.
+COMPRESSIBLE = (
+    'text/html', 'text/plain', 'text/css', 'text/csv', 'text/javascript',
+    'application/javascript', 'application/json', 'application/x-ndjson'
+)
+
+_stats_lock = threading.Lock()
+_stats = {
+    'responses': 0,
+    'compressed': 0,
+    'bytes_in': 0,
+    'bytes_out': 0,
+    'seconds': 0.0
+}
+
+def stats():
+    """
+    Compression statistics for this process, for monitoring. bytes_in and
+    bytes_out cover compressed responses only, and seconds is the time spent
+    compressing them.
+
+    :rtype: dict
+    """
+    with _stats_lock:
+        result = dict(_stats)
+    result['bytes_saved'] = result['bytes_in'] - result['bytes_out']
+    return result
+
+def _accepts(header, encoding):
+    for item in header.split(','):
+        parts = item.strip().split(';')
+        if parts[0].strip().lower() != encoding:
+            continue
+        for param in parts[1:]:
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+class _Gzip(object):
+    encoding = 'gzip'
+
+    def __init__(self, level):
+        # wbits of 16 + MAX_WBITS writes a gzip header and trailer
+        self._obj = zlib.compressobj(
+            level, zlib.DEFLATED, 16 + zlib.MAX_WBITS
+        )
+
+    def compress(self, data):
+        return self._obj.compress(data)
+
+    def finish(self):
+        return self._obj.flush()
+
+class _Brotli(object):
+    encoding = 'br'
+
+    def __init__(self, level):
+        self._obj = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._obj.process(data)
+
+    def finish(self):
+        return self._obj.finish()
+
+class CompressMiddleware(object):
+    """
+    Wraps a WSGI application, compressing its responses where the client
+    accepts it.
+
+    :param app: the WSGI application to wrap.
+    :param level: compression level, 1 (fastest) to 9 (smallest).
+    :param min_size: responses shorter than this many bytes are not
+                     compressed.
+    """
+    def __init__(self, app, level=6, min_size=1024):
+        self.app = app
+        self.level = level
+        self.min_size = min_size
+
+    def __call__(self, environ, start_response):
+        accept = environ.get('HTTP_ACCEPT_ENCODING', '')
+        if brotli is not None and _accepts(accept, 'br'):
+            compressor = _Brotli
+        elif _accepts(accept, 'gzip'):
+            compressor = _Gzip
+        else:
+            return self.app(environ, start_response)
+        response, written = [], []
+        def deferred_start_response(status, headers, exc_info=None):
+            if exc_info is not None and response:
+                # Headers may already be sent - let the server deal with it
+                return start_response(status, headers, exc_info)
+            response[:] = [status, headers, exc_info]
+            # Data passed to write() comes before the returned iterable's
+            return written.append
+        app_iter = self.app(environ, deferred_start_response)
+        return self._stream(
+            app_iter, written, compressor, start_response, response
+        )
+
+    def _compressible(self, status, headers):
+        if not status.startswith('200'):
+            return False
+        content_type = None
+        for name, value in headers:
+            name = name.lower()
+            if name == 'content-encoding':
+                return False
+            if name == 'content-type':
+                content_type = value.split(';')[0].strip().lower()
+            if name == 'content-length':
+                try:
+                    if int(value) < self.min_size:
+                        return False
+                except ValueError:
+                    return False # Malformed, so leave the response alone
+        return content_type in COMPRESSIBLE
+
+    def _stream(self, app_iter, written, compressor, start_response,
+                response):
+        try:
+            chunks = self._chain(written, app_iter)
+            buffered, size = [], 0
+            for chunk in chunks:
+                buffered.append(chunk)
+                size += len(chunk)
+                # Don't hold back responses that won't be compressed anyway,
+                # such as event streams.
+                if (size >= self.min_size or
+                    response and not self._compressible(*response[:2])):
+                    break
+            status, headers, exc_info = response
+            if (size < self.min_size or
+                not self._compressible(status, headers)):
+                with _stats_lock:
+                    _stats['responses'] += 1
+                start_response(status, headers, exc_info)
+                for chunk in self._chain(buffered, chunks):
+                    yield chunk
+                return
+            start_response(
+                status, self._headers(headers, compressor), exc_info
+            )
+            compressor = compressor(self.level)
+            size_in, size_out, spent = 0, 0, 0.0
+            for chunk in self._chain(buffered, chunks):
+                started = time.time()
+                data = compressor.compress(chunk)
+                spent += time.time() - started
+                size_in += len(chunk)
+                if data:
+                    size_out += len(data)
+                    yield data
+            started = time.time()
+            data = compressor.finish()
+            spent += time.time() - started
+            size_out += len(data)
+            with _stats_lock:
+                _stats['responses'] += 1
+                _stats['compressed'] += 1
+                _stats['bytes_in'] += size_in
+                _stats['bytes_out'] += size_out
+                _stats['seconds'] += spent
+            metrics.COMPRESS_IN.add(size_in)
+            metrics.COMPRESS_OUT.add(size_out)
+            yield data
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+    @staticmethod
+    def _chain(buffered, chunks):
+        for chunk in buffered:
+            yield chunk
+        for chunk in chunks:
+            yield chunk
+
+    @staticmethod
+    def _headers(headers, compressor):
+        result, vary = [], []
+        for name, value in headers:
+            lname = name.lower()
+            if lname == 'content-length':
+                continue
+            if lname == 'vary':
+                vary.append(value)
+                continue
+            if lname == 'etag' and not value.startswith('W/'):
+                value = 'W/' + value # The body is no longer byte identical
+            result.append((name, value))
+        vary.append('Accept-Encoding')
+        result.append(('Vary', ', '.join(vary)))
+        result.append(('Content-Encoding', compressor.encoding))
+        return result
@@ -22,9 +22,13 @@ from ConfigParser import (
     NoOptionError, NoSectionError
 )
 from traceback import format_exc
-import os, re, importlib
-import mah.log
-from mah.database import database as db
+import errno, os, re, importlib, stat, tempfile
+from mah.worker import worker
+# Bound here, as the mah package rebinds its log attribute to the logger
+from mah import (
+    log as mahlog, breaker as mahbreaker, metrics as mahmetrics,
+    profiler as mahprofiler
+)
 
 _valid_name = re.compile(r'^[A-Za-z][A-Za-z0-9_]*\Z')
 
@@ -113,10 +117,15 @@ class ConfigSection(object):
         return self._list(option, default, self._caststr)
 
 class AttribDict(dict):
+    """
+    A dictionary with case-insensitive keys, which can also be read as
+    attributes. Lower case keys are mirrored in the instance dictionary, so
+    reading them as attributes doesn't go through :meth:`__getattr__`.
+    """
     def __getattr__(self, key):
         lkey = key.lower()
-        if lkey in self.keys():
-            return self[lkey]
+        if dict.__contains__(self, lkey):
+            return dict.__getitem__(self, lkey)
         raise AttributeError(
             "{cls!r} object has no attribute {attr!r}".format(
                 cls=self.__class__,
@@ -131,17 +140,170 @@ class AttribDict(dict):
             self.__setitem__(key, value)
 
     def __setitem__(self, key, value):
-        super(AttribDict, self).__setitem__(key.lower(), value)
+        lkey = key.lower()
+        super(AttribDict, self).__setitem__(lkey, value)
+        if not hasattr(self.__class__, lkey):
+            self.__dict__[lkey] = value
 
     def __getitem__(self, key):
         return super(AttribDict, self).__getitem__(key.lower())
 
+    def __delitem__(self, key):
+        lkey = key.lower()
+        super(AttribDict, self).__delitem__(lkey)
+        self.__dict__.pop(lkey, None)
+
     def get(self, key, default=None):
         return super(AttribDict, self).get(key.lower(), default)
 
     def has_key(self, key):
         return super(AttribDict, self).has_key(key.lower())
 
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        for key in self.keys():
+            self.__dict__.pop(key, None)
+        super(AttribDict, self).clear()
+
+class Section(object):
+    """
+    A read-only configuration section, as made by :func:`freeze`.
+
+    Options are stored in slots named after their lower case names, so
+    reading one (config.application.session_timeout) is a plain attribute
+    lookup. Other spellings (config.Application.Session_Timeout) and the
+    dictionary interface (config.application['session_timeout']) work as
+    they do for sections being loaded, but are slower.
+    """
+    __slots__ = ()
+    _keys = frozenset()
+
+    def __getattr__(self, key):
+        # Only called for names that aren't slots
+        lkey = key.lower()
+        if lkey != key and lkey in self._keys:
+            return getattr(self, lkey)
+        raise AttributeError(
+            "{cls!r} object has no attribute {attr!r}".format(
+                cls=self.__class__,
+                attr=key
+            )
+        )
+
+    def __setattr__(self, key, value):
+        raise TypeError('Configuration sections are read-only')
+
+    __delattr__ = __setattr__
+
+    def __getitem__(self, key):
+        lkey = key.lower()
+        if lkey not in self._keys:
+            raise KeyError(key)
+        return getattr(self, lkey)
+
+    def get(self, key, default=None):
+        lkey = key.lower()
+        return getattr(self, lkey) if lkey in self._keys else default
+
+    def has_key(self, key):
+        return key.lower() in self._keys
+
+    __contains__ = has_key
+
+    def keys(self):
+        return list(self._keys)
+
+    def values(self):
+        return [getattr(self, key) for key in self._keys]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self._keys]
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return '<Section {items!r}>'.format(items=dict(self.items()))
+
+def freeze(section):
+    """
+    Make a read-only copy of a configuration section. Lists become tuples,
+    and subsections are frozen too.
+
+    :rtype: Section
+    """
+    keys = tuple(sorted(section.keys()))
+    for key in keys:
+        if not _valid_name.match(key) or hasattr(Section, key):
+            raise ValueError(
+                'Config option {key} is not a valid name'.format(key=key)
+            )
+    cls = type('Section', (Section,), {
+        '__slots__': keys,
+        '_keys': frozenset(keys)
+    })
+    frozen = cls()
+    for key, value in section.items():
+        if isinstance(value, list):
+            value = tuple(value)
+        elif isinstance(value, AttribDict):
+            value = freeze(value)
+        object.__setattr__(frozen, key, value)
+    return frozen
+
+def default_dir(name):
+    """
+    The default location of a directory MAH writes files to: name inside a
+    directory of this user's in the temporary directory.
+    """
+    return os.path.join(
+        tempfile.gettempdir(), 'mah-{uid}'.format(uid=os.geteuid()), name
+    )
+
+def private_dir(path, option):
+    """
+    Create the directory path, readable and writable only by this user, if
+    it doesn't exist, and check that no other user can add or replace files
+    in it: it must belong to this user, and each directory above it to this
+    user or root, and none of them may be writable by others unless, like
+    /tmp, only the owner of an entry may remove it. Files MAH serves, loads
+    or unpickles from the directory can't be planted by another local user.
+
+    :param option: the name of the setting path comes from, for errors.
+    :return: path
+    :raises ValueError: if the directory isn't private.
+    """
+    path = os.path.abspath(path)
+    try:
+        os.makedirs(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    uid = os.geteuid()
+    folder = path
+    while True:
+        info = os.stat(folder)
+        owners = (uid,) if folder == path else (uid, 0)
+        if (not stat.S_ISDIR(info.st_mode) or info.st_uid not in owners or
+            (info.st_mode & 0o022 and not info.st_mode & stat.S_ISVTX) or
+            (folder == path and info.st_mode & 0o022)):
+            raise ValueError(
+                'Config {option} ({path}) must be a directory only this '
+                'user can write to, and {folder} allows others to'.format(
+                    option=option, path=path, folder=folder
+                )
+            )
+        parent = os.path.dirname(folder)
+        if parent == folder:
+            return path
+        folder = parent
+
 def load_module(config, src, parent, cfgparent, clsname, ifaces):
     if not _valid_name.match(config.type):
         raise ValueError(
@@ -162,7 +324,10 @@ def load_module(config, src, parent, cfgparent, clsname, ifaces):
                 trace=format_exc()
             )
         )
-    cls = getattr(config.module, clsname)
+    # Each load initialises its own subclass, so that a reload doesn't
+    # change the backend in use until the new configuration is swapped in
+    base = getattr(config.module, clsname)
+    cls = config.backend = type(base.__name__, (base,), {})
     try:
         cls.init(config, src)
     except Exception:
@@ -188,7 +353,7 @@ def load_module(config, src, parent, cfgparent, clsname, ifaces):
             )
 
 class Config(AttribDict):
-    def __init__(self, src=None):
+    def __init__(self, src=None, setup_logging=True):
         if src is None: return
         # We're the main config. Set ourselves up
         self.ok = False
@@ -208,7 +373,7 @@ class Config(AttribDict):
         section.file_level = rsection.str('file_level', 'DEBUG')
         errors = []
         if section.file_level != 'NONE':
-            if section.file_level in mah.log.LEVELS:
+            if section.file_level in mahlog.LEVELS:
                 section.file_name = rsection.str('file_name')
                 section.file_format = rsection.str(
                     'file_format',
@@ -219,7 +384,7 @@ class Config(AttribDict):
                 errors.append('logging.file_level')
         section.syslog_level = rsection.str('syslog_level', 'DEBUG')
         if section.syslog_level != 'NONE':
-            if section.syslog_level in mah.log.LEVELS:
+            if section.syslog_level in mahlog.LEVELS:
                 section.syslog_host = rsection.str('syslog_host', 'localhost')
                 section.syslog_port = rsection.int('syslog_port', 514)
                 section.syslog_facility = rsection.str(
@@ -230,16 +395,30 @@ class Config(AttribDict):
                 )
             else:
                 errors.append('logging.syslog_level')
+        # Fall back to the defaults until the errors can be raised
+        section.queue_size = max(rsection.int('queue_size', 10000), 1)
+        overflow = rsection.str('overflow', 'drop_new')
+        section.overflow = (
+            overflow if overflow in mahlog.OVERFLOW else 'drop_new'
+        )
+        section.block_timeout = rsection.float('block_timeout', 1.0)
         self.logging = section
-        if len(errors) < 2:
-            mah.log.init(self.logging)
+        if setup_logging and len(errors) < 2:
+            mahlog.init(self.logging)
         if len(errors):
             raise ValueError(
                 'Config {config} is invalid'
                 ' - must be one of {options}'.format(
                     config=', '.join(errors),
-                    options='NONE, ' + ', '.join(mah.log.LEVELS)
+                    options='NONE, ' + ', '.join(mahlog.LEVELS)
                 ))
+        if rsection.int('queue_size', 10000) < 1:
+            raise ValueError('Config logging.queue_size must be at least 1')
+        if overflow != section.overflow:
+            raise ValueError(
+                'Config logging.overflow is invalid - must be one of '
+                '{options}'.format(options=', '.join(mahlog.OVERFLOW))
+            )
 
         # Application section
         section = Config()
@@ -257,16 +436,66 @@ class Config(AttribDict):
         section.preferred_url_scheme = rsection.str(
             'preferred_url_scheme', 'https'
         )
+        section.proxies = rsection.int('proxies', 0)
         section.refresh = rsection.int('refresh', 30)
+        section.compress = rsection.bool('compress', False)
+        section.compress_level = rsection.int('compress_level', 6)
+        section.compress_min_size = rsection.int('compress_min_size', 1024)
+        section.template_warmup = rsection.bool('template_warmup', True)
+        section.template_cache = rsection.str('template_cache', None)
+        section.reload_interval = rsection.int('reload_interval', 0)
+        section.reload_signal = rsection.bool('reload_signal', False)
+        section.push = rsection.bool('push', False)
+        section.push_heartbeat = rsection.int('push_heartbeat', 15)
+        section.push_max_duration = rsection.int('push_max_duration', 300)
+        section.admins = rsection.strlist('admins', [])
+        section.export_batch = rsection.int('export_batch', 1000)
 
         if section.session_timeout < 30:
             raise ValueError(
                 'Config application.session_timeout must be at least 30'
             )
+        if section.reload_interval < 0:
+            raise ValueError(
+                'Config application.reload_interval must not be negative'
+            )
         if section.refresh < 10:
             raise ValueError('Config application.refresh must be at least 10')
+        if section.proxies < 0:
+            raise ValueError('Config application.proxies must not be negative')
+        if section.template_cache:
+            private_dir(section.template_cache, 'application.template_cache')
+        if section.export_batch < 1:
+            raise ValueError(
+                'Config application.export_batch must be at least 1'
+            )
+        if section.compress_level < 1 or section.compress_level > 9:
+            raise ValueError(
+                'Config application.compress_level must be '
+                'between 1 and 9 inclusive'
+            )
+        if section.push_heartbeat < 1:
+            raise ValueError(
+                'Config application.push_heartbeat must be at least 1'
+            )
+        if section.push_max_duration < section.push_heartbeat:
+            raise ValueError(
+                'Config application.push_max_duration must be at least '
+                'application.push_heartbeat'
+            )
         self.application = section
 
+        # Assets section
+        section = Config()
+        rsection = src.section('assets')
+        section.fingerprint = rsection.bool('fingerprint', True)
+        section.build_dir = rsection.str('build_dir', default_dir('assets'))
+        section.max_age = rsection.int('max_age', 31536000)
+        section.x_sendfile = rsection.bool('x_sendfile', False)
+        if section.fingerprint:
+            private_dir(section.build_dir, 'assets.build_dir')
+        self.assets = section
+
         # Authentication section
         section = Config()
         rsection = src.section('authentication')
@@ -278,6 +507,32 @@ class Config(AttribDict):
                 'Config authentication.length must be '
                 'between 5 and 128 inclusive'
             )
+        # Defaults to 60 with a shared cache, see the cache section
+        section.cache_ttl = rsection.int('cache_ttl', None)
+        if section.cache_ttl is not None and section.cache_ttl < 0:
+            raise ValueError(
+                'Config authentication.cache_ttl must not be negative'
+            )
+        section.mode = rsection.str('mode', 'table')
+        section.hmac_key = rsection.str('hmac_key', None)
+        section.audit_queue = rsection.int('audit_queue', 10000)
+        if section.mode not in ('table', 'stateless'):
+            raise ValueError(
+                'Config authentication.mode must be table or stateless'
+            )
+        if section.mode == 'stateless' and not section.hmac_key:
+            raise ValueError(
+                'Config authentication.hmac_key must be set in stateless mode'
+            )
+        if section.mode == 'stateless' and section.timeout < 2:
+            raise ValueError(
+                'Config authentication.timeout must be at least 2 in '
+                'stateless mode'
+            )
+        if section.audit_queue < 1:
+            raise ValueError(
+                'Config authentication.audit_queue must be at least 1'
+            )
         self.authentication = section
 
         # Database section
@@ -285,8 +540,112 @@ class Config(AttribDict):
         rsection = src.section('database')
         section.connect = rsection.str('connect')
         section.logsql = rsection.bool('logsql', False)
+        section.create_tables = rsection.bool('create_tables', True)
+        section.slow_query_ms = rsection.float('slow_query_ms', 250.0)
+        section.max_statements = rsection.int('max_statements', 0)
+        section.replicas = rsection.strlist('replicas', [])
+        section.replica_lag = rsection.int('replica_lag', 10)
+        if section.replica_lag < 0:
+            raise ValueError(
+                'Config database.replica_lag must not be negative'
+            )
         self.database = section
 
+        # Breaker section
+        section = Config()
+        rsection = src.section('breaker')
+        section.failure_threshold = rsection.int('failure_threshold', 5)
+        section.reset_timeout = rsection.int('reset_timeout', 30)
+        section.half_open_calls = rsection.int('half_open_calls', 1)
+        if section.failure_threshold < 1:
+            raise ValueError(
+                'Config breaker.failure_threshold must be at least 1'
+            )
+        if section.half_open_calls < 1:
+            raise ValueError(
+                'Config breaker.half_open_calls must be at least 1'
+            )
+        self.breaker = section
+
+        # Health section
+        section = Config()
+        rsection = src.section('health')
+        section.cache_seconds = rsection.int('cache_seconds', 5)
+        section.timeout = rsection.int('timeout', 3)
+        if section.timeout < 1:
+            raise ValueError('Config health.timeout must be at least 1')
+        self.health = section
+
+        # Metrics section
+        section = Config()
+        rsection = src.section('metrics')
+        section.enabled = rsection.bool('enabled', False)
+        section.dir = rsection.str('dir', default_dir('metrics'))
+        section.flush_interval = rsection.int('flush_interval', 15)
+        section.buckets = rsection.floatlist(
+            'buckets', list(mahmetrics.DEFAULT_BUCKETS)
+        )
+        section.allow = [
+            addr for addr in rsection.strlist('allow', []) if addr
+        ]
+        if section.flush_interval < 1:
+            raise ValueError(
+                'Config metrics.flush_interval must be at least 1'
+            )
+        if section.enabled:
+            private_dir(section.dir, 'metrics.dir')
+        self.metrics = section
+
+        # Profiler section
+        section = Config()
+        rsection = src.section('profiler')
+        section.enabled = rsection.bool('enabled', False)
+        section.mode = rsection.str('mode', 'cprofile')
+        section.sample_rate = rsection.float('sample_rate', 0.0)
+        section.secret = rsection.str('secret', None)
+        section.dir = rsection.str('dir', default_dir('profiles'))
+        section.keep = rsection.int('keep', 50)
+        section.interval = rsection.float('interval', 0.005)
+        if section.mode not in ('cprofile', 'sample'):
+            raise ValueError(
+                'Config profiler.mode must be cprofile or sample'
+            )
+        if section.sample_rate < 0 or section.sample_rate > 1:
+            raise ValueError(
+                'Config profiler.sample_rate must be between 0 and 1'
+            )
+        if section.keep < 1:
+            raise ValueError('Config profiler.keep must be at least 1')
+        if section.enabled:
+            private_dir(section.dir, 'profiler.dir')
+        self.profiler = section
+
+        # Cache section
+        section = Config()
+        rsection = src.section('cache')
+        section.type = rsection.str('type', 'memory')
+        section.max_bytes = rsection.int('max_bytes', 16777216)
+        if section.max_bytes < 1:
+            raise ValueError('Config cache.max_bytes must be at least 1')
+        load_module(
+            section, rsection, 'cache', 'cache', 'Cache',
+            ('get', 'set', 'delete', 'clear', 'stats')
+        )
+        self.cache = section
+        if self.database.replicas and not section.backend.shared:
+            # Other processes wouldn't know which users to read from the
+            # primary after a write
+            raise ValueError(
+                'Config cache.type must be a cache shared by all processes '
+                '(such as sqlite) when database.replicas is set'
+            )
+        if self.authentication.cache_ttl is None:
+            # A cache in each process can't see another process's
+            # invalidations, so it would show stale authentications
+            self.authentication.cache_ttl = (
+                60 if section.backend.shared else 0
+            )
+
         # Login section
         section = Config()
         rsection = src.section('login')
@@ -295,7 +654,7 @@ class Config(AttribDict):
             section, rsection, 'authentication', 'login', 'Authentication',
             ('authenticate', 'for_production')
         )
-        auth = section.module.Authentication
+        auth = section.backend
         if (not callable(getattr(auth, 'authenticate', None)) or
             not callable(getattr(auth, 'for_production', None))):
             raise RuntimeError(
@@ -309,13 +668,13 @@ class Config(AttribDict):
         # Directory section
         section = Config()
         rsection = src.section('directory')
-        section.attributes = src.strlist('attributes')
+        section.attributes = rsection.strlist('attributes')
         if len(section.attributes) < 2:
             raise ValueError(
                 'Config directory.attributes should '
                 'be a list of at least two entries'
             )
-        section.attribute_names = src.strlist('attribute_names')
+        section.attribute_names = rsection.strlist('attribute_names')
         if len(section.attribute_names) < 2:
             raise ValueError(
                 'Config directory.attribute_names should '
@@ -326,18 +685,21 @@ class Config(AttribDict):
                 'Config directory.attribute_names should be of '
                 'the same length as directory.attributes'
             )
-        section.id_attribute = src.str('id_attribute')
+        section.id_attribute = rsection.str('id_attribute')
         if section.id_attribute != section.attributes[0]:
             raise ValueError(
                 'Config directory.id_attribute should '
                 'match first entry of directory.attributes'
             )
-        section.name_attribute = src.str('name_attribute')
+        section.name_attribute = rsection.str('name_attribute')
         if section.name_attribute != section.attributes[1]:
             raise ValueError(
                 'Config directory.name_attribute should '
                 'match second entry of directory.attributes'
             )
+        section.cache_ttl = rsection.int('cache_ttl', 300)
+        if section.cache_ttl < 0:
+            raise ValueError('Config directory.cache_ttl must not be negative')
         section.type = rsection.str('type')
         load_module(
             section, rsection, 'directory', 'directory', 'Directory',
@@ -350,10 +712,27 @@ class Config(AttribDict):
         rsection = src.section('report')
         section.email_from = rsection.str('email_from', 'mah@corp.com')
         section.email_to = rsection.strlist('email_to', ['mah@corp.com'])
-        section.subject = rsection.str(
-            'subject', 'MAH suspicious activity report'
+        section.email_subject = rsection.str(
+            'email_subject', 'MAH suspicious activity report'
         )
         section.smtp_server = rsection.str('smtp_server', 'localhost')
+        section.digest_interval = rsection.int('digest_interval', 0)
+        section.queue = rsection.bool('queue', True)
+        section.queue_poll = rsection.int('queue_poll', 10)
+        section.queue_batch = rsection.int('queue_batch', 50)
+        section.queue_backoff = rsection.int('queue_backoff', 30)
+        section.queue_max_attempts = rsection.int('queue_max_attempts', 10)
+        section.smtp_idle = rsection.int('smtp_idle', 60)
+        if section.digest_interval < 0:
+            raise ValueError(
+                'Config report.digest_interval must not be negative'
+            )
+        if section.queue_poll < 1:
+            raise ValueError('Config report.queue_poll must be at least 1')
+        if section.queue_max_attempts < 1:
+            raise ValueError(
+                'Config report.queue_max_attempts must be at least 1'
+            )
         self.report = section
         self.ok = True
 
@@ -363,32 +742,156 @@ config = Config()
 config.ok = False
 config.error = 'Config not loaded.'
 
-def load():
-    global config
-    src = os.environ.get('MAHCONFIG', 'mah.conf')
+_source = {'path': None, 'mtime': None}
+_reload_hooks = []
+_hangup = []
+
+def _read(path):
     raw = ConfigParser()
+    with open(path, 'r') as cfg:
+        raw.readfp(cfg)
+    return raw
+
+def _build(raw, setup_logging=True):
+    loaded = Config(raw, setup_logging)
+    for name, section in loaded.items():
+        if isinstance(section, AttribDict):
+            loaded[name] = freeze(section)
+            if 'backend' in section:
+                # Backends keep the section they were initialised with
+                section.backend.config = loaded[name]
+    return loaded
+
+def _apply(loaded):
+    mahbreaker.init(loaded.breaker)
+    mahmetrics.init(loaded.metrics)
+    mahprofiler.init(loaded.profiler)
+    # Each section is replaced in one step, and sections are only removed
+    # once the new ones are in, so readers never see a missing section
+    config.update(loaded)
+    for key in set(config.keys()) - set(loaded.keys()):
+        del config[key]
+
+def load(path=None):
+    """
+    Read the configuration file into :data:`config`, which is updated in
+    place so that modules that have already imported it see the result. If
+    the configuration is invalid, config.ok is False and config.error
+    describes the problem.
+
+    This parses the file, sets up logging and initialises the login and
+    directory backends, but does not connect to anything. Each section is
+    then replaced by a read-only copy (see :func:`freeze`).
+
+    :param path: the configuration file. Defaults to the MAHCONFIG
+                 environment variable, or mah.conf.
+    """
+    src = path or os.environ.get('MAHCONFIG', 'mah.conf')
+    _source['path'] = src
     try:
-        with open(src, 'r') as cfg:
-            raw.readfp(cfg)
+        _source['mtime'] = os.path.getmtime(src)
+        raw = _read(src)
     except Exception as e:
         config.error = 'Failed to open or read configuration file'
         config.exception = e
         config.trace = format_exc()
         return
     try:
-        config = Config(raw)
+        loaded = _build(raw)
     except Exception as e:
         config.error = 'Configuration error detected'
         config.exception = e
         config.trace = format_exc()
+        return
+    _apply(loaded)
+
+def on_reload(hook):
+    """
+    Register hook to be called as hook(old, new) after :func:`reload` has
+    swapped in a new configuration, where old is a dict of the previous
+    sections. Hooks replace whatever was built from the old configuration,
+    such as connection pools. This can be used as a decorator.
+    """
+    _reload_hooks.append(hook)
+    return hook
+
+def reload():
+    """
+    Read the configuration file again and, if it is valid, swap it in for
+    the running one. If it is not, the error is logged and the running
+    configuration is kept.
+
+    Settings applied when the app is created (application.host, port,
+    session_key, the session cookie options, preferred_url_scheme, proxies,
+    compress and template_cache, and the assets section) still need a
+    restart.
+
+    :return: whether the new configuration was swapped in.
+    """
+    log = mahlog.log
+    path = _source['path']
     try:
-        db.init()
-    except Exception as e:
-        config.ok = False
-        config.error = (
-            'Database initialisation failed - configuration incorrect?'
+        mtime = os.path.getmtime(path)
+        loaded = _build(_read(path), setup_logging=False)
+    except Exception:
+        log.error(
+            'Not reloading invalid configuration {path}: {trace}',
+            path=path,
+            trace=format_exc()
         )
-        config.exception = e
-        config.trace = format_exc()
-load()    
-del load, load_module
+        return False
+    _source['mtime'] = mtime
+    old = dict(config)
+    mahlog.init(loaded.logging)
+    _apply(loaded)
+    for hook in _reload_hooks:
+        try:
+            hook(old, config)
+        except Exception:
+            log.error(
+                'Configuration reload hook {name} failed: {trace}',
+                name=hook.__name__,
+                trace=format_exc()
+            )
+    log.info('Reloaded configuration from {path}', path=path)
+    return True
+
+def changed():
+    """
+    Whether the configuration file has been modified since it was loaded.
+    """
+    try:
+        return os.path.getmtime(_source['path']) != _source['mtime']
+    except (OSError, TypeError):
+        return False
+
+def hangup(signum=None, frame=None):
+    """
+    Ask for the configuration to be reloaded, the next time the worker
+    checks for changes. This is installed as the SIGHUP handler if
+    application.reload_signal is set, and does nothing that could block.
+    """
+    _hangup.append(True)
+
+def _interval():
+    if not config.ok:
+        return 60
+    if config.application.reload_interval:
+        return config.application.reload_interval
+    return 1 if config.application.reload_signal else 60
+
+def check():
+    """
+    Reload the configuration if SIGHUP was received, or if the file has
+    changed and application.reload_interval is set. Run periodically by the
+    worker.
+    """
+    if not config.ok:
+        return
+    if _hangup:
+        del _hangup[:]
+        reload()
+    elif config.application.reload_interval and changed():
+        reload()
+
+worker.every(_interval, check)
@@ -1,44 +1,160 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker
+"""
+The SQL Alchemy engine and session, and the timing of every SQL statement.
+
+Each statement's duration is added to the database metrics, and statements
+taking longer than database.slow_query_ms are logged as warnings along with
+the route that ran them. The number of statements a request runs, and the
+time they take, are logged when it calls :meth:`database.done`::
+
+    DEBUG: index ran 4 statement(s) in 2.1ms
+
+so that a change adding queries to a page shows up straight away.
+
+With database.replicas set, reads run inside :meth:`database.replica` (such
+as the authentication lists of the index and report pages) go to one of the
+read replicas, and everything else, including all writes, to the primary.
+After a user writes, :meth:`database.use_primary` sends their reads to the
+primary for database.replica_lag seconds, so they see their own writes::
+
+    with db.replica():
+        auths = db.session.query(Verification).all()
+
+See the :doc:`configuration` section for details.
+"""
+import random, re, threading, time
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+from mah import metrics
+from mah.config import config, on_reload
+from mah.worker import worker
 from mah.log import log
 
+# Seconds a replica that failed to connect is left out
+_REPLICA_DOWN = 30
+
+class RoutingSession(Session):
+    """
+    A session sending reads to a replica where :meth:`database.replica`
+    allows it, and everything else to the primary it is bound to.
+    """
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing:
+            engine = database._read_engine()
+            if engine is not None:
+                return engine
+        return Session.get_bind(self, mapper, clause)
+
 class database(object):
+    """
+    The SQL Alchemy session and declarative base are created on import, so
+    that models can be declared at any time, but nothing is bound to a
+    database until :meth:`init` is called.
+    """
     engine = None
-    session = None
-    Base = None
+    replicas = ()
+    session = scoped_session(sessionmaker(
+        class_=RoutingSession, autocommit=False, autoflush=False
+    ))
+    Base = declarative_base()
+    Base.query = session.query_property()
+    # Statements run by the current request (or background task)
+    _request = threading.local()
+
+    # Engines replaced by a configuration reload, until their connections
+    # are all returned
+    _retired = []
+    # Replica engines that failed to connect, until they are tried again
+    _down = {}
 
     @classmethod
     def init(cls):
         """
         Initialised the database connection for SQL Alchemy.
         """
-        from mah.config import config # Delayed to ensure it's loaded
         if not config.ok: return
-        cls.engine = create_engine(
-            config.database.connect,
-            convert_unicode=True,
-            pool_recycle=3600
+        cls.engine = cls._create_engine(config.database.connect)
+        cls.replicas = tuple(
+            cls._create_engine(url, replica=True)
+            for url in config.database.replicas
         )
-        if config.database.logsql:
-            cls.engine.logger = log
-        cls.session = scoped_session(sessionmaker(
-            autocommit=False,
-            autoflush=False,
-            bind=cls.engine
-        ))
-        cls.Base = declarative_base()
-        cls.Base.query = cls.session.query_property()
+        cls.session.configure(bind=cls.engine)
+
+        # Get the table definitions loaded
+        import mah.verification, mah.mailer, mah.report, mah.audit, mah.rollup
 
-        import mah.verification # Get the table definition loaded
+        cls._create_tables(cls.engine)
 
+    @classmethod
+    def _create_tables(cls, engine):
+        if not config.database.create_tables:
+            return
         try:
-            cls.Base.metadata.create_all(bind=cls.engine) ####!
+            cls.Base.metadata.create_all(bind=engine) ####!
         except Exception as e:
-            log.error("Failed to connect to database: {err}.".format(
-                err=e
-            ))
+            log.error("Failed to connect to database: {err}.", err=e)
+            raise
+
+    @staticmethod
+    def _create_engine(url, replica=False):
+        engine = create_engine(url, convert_unicode=True, pool_recycle=3600)
+        if config.database.logsql:
+            engine.logger = log
+        event.listen(engine, 'before_cursor_execute', _before_execute)
+        event.listen(engine, 'after_cursor_execute', _after_execute)
+        if replica:
+            event.listen(engine, 'handle_error', _replica_error)
+        return engine
+
+    @classmethod
+    def rebind(cls):
+        """
+        Switch to a new engine for the current database configuration. New
+        sessions use it straight away; the old engine is disposed of once the
+        requests using it have returned their connections. If the new
+        database can't be set up, the old engine is kept.
+        """
+        engine = cls._create_engine(config.database.connect)
+        try:
+            cls._create_tables(engine)
+        except Exception:
+            engine.dispose()
             raise
+        old = [cls.engine] + list(cls.replicas)
+        cls.engine = engine
+        cls.replicas = tuple(
+            cls._create_engine(url, replica=True)
+            for url in config.database.replicas
+        )
+        cls._down.clear()
+        cls.session.configure(bind=engine)
+        cls._retired.extend(e for e in old if e is not None)
+        cls.drain()
+
+    @classmethod
+    def drain(cls):
+        """
+        Close the connections of retired engines that are no longer in use.
+        Run periodically by the worker.
+        """
+        for engine in list(cls._retired):
+            checkedout = getattr(engine.pool, 'checkedout', None)
+            if checkedout is None or checkedout() == 0:
+                engine.dispose()
+                cls._retired.remove(engine)
+
+    @classmethod
+    def dispose(cls):
+        """
+        Close all pooled database connections. Connections must not be shared
+        between processes, so this is called in a newly forked process before
+        it uses the database (see mah.post_fork).
+        """
+        cls.session.remove()
+        for engine in (cls.engine,) + tuple(cls.replicas):
+            if engine is not None:
+                engine.dispose()
 
     @classmethod
     def done(cls, ok=False):
@@ -47,3 +163,177 @@ class database(object):
         else:
             cls.session.rollback() # pylint: disable=E1101
         cls.session.remove()
+        cls._request.pinned = False
+        cls._request.replica_engine = None
+        cls._report()
+
+    @classmethod
+    @contextmanager
+    def replica(cls):
+        """
+        Run the reads inside this block on a read replica (the same one for
+        the rest of the request), unless there are none, the request has
+        been sent to the primary by :meth:`use_primary`, or the block is
+        inside :meth:`primary`. Writes always go to the primary.
+        """
+        state = cls._request
+        state.replica = getattr(state, 'replica', 0) + 1
+        try:
+            yield
+        finally:
+            state.replica -= 1
+
+    @classmethod
+    @contextmanager
+    def primary(cls):
+        """
+        Run the reads inside this block on the primary, even inside
+        :meth:`replica`.
+        """
+        state = cls._request
+        state.primary = getattr(state, 'primary', 0) + 1
+        try:
+            yield
+        finally:
+            state.primary -= 1
+
+    @classmethod
+    def use_primary(cls):
+        """
+        Send the rest of this request's reads to the primary, and, in a
+        request, those of the same user for database.replica_lag seconds,
+        so that they see what they have just written before the replicas
+        catch up.
+        """
+        from flask import has_request_context, session
+        cls._request.pinned = True
+        if cls.replicas and has_request_context():
+            session['_db_primary_until'] = (
+                time.time() + config.database.replica_lag
+            )
+
+    @classmethod
+    def _pinned(cls):
+        from flask import has_request_context, session
+        if getattr(cls._request, 'pinned', False):
+            return True
+        return (
+            has_request_context() and
+            session.get('_db_primary_until', 0) > time.time()
+        )
+
+    @classmethod
+    def _read_engine(cls):
+        state = cls._request
+        if (not cls.replicas or not getattr(state, 'replica', 0) or
+            getattr(state, 'primary', 0) or cls._pinned()):
+            return None
+        engine = getattr(state, 'replica_engine', None)
+        if engine is None or cls._down.get(engine, 0) > time.time():
+            healthy = [
+                e for e in cls.replicas if cls._down.get(e, 0) <= time.time()
+            ]
+            engine = random.choice(healthy) if healthy else None
+            state.replica_engine = engine
+        return engine
+
+    @classmethod
+    def statements(cls):
+        """
+        The statements run by the current request since it last called
+        :meth:`done`.
+
+        :return: a tuple of the number of statements and the seconds they
+                 took.
+        """
+        return (
+            getattr(cls._request, 'count', 0),
+            getattr(cls._request, 'seconds', 0.0)
+        )
+
+    @classmethod
+    def _record(cls, seconds):
+        stats = cls._request
+        stats.count = getattr(stats, 'count', 0) + 1
+        stats.seconds = getattr(stats, 'seconds', 0.0) + seconds
+
+    @classmethod
+    def _report(cls):
+        count, seconds = cls.statements()
+        if not count:
+            return
+        cls._request.count, cls._request.seconds = 0, 0.0
+        limit = config.database.max_statements
+        if limit and count > limit:
+            log.warning(
+                '{route} ran {count} statement(s) in {ms:.1f}ms, more than '
+                'database.max_statements ({limit})',
+                route=_route(),
+                count=count,
+                ms=seconds * 1000,
+                limit=limit
+            )
+        else:
+            log.debug(
+                '{route} ran {count} statement(s) in {ms:.1f}ms',
+                route=_route(),
+                count=count,
+                ms=seconds * 1000
+            )
+
+@on_reload
+def _reloaded(old, new):
+    if (new.database.connect != old['database'].connect or
+        new.database.replicas != old['database'].replicas or
+        new.database.logsql != old['database'].logsql):
+        database.rebind()
+        log.info('Switched to a new database engine')
+
+worker.every(5, database.drain)
+# A task which raised didn't finish its session
+worker.on_failure(lambda: database.done(False))
+
+def _route():
+    from flask import has_request_context, request
+    if has_request_context():
+        return request.endpoint or 'none'
+    return 'background'
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the execution context, so a statement which fails leaves
+    # nothing behind on the connection
+    if context is not None:
+        context._mah_started = time.time()
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_mah_started', None)
+    if started is None:
+        return
+    elapsed = time.time() - started
+    route = _route()
+    metrics.DB_STATEMENTS.inc(route)
+    metrics.DB_SECONDS.add(elapsed, route)
+    database._record(elapsed)
+    threshold = config.database.slow_query_ms
+    if threshold and elapsed * 1000 >= threshold:
+        # Parameters are left out, as they can hold personal details
+        log.warning(
+            'Slow statement ({ms:.1f}ms) in {route}: {statement}',
+            ms=elapsed * 1000,
+            route=route,
+            statement=re.sub(r'\s+', ' ', statement).strip()[:1000]
+        )
+
+def _replica_error(context):
+    if context.engine is None or not (
+        context.is_disconnect or context.connection is None
+    ):
+        return
+    # Unreachable, so leave it out for a while; the primary serves its reads
+    database._down[context.engine] = time.time() + _REPLICA_DOWN
+    log.warning(
+        'Read replica {url} failed, not using it for {seconds}s: {err}',
+        url=repr(context.engine.url),
+        seconds=_REPLICA_DOWN,
+        err=context.original_exception
+    )
@@ -1,6 +1,9 @@
 """
 Base classes for directory services.
 """
+from mah.config import config as mahconfig, on_reload
+
+_MISSING = object()
 
 class Person(object):
     """
@@ -70,3 +73,54 @@ class Directory(object):
         :return: a Person (or subclass) object or None 
         :rtype: mah.directory.Person
         """
+
+    @classmethod
+    def lookup(cls, *uids):
+        """
+        Find specific staff members, like user, remembering the results in
+        the cache (see mah.cache) for directory.cache_ttl seconds. The
+        directory is only connected to if some of them aren't cached. Uids
+        that weren't found are not cached, as backends can't tell a missing
+        user from a directory they failed to reach.
+
+        :param uids: the user IDs of the staff members to find.
+        :return: a list of a Person (or subclass) object or None for each uid.
+        :rtype: list
+        """
+        cache = mahconfig.cache.backend
+        ttl = cls.config.cache_ttl
+        found = [
+            cache.get(u'user:' + uid, _MISSING) if ttl else _MISSING
+            for uid in uids
+        ]
+        if any(person is _MISSING for person in found):
+            staff = cls()
+            for index, uid in enumerate(uids):
+                if found[index] is _MISSING:
+                    found[index] = staff.user(uid)
+                    if ttl and found[index] is not None:
+                        cache.set(u'user:' + uid, found[index], ttl)
+        return found
+
+    @classmethod
+    def ping(cls, timeout):
+        """
+        Check that the directory can be reached, for the /readyz health
+        check. Raise an exception if it can't. The default implementation
+        doesn't check anything.
+
+        :param timeout: seconds to wait for the directory.
+        :return: False if the directory was not checked.
+        """
+        return False
+
+def _options(section):
+    return dict(
+        (key, section[key]) for key in section._keys if key != 'backend'
+    )
+
+@on_reload
+def _reloaded(old, new):
+    # Users cached from the old directory may not be in the new one
+    if _options(old['directory']) != _options(new.directory):
+        new.cache.backend.delete_prefix(u'user:')
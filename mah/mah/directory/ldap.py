@@ -1,14 +1,25 @@
 """
 Use LDAP or AD for directory services.
 """
-import ldap3, traceback
+import ldap3, socket, traceback
+from ldap3.core.exceptions import (
+    LDAPCommunicationError, LDAPResponseTimeoutError
+)
+from ldap3.utils.conv import escape_filter_chars
 try:
     from urlparse import urlparse
 except:
     from urllib.parse import urlparse
 from mah.directory import Directory as DirectoryBase, Person as PersonBase
+from mah.breaker import breaker, CircuitOpenError
 from mah.log import log
 
+FAILURES = (LDAPCommunicationError, LDAPResponseTimeoutError, socket.error)
+"""
+The exceptions which show the LDAP or AD server is failing, for its circuit
+breaker: not, for instance, an invalid search filter.
+"""
+
 class Person(PersonBase):
     """
     Ensure all requested attributes are listed, even if they are set to None
@@ -42,11 +53,14 @@ class Directory(DirectoryBase):
             read_only=True
         )
         try:
-            self.conn.bind()
+            breaker('ldap', FAILURES).call(self.conn.bind)
+        except CircuitOpenError:
+            raise
         except Exception:
-            log.error("Could not bind to LDAP server: {err}".format(
+            log.error(
+                "Could not bind to LDAP server: {err}",
                 err=traceback.format_exc()
-            ))
+            )
         else:
             self.connected = True
 
@@ -55,9 +69,10 @@ class Directory(DirectoryBase):
             return []
         cookie = None
         ret = []
-        log.debug("Running search {search}".format(search=search))
+        log.debug("Running search {search}", search=search)
         while True:
-            self.conn.search(
+            breaker('ldap', FAILURES).call(
+                self.conn.search,
                 search_base=self.config.ldap_base,
                 search_filter=search,
                 search_scope=ldap3.SUBTREE,
@@ -115,6 +130,33 @@ class Directory(DirectoryBase):
         config.ldap_password = url.password
         config.ldap_use_ssl = url.scheme == 'ldaps'
 
+    @classmethod
+    def ping(cls, timeout):
+        """
+        Bind to the LDAP or AD server, and unbind again.
+        """
+        conn = ldap3.Connection(
+            ldap3.Server(
+                host=cls.config.ldap_hostname,
+                port=cls.config.ldap_port,
+                use_ssl=cls.config.ldap_use_ssl,
+                get_info=ldap3.NONE,
+                connect_timeout=timeout
+            ),
+            auto_bind=False,
+            user=cls.config.ldap_username,
+            password=cls.config.ldap_password,
+            receive_timeout=timeout,
+            read_only=True
+        )
+        try:
+            if not breaker('ldap', FAILURES).call(conn.bind):
+                raise RuntimeError('LDAP bind failed: {result}'.format(
+                    result=conn.result.get('description')
+                ))
+        finally:
+            conn.unbind()
+
     def search(self, query):
         """
         Search the LDAP or AD directory, comparing against the fields listed in
@@ -138,7 +180,7 @@ class Directory(DirectoryBase):
         """
         search=u'({attr}=*{uid}*)'.format(
             attr=self.config.id_attribute,
-            uid=uid
+            uid=escape_filter_chars(uid)
         )
         results = self._search(search)
         if len(results) == 1:
@@ -149,7 +191,9 @@ class Directory(DirectoryBase):
             log.error(
                 "ldap error: searching for a uid of {uid} without wildcards "
                 "returned {results} results. Possible LDAP "
-                "inconsistency?".format(uid=uid, results=len(results))
+                "inconsistency?",
+                uid=uid,
+                results=len(results)
             )
         return None
 
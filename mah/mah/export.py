@@ -0,0 +1,162 @@
+"""
+Export the history of authentications for auditors, as CSV or as JSON lines
+(one JSON object per line).
+
+Rows are read through a server-side cursor, application.export_batch at a
+time, as plain tuples of columns rather than Verification objects, so they
+never enter the session's identity map, and each is written out as soon as
+it is read: memory use is the same however many rows are exported.
+Administrators (see application.admins) can download an export from
+/admin/export; it is also available from the command line::
+
+    python -m mah.export --format csv --start 2026-01-01 --end 2026-02-01
+
+Shared secrets are never exported.
+"""
+import csv, json, sys
+from collections import OrderedDict
+from datetime import datetime
+from sqlalchemy import or_
+from mah.config import config
+from mah.database import database as db
+from mah.verification import Verification
+
+COLUMNS = (
+    'auth_id', 'source_uid', 'source_name', 'dest_uid', 'dest_name',
+    'expiry', 'reciprocated', 'generation'
+)
+
+_TIME_FORMATS = ('%Y-%m-%d', '%Y-%m-%dT%H:%M:%S')
+
+def parse_time(value):
+    """
+    Parse a date (YYYY-MM-DD) or a UTC time (YYYY-MM-DDTHH:MM:SS) given to
+    filter an export.
+
+    :return: a datetime, or None if value is empty.
+    :raises ValueError: if value is in neither format.
+    """
+    if not value:
+        return None
+    for fmt in _TIME_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError(
+        'Invalid time {value!r}, expected YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS'
+        .format(value=value)
+    )
+
+def rows(start=None, end=None, uid=None):
+    """
+    The authentications expiring from start (inclusive) to end (exclusive),
+    to or from uid if it is given, in the order they were created.
+
+    :return: an iterator of tuples of the values of COLUMNS, read from the
+             database as it is consumed.
+    """
+    query = db.session.query( # pylint: disable=E1101
+        *[getattr(Verification, column) for column in COLUMNS]
+    )
+    if start is not None:
+        query = query.filter(Verification.expiry >= start)
+    if end is not None:
+        query = query.filter(Verification.expiry < end)
+    if uid:
+        query = query.filter(or_(
+            Verification.source_uid == uid, Verification.dest_uid == uid
+        ))
+    return query.order_by(Verification.auth_id).yield_per(
+        config.application.export_batch
+    )
+
+def _value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+class _Line(object):
+    # A file for csv.writer that keeps the last line written
+    data = ''
+    def write(self, data):
+        self.data = data
+
+def csv_lines(rows):
+    """
+    Format rows as CSV, after a header line of the column names.
+    """
+    line = _Line()
+    writer = csv.writer(line)
+    def text(value):
+        value = _value(value)
+        if value is None:
+            return ''
+        if isinstance(value, bool):
+            return int(value)
+        if str is bytes and isinstance(value, type(u'')):
+            return value.encode('utf-8') # The Python 2 csv module wants bytes
+        return value
+    writer.writerow(COLUMNS)
+    yield line.data
+    for row in rows:
+        writer.writerow([text(value) for value in row])
+        yield line.data
+
+def jsonl_lines(rows):
+    """
+    Format rows as JSON objects keyed by column name, one per line.
+    """
+    for row in rows:
+        yield json.dumps(
+            OrderedDict(zip(COLUMNS, [_value(value) for value in row]))
+        ) + '\n'
+
+FORMATS = OrderedDict([
+    ('csv', ('text/csv', csv_lines)),
+    ('jsonl', ('application/x-ndjson', jsonl_lines))
+])
+"""
+The export formats, mapped to their MIME type and line formatting function.
+"""
+
+def lines(fmt='csv', start=None, end=None, uid=None):
+    """
+    Stream an export, reading from a read replica if there are any. The
+    database session is finished when the last line has been produced.
+
+    :param fmt: a key of FORMATS.
+    :return: an iterator of lines of text.
+    """
+    ok = False
+    try:
+        with db.replica():
+            for line in FORMATS[fmt][1](rows(start, end, uid)):
+                yield line
+        ok = True
+    finally:
+        db.done(ok)
+
+if __name__ == '__main__':
+    import argparse
+    from mah.config import load
+    parser = argparse.ArgumentParser(
+        prog='python -m mah.export',
+        description='Export authentications to standard output.'
+    )
+    parser.add_argument('--format', choices=list(FORMATS), default='csv')
+    parser.add_argument('--start', type=parse_time,
+                        help='first expiry time to include (UTC)')
+    parser.add_argument('--end', type=parse_time,
+                        help='expiry time to stop at (UTC)')
+    parser.add_argument('--uid', help='only authentications to or from uid')
+    args = parser.parse_args()
+    load()
+    if not config.ok:
+        sys.exit(config.error)
+    db.init()
+    # Use the imported module, which the configuration is applied to
+    from mah import export
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    for line in export.lines(args.format, args.start, args.end, args.uid):
+        out.write(line if str is bytes else line.encode('utf-8'))
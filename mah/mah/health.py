@@ -0,0 +1,119 @@
+"""
+Dependency health checks for the /readyz endpoint.
+
+Each check probes one dependency (the database, the directory and the login
+service) and records whether it is reachable and how long it took. Results
+are cached for health.cache_seconds, and only one request at a time runs a
+given check - others get the cached result, or wait for the running check -
+so however often the load balancer probes, the backends see at most one
+probe per check per process every health.cache_seconds.
+
+See the :doc:`configuration` section for details.
+"""
+import threading, time
+from traceback import format_exc
+from mah.config import config
+from mah.database import database as db
+from mah.breaker import CircuitOpenError
+from mah.log import log
+
+OK = 'ok'
+FAILED = 'failed'
+OPEN = 'open'
+UNCHECKED = 'unchecked'
+
+class Check(object):
+    """
+    A cached health check.
+
+    :param name: the dependency name, used in the report.
+    :param probe: a callable that raises an exception if the dependency is
+                  unhealthy, and returns False if it cannot be checked.
+    """
+    def __init__(self, name, probe):
+        self.name = name
+        self.probe = probe
+        self._lock = threading.Lock()
+        self._result = None
+        self._checked = 0
+
+    def result(self):
+        """
+        The cached result of the check, running it first if the cached one
+        is too old.
+
+        :rtype: dict
+        """
+        if time.time() - self._checked < config.health.cache_seconds:
+            return self._result
+        if not self._lock.acquire(False):
+            # Another request is running this check
+            if self._result is not None:
+                return self._result
+            self._lock.acquire()
+            self._lock.release()
+            return self._result
+        try:
+            if time.time() - self._checked >= config.health.cache_seconds:
+                self._result = self._run()
+                self._checked = time.time()
+            return self._result
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        started = time.time()
+        error = None
+        try:
+            status = UNCHECKED if self.probe() is False else OK
+        except CircuitOpenError as e:
+            status, error = OPEN, e.__class__.__name__
+            log.warning(
+                "Health check {name} skipped: {err}", name=self.name, err=e
+            )
+        except Exception as e:
+            # /readyz is public, so the details only go to the log
+            status, error = FAILED, e.__class__.__name__
+            log.warning(
+                "Health check {name} failed: {trace}",
+                name=self.name,
+                trace=format_exc()
+            )
+        return {
+            'status': status,
+            'latency_ms': round((time.time() - started) * 1000, 1),
+            'error': error,
+            'checked': time.time()
+        }
+
+def _database():
+    conn = db.engine.connect()
+    try:
+        conn.execute('SELECT 1')
+    finally:
+        conn.close()
+
+def _directory():
+    return config.directory.backend.ping(config.health.timeout)
+
+def _login():
+    return config.login.backend.ping(config.health.timeout)
+
+checks = [
+    Check('database', _database),
+    Check('directory', _directory),
+    Check('login', _login)
+]
+
+def report():
+    """
+    Run (or reuse the cached results of) all checks.
+
+    :return: a tuple of whether every dependency that could be checked is
+             healthy, and a dict of check results keyed by name.
+    """
+    results = dict((check.name, check.result()) for check in checks)
+    ready = all(
+        result['status'] in (OK, UNCHECKED) for result in results.values()
+    )
+    return ready, results
@@ -9,10 +9,22 @@ Usually, this will be used like so::
     from mah.log import log
 
     log.debug("This is a debugging message")
+    log.info("Logout of user {user}.", user=username)
+
+Keyword arguments are substituted into the message with str.format(), but
+only if a handler is going to emit it, so there is no need to check the level
+before logging something expensive to format.
+
+Handlers don't run on the thread doing the logging. Records are put in a
+bounded queue (logging.queue_size) and written to file and syslog by a
+listener thread, so a slow disk or syslog server doesn't hold up requests.
+If the queue is full, logging.overflow decides which message is dropped; the
+number of dropped messages is reported by :func:`stats`, on /status and on
+/metrics.
 """
-import logging
+import atexit, collections, logging, os, threading, time
 from logging.handlers import SysLogHandler
-from logging import FileHandler, getLogger
+from logging import FileHandler
 
 LEVELS = {
     'DEBUG': logging.DEBUG,
@@ -27,10 +39,206 @@ LEVELS = {
     '50': logging.CRITICAL
 }
 
+#: What to do with a new message when the queue is full.
+OVERFLOW = ('drop_new', 'drop_old', 'block')
+
+class _BraceMessage(object):
+    """
+    A message formatted with str.format() when it is first needed.
+    """
+    __slots__ = ('fmt', 'kwargs')
+
+    def __init__(self, fmt, kwargs):
+        self.fmt = fmt
+        self.kwargs = kwargs
+
+    def __unicode__(self):
+        return unicode(self.fmt).format(**self.kwargs)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+class MAHLogger(logging.Logger):
+    """
+    A logger also accepting keyword arguments, which are substituted into the
+    message with str.format().
+    """
+    def _log(self, level, msg, args, exc_info=None, extra=None, **kwargs):
+        if kwargs:
+            msg = _BraceMessage(msg, kwargs)
+        logging.Logger._log(self, level, msg, args, exc_info, extra)
+
+def _message(record):
+    if isinstance(record.msg, _BraceMessage):
+        return unicode(record.msg)
+    return record.getMessage()
+
+class QueueHandler(logging.Handler):
+    """
+    Passes records to the handlers of a listener thread, through a queue of
+    at most size records.
+
+    Adding a record to the queue takes no lock (deque appends are atomic),
+    and the listener is only woken up if it has run out of records, so
+    logging threads don't contend with each other or with the listener.
+
+    :param size: the number of records the queue holds.
+    :param overflow: one of :data:`OVERFLOW`.
+    :param block_timeout: with the block policy, the number of seconds to
+                          wait for room in the queue before dropping the
+                          message.
+    """
+    def __init__(self, size=10000, overflow='drop_new', block_timeout=1.0):
+        logging.Handler.__init__(self)
+        self.size = size
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.handlers = []
+        self.dropped = 0
+        self._pid = None
+        self._records = collections.deque()
+        self._wake = threading.Event()
+        self._idle = False
+        self._stopping = False
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def set_handlers(self, handlers):
+        """
+        Replace the handlers the listener thread writes records to, and
+        accept records of the lowest level any of them emits.
+        """
+        self.handlers = list(handlers)
+        self.setLevel(
+            min([h.level for h in self.handlers] or [logging.NOTSET])
+        )
+
+    def prepare(self, record):
+        """
+        Format the message on the logging thread, so the listener doesn't
+        see arguments that have changed since.
+        """
+        record.msg = _message(record)
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info
+            )
+            record.exc_info = None
+        return record
+
+    def handle(self, record):
+        # The queue needs no handler lock
+        if self.filter(record):
+            self.emit(record)
+        return record
+
+    def emit(self, record):
+        try:
+            if self._pid != os.getpid():
+                self._start()
+            self._put(self.prepare(record))
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def _put(self, record):
+        records = self._records
+        if len(records) >= self.size:
+            if self.overflow == 'block':
+                deadline = time.time() + self.block_timeout
+                while len(records) >= self.size and time.time() < deadline:
+                    time.sleep(0.001)
+            self.dropped += 1
+            if self.overflow == 'drop_old':
+                try:
+                    records.popleft()
+                except IndexError:
+                    pass
+            elif len(records) >= self.size:
+                return
+            else:
+                self.dropped -= 1 # There was room after all
+        records.append(record)
+        if self._idle:
+            self._wake.set()
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # Nothing of the parent's listener survives a fork, and its
+            # locks may have been held at the time
+            for handler in self.handlers:
+                handler.createLock()
+            self._records = collections.deque()
+            self._wake = threading.Event()
+            self._idle = self._stopping = False
+            self._thread = threading.Thread(
+                target=self._listen, name='mah-log'
+            )
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _listen(self):
+        records = self._records
+        while True:
+            try:
+                record = records.popleft()
+            except IndexError:
+                if self._stopping:
+                    return
+                self._idle = True
+                # A record added before _idle was set isn't signalled
+                if not records:
+                    self._wake.wait()
+                self._wake.clear()
+                self._idle = False
+                continue
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def post_fork(self):
+        """
+        Start a new listener thread in a forked process.
+        """
+        self._start_lock = threading.Lock()
+        self._pid = None
+        self.dropped = 0
+
+    def stop(self, timeout=5.0):
+        """
+        Write out queued records and stop the listener thread.
+        """
+        if self._pid != os.getpid():
+            return
+        self._pid = None
+        self._stopping = True
+        self._wake.set()
+        self._thread.join(timeout)
+
+    def stats(self):
+        """
+        :return: a dict of the number of queued records, the queue capacity
+                 and the number of records dropped.
+        """
+        return {
+            'queued': len(self._records),
+            'capacity': self.size,
+            'dropped': self.dropped
+        }
+
 #: This instance is imported and used in various places in MAH.
-log = getLogger(__name__)
-# set this to the lowest level to allow handlers to individually override it.
-log.setLevel(logging.DEBUG)
+log = MAHLogger(__name__)
+log.parent = logging.root
+logging.Logger.manager.loggerDict[__name__] = log
+# Records only get through the queue to the handlers set up by init()
+queue_handler = QueueHandler()
+log.addHandler(queue_handler)
+atexit.register(queue_handler.stop)
 
 def init(config):
     """
@@ -40,20 +248,45 @@ def init(config):
                    also available as **mah.config.config.logging**. See the
                    :doc:`configuration` section for details.
     """
-    global log
-    if config.file_level != 'NONE':
+    handlers = []
+    if config.file_level in LEVELS:
         file_handler = FileHandler(config.file_name)
         file_handler.setLevel(LEVELS[config.file_level])
         file_formatter = logging.Formatter(config.file_format)
         file_handler.setFormatter(file_formatter)
-        log.addHandler(file_handler)
-    if config.syslog_level != 'NONE':
+        handlers.append(file_handler)
+    if config.syslog_level in LEVELS:
         syslog_handler = SysLogHandler(
-            config.syslog_host,
-            config.syslog_port,
+            (config.syslog_host, config.syslog_port),
             config.syslog_facility
         )
         syslog_handler.setLevel(LEVELS[config.syslog_level])
         syslog_formatter = logging.Formatter(config.syslog_format)
         syslog_handler.setFormatter(syslog_formatter)
-        log.addHandler(syslog_handler)
+        handlers.append(syslog_handler)
+    queue_handler.size = config.queue_size
+    queue_handler.overflow = config.overflow
+    queue_handler.block_timeout = config.block_timeout
+    # Replacing the handlers on a running listener would race it, so stop it
+    # first; it is restarted by the next message
+    queue_handler.stop()
+    for handler in queue_handler.handlers:
+        handler.close()
+    queue_handler.set_handlers(handlers)
+    # Calls below every handler's level return before formatting anything
+    log.setLevel(queue_handler.level or logging.CRITICAL + 1)
+
+def post_fork():
+    """
+    Restart the listener thread in a process forked from the one that set
+    up logging.
+    """
+    queue_handler.post_fork()
+
+def stats():
+    """
+    Logging queue statistics for this process, for monitoring.
+
+    :rtype: dict
+    """
+    return queue_handler.stats()
@@ -0,0 +1,272 @@
+"""
+A persistent, asynchronous outgoing mail queue.
+
+Messages are stored in the outbox table in the same transaction as the
+request that created them, and delivered by the background worker (see
+mah.worker) over a single SMTP connection that is reused for as long as there
+is mail to send. Failed deliveries are retried with exponential backoff.
+Several processes may share the outbox; each message is claimed by one of
+them before it is sent.
+
+Usually this will be used like so::
+
+    from mah import mailer
+
+    mailer.enqueue(msg['From'], recipients, msg.as_string())
+    db.done(True)
+    mailer.notify()
+"""
+import smtplib, socket, threading, time
+from datetime import datetime, timedelta
+from traceback import format_exc
+from sqlalchemy import (
+    Column, Integer, String, Text, Boolean, DateTime, Sequence, and_, or_,
+    func
+)
+from mah.config import config
+from mah.database import database as db
+from mah.breaker import breaker
+from mah.worker import worker
+from mah import metrics
+from mah.log import log
+
+Base = db.Base
+
+FAILURES = (
+    socket.error, smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError,
+    smtplib.SMTPHeloError
+)
+"""
+The exceptions which show the mail server is failing, for its circuit
+breaker: connection errors and timeouts, not refused messages.
+"""
+
+class Outbox(Base):
+    """
+    A queued email message.
+    """
+    __tablename__ = 'outbox'
+
+    message_id = Column(Integer, Sequence('outbox_id_seq'), primary_key=True)
+    sender = Column(String(200), nullable=False)
+    recipients = Column(Text, nullable=False)
+    """
+    Comma separated list of recipient addresses.
+    """
+    message = Column(Text, nullable=False)
+    """
+    The full message, headers included.
+    """
+    created = Column(DateTime, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt = Column(DateTime, nullable=False, index=True)
+    claimed_until = Column(DateTime, nullable=True)
+    """
+    Set while a process is delivering this message, so that other processes
+    leave it alone until the claim runs out.
+    """
+    sent = Column(DateTime, nullable=True, index=True)
+    failed = Column(Boolean, nullable=False, default=False)
+    """
+    Set once the message has failed report.queue_max_attempts times. Failed
+    messages are kept, but never retried.
+    """
+    last_error = Column(String(500), nullable=True)
+
+class _Connection(object):
+    """
+    A lazily opened SMTP connection, kept open between messages and closed
+    once it has been idle for report.smtp_idle seconds.
+    """
+    def __init__(self):
+        self.smtp = None
+        self.server = None
+        self.last_used = 0
+
+    def get(self):
+        server = config.report.smtp_server
+        if self.smtp is not None and self.server != server:
+            self.close()
+        if self.smtp is not None:
+            try:
+                self.smtp.noop()
+            except smtplib.SMTPException:
+                self.close()
+        if self.smtp is None:
+            self.smtp = smtplib.SMTP(server)
+            self.server = server
+        self.last_used = time.time()
+        return self.smtp
+
+    def close(self):
+        if self.smtp is None:
+            return
+        try:
+            self.smtp.quit()
+        except Exception:
+            pass
+        self.smtp = None
+
+    def close_if_idle(self):
+        if (self.smtp is not None and
+            time.time() - self.last_used > config.report.smtp_idle):
+            self.close()
+
+_connection = _Connection()
+
+_stats_lock = threading.Lock()
+_stats = {
+    'sent': 0,
+    'retried': 0,
+    'failed': 0,
+    'last_latency': None,
+    'total_latency': 0.0
+}
+
+def enqueue(sender, recipients, message):
+    """
+    Add a message to the outbox in the current database session. It is queued
+    once the session is committed.
+
+    :param sender: the envelope from address.
+    :param recipients: a list of envelope recipient addresses.
+    :param message: the full message as a string.
+    """
+    now = datetime.utcnow()
+    db.session.add(Outbox( # pylint: disable=E1101
+        sender=sender,
+        recipients=','.join(recipients),
+        message=message,
+        created=now,
+        attempts=0,
+        next_attempt=now,
+        failed=False
+    ))
+
+def notify():
+    """
+    Tell the worker there is new mail to deliver.
+    """
+    worker.wake(deliver)
+
+def deliver():
+    """
+    Deliver due messages from the outbox. Run periodically by the worker.
+    """
+    now = datetime.utcnow()
+    due = db.session.query(Outbox.message_id).filter( # pylint: disable=E1101
+        and_(
+            Outbox.sent == None,
+            Outbox.failed == False,
+            Outbox.next_attempt <= now,
+            or_(Outbox.claimed_until == None, Outbox.claimed_until < now)
+        )
+    ).order_by(Outbox.next_attempt).limit(config.report.queue_batch).all()
+    db.done(True)
+    for (message_id,) in due:
+        _deliver_one(message_id)
+    _connection.close_if_idle()
+
+def _deliver_one(message_id):
+    now = datetime.utcnow()
+    claimed = db.session.query(Outbox).filter( # pylint: disable=E1101
+        and_(
+            Outbox.message_id == message_id,
+            Outbox.sent == None,
+            or_(Outbox.claimed_until == None, Outbox.claimed_until < now)
+        )
+    ).update(
+        {'claimed_until': now + timedelta(seconds=300)},
+        synchronize_session=False
+    )
+    db.done(True)
+    if claimed != 1:
+        return # Another process got there first
+    msg = db.session.query(Outbox).get(message_id) # pylint: disable=E1101
+    try:
+        breaker('smtp', FAILURES).call(
+            lambda: _connection.get().sendmail(
+                msg.sender, msg.recipients.split(','), msg.message
+            )
+        )
+    except Exception:
+        _connection.close()
+        msg.attempts += 1
+        msg.claimed_until = None
+        msg.last_error = format_exc()[-500:]
+        if msg.attempts >= config.report.queue_max_attempts:
+            msg.failed = True
+            log.error(
+                'Giving up on queued email {id} after {attempts} '
+                'attempts: {err}',
+                id=message_id,
+                attempts=msg.attempts,
+                err=msg.last_error
+            )
+            _count('failed')
+        else:
+            delay = min(
+                config.report.queue_backoff * 2 ** (msg.attempts - 1),
+                3600
+            )
+            msg.next_attempt = datetime.utcnow() + timedelta(seconds=delay)
+            log.warning(
+                'Failed to send queued email {id} via {server}, retrying in '
+                '{delay} seconds',
+                id=message_id,
+                server=config.report.smtp_server,
+                delay=delay
+            )
+            _count('retried')
+        db.done(True)
+        return
+    sent = datetime.utcnow()
+    latency = (sent - msg.created).total_seconds()
+    msg.sent = sent
+    msg.claimed_until = None
+    db.done(True)
+    with _stats_lock:
+        _stats['sent'] += 1
+        _stats['last_latency'] = latency
+        _stats['total_latency'] += latency
+    metrics.MAIL.inc('sent')
+    metrics.MAIL_LATENCY.add(latency)
+    log.info(
+        'Emailed queued message {id} via {server} after {latency:.1f} '
+        'seconds',
+        id=message_id,
+        server=config.report.smtp_server,
+        latency=latency
+    )
+
+def _count(key):
+    with _stats_lock:
+        _stats[key] += 1
+    metrics.MAIL.inc(key)
+
+def stats():
+    """
+    Queue statistics for monitoring. Counters and latencies are for messages
+    delivered by this process; the depth and oldest message age cover the
+    whole outbox.
+
+    :rtype: dict
+    """
+    depth, oldest = db.session.query( # pylint: disable=E1101
+        func.count(Outbox.message_id),
+        func.min(Outbox.created)
+    ).filter(and_(Outbox.sent == None, Outbox.failed == False)).one()
+    with _stats_lock:
+        result = dict(_stats)
+    result['depth'] = depth
+    result['oldest_age'] = (
+        None if oldest is None
+        else (datetime.utcnow() - oldest).total_seconds()
+    )
+    result['average_latency'] = (
+        result.pop('total_latency') / result['sent'] if result['sent']
+        else None
+    )
+    return result
+
+worker.every(lambda: config.report.queue_poll, deliver)
@@ -0,0 +1,374 @@
+"""
+Request, database and backend metrics, served in the Prometheus text
+exposition format on /metrics.
+
+Metrics are declared once in this module and updated from wherever the
+measured work happens::
+
+    from mah import metrics
+
+    metrics.BACKEND_CALLS.inc('ldap', 'success')
+    metrics.BACKEND_LATENCY.observe(0.042, 'ldap')
+
+Updates only touch an in-memory table under a lock held for a dict lookup
+and an addition. Each process periodically writes its table to its own file
+in metrics.dir, and a scrape of /metrics (answered by any one process) adds
+up the files of all processes, so the numbers cover every mod_wsgi or
+gunicorn process. The files of processes that have exited are folded into a
+single archive file, so that totals never go down.
+
+This is enabled with the metrics section of the configuration. See the
+:doc:`configuration` section for details.
+"""
+import bisect, errno, fcntl, json, os, shutil, tempfile, threading, time
+from mah.worker import worker
+from mah.log import log, stats as log_stats
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+_lock = threading.Lock()
+_values = {}
+_metrics = []
+_settings = {
+    'enabled': False,
+    'dir': None, # Set by init
+    'flush_interval': 15,
+    'buckets': DEFAULT_BUCKETS
+}
+_started = time.time()
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        _metrics.append(self)
+
+class Counter(Metric):
+    """
+    A value that only goes up.
+    """
+    kind = 'counter'
+
+    def inc(self, *labels):
+        """
+        Add one to the counter for the given label values.
+        """
+        self.add(1, *labels)
+
+    def add(self, amount, *labels):
+        """
+        Add amount to the counter for the given label values.
+        """
+        key = (self.name, labels)
+        with _lock:
+            _values[key] = _values.get(key, 0) + amount
+
+class Histogram(Metric):
+    """
+    A distribution of observed values (usually durations in seconds), counted
+    in metrics.buckets.
+    """
+    kind = 'histogram'
+
+    def observe(self, value, *labels):
+        """
+        Record value for the given label values.
+        """
+        buckets = _settings['buckets']
+        index = bisect.bisect_left(buckets, value)
+        key = (self.name, labels)
+        with _lock:
+            counts = _values.get(key)
+            if counts is None:
+                # One count per bucket, one for +Inf, then the sum
+                counts = _values[key] = [0] * (len(buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+REQUESTS = Counter(
+    'mah_http_requests_total', 'HTTP requests served.',
+    ('endpoint', 'method', 'status')
+)
+REQUEST_LATENCY = Histogram(
+    'mah_http_request_duration_seconds', 'Time taken to serve requests.',
+    ('endpoint',)
+)
+EXCEPTIONS = Counter(
+    'mah_http_exceptions_total', 'Exceptions raised by request handlers.',
+    ('endpoint', 'exception')
+)
+DB_STATEMENTS = Counter(
+    'mah_db_statements_total', 'SQL statements executed.', ('endpoint',)
+)
+DB_SECONDS = Counter(
+    'mah_db_statement_seconds_total', 'Time spent executing SQL statements.',
+    ('endpoint',)
+)
+BACKEND_CALLS = Counter(
+    'mah_backend_calls_total',
+    'Calls to the directory, login and mail backends, by outcome (success, '
+    'failure of the backend, error in the call itself, or rejected by an '
+    'open circuit breaker).',
+    ('backend', 'outcome')
+)
+BACKEND_LATENCY = Histogram(
+    'mah_backend_call_duration_seconds',
+    'Time taken by calls to the directory, login and mail backends.',
+    ('backend',)
+)
+MAIL = Counter(
+    'mah_mail_messages_total',
+    'Queued report emails handled, by outcome (sent, retried or failed).',
+    ('outcome',)
+)
+MAIL_LATENCY = Counter(
+    'mah_mail_queue_latency_seconds_total',
+    'Total time sent report emails spent in the queue.'
+)
+COMPRESS_IN = Counter(
+    'mah_compress_bytes_in_total', 'Response bytes before compression.'
+)
+COMPRESS_OUT = Counter(
+    'mah_compress_bytes_out_total', 'Response bytes after compression.'
+)
+CACHE = Counter(
+    'mah_cache_requests_total',
+    'Cache lookups, by kind of data (such as user or active) and outcome '
+    '(hit or miss).',
+    ('kind', 'outcome')
+)
+CACHE_EVICTIONS = Counter(
+    'mah_cache_evictions_total',
+    'Cache entries evicted to stay within cache.max_bytes.'
+)
+LOG_DROPPED = Counter(
+    'mah_log_dropped_total', 'Log messages dropped because the queue was full.'
+)
+
+def init(config):
+    """
+    Apply the metrics configuration.
+
+    :param config: the metrics subsection of the core configuration object,
+                   also available as **mah.config.config.metrics**. See the
+                   :doc:`configuration` section for details.
+    """
+    buckets = tuple(sorted(config.buckets))
+    with _lock:
+        if buckets != _settings['buckets']:
+            # Recorded histograms no longer fit
+            for key in [k for k, v in _values.items() if isinstance(v, list)]:
+                del _values[key]
+        _settings.update(
+            enabled=config.enabled,
+            dir=config.dir,
+            flush_interval=config.flush_interval,
+            buckets=buckets
+        )
+
+def enabled():
+    return _settings['enabled']
+
+def init_app(app):
+    """
+    Time every request made to app.
+    """
+    from flask import g, request
+
+    def start():
+        g.mah_started = time.time()
+
+    def finish(response):
+        endpoint = request.endpoint or 'none'
+        REQUESTS.inc(endpoint, request.method, str(response.status_code))
+        started = getattr(g, 'mah_started', None)
+        if started is not None:
+            REQUEST_LATENCY.observe(time.time() - started, endpoint)
+        return response
+
+    app.before_request(start)
+    app.after_request(finish)
+
+def post_fork():
+    """
+    Forget values inherited from the parent process, which reports them
+    itself.
+    """
+    global _started
+    with _lock:
+        _values.clear()
+    _started = time.time()
+
+def _path(pid=None, started=None):
+    return os.path.join(_settings['dir'], '{pid}-{started}.json'.format(
+        pid=pid or os.getpid(),
+        started=int((started or _started) * 1000)
+    ))
+
+def _snapshot():
+    with _lock:
+        # Counted by the log queue, as mah.log can't use this module
+        _values[(LOG_DROPPED.name, ())] = log_stats()['dropped']
+        return [
+            [name, list(labels), list(value) if isinstance(value, list)
+             else value]
+            for (name, labels), value in _values.items()
+        ]
+
+def _write(path, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    shutil.move(tmp, path)
+
+def _load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return []
+
+def _merge(totals, rows):
+    for name, labels, value in rows:
+        key = (name, tuple(labels))
+        current = totals.get(key)
+        if current is None:
+            totals[key] = list(value) if isinstance(value, list) else value
+        elif isinstance(value, list):
+            if len(value) == len(current):
+                totals[key] = [a + b for a, b in zip(current, value)]
+        else:
+            totals[key] = current + value
+    return totals
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+def flush():
+    """
+    Write this process's metrics to its file, and archive the files of
+    processes that have exited. Run periodically by the worker.
+    """
+    if not _settings['enabled']:
+        return
+    if not os.path.isdir(_settings['dir']):
+        os.makedirs(_settings['dir'])
+    _write(_path(), _snapshot())
+    _archive()
+
+def _archive():
+    folder = _settings['dir']
+    for name in os.listdir(folder):
+        if not name.endswith('.json') or name == 'archive.json':
+            continue
+        try:
+            pid = int(name.split('-', 1)[0])
+        except ValueError:
+            continue
+        if pid == os.getpid() or _alive(pid):
+            continue
+        claimed = os.path.join(folder, name + '.dead')
+        try:
+            os.rename(os.path.join(folder, name), claimed)
+        except OSError:
+            continue # Another process is archiving it
+        with open(os.path.join(folder, 'archive.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            archive = os.path.join(folder, 'archive.json')
+            totals = _merge(_merge({}, _load(archive)), _load(claimed))
+            _write(archive, [
+                [key[0], list(key[1]), value]
+                for key, value in totals.items()
+            ])
+            os.remove(claimed)
+        log.debug('Archived metrics of exited process {pid}', pid=pid)
+
+def collect():
+    """
+    Add up the metrics of all processes.
+
+    :return: a dict mapping (metric name, label values) to a value, or, for
+             histograms, a list of bucket counts followed by the sum.
+    """
+    if not _settings['enabled']:
+        return _merge({}, _snapshot())
+    flush()
+    totals = {}
+    for name in os.listdir(_settings['dir']):
+        if name.endswith('.json'):
+            _merge(totals, _load(os.path.join(_settings['dir'], name)))
+    return totals
+
+def _escape(value):
+    return unicode(value).replace('\\', r'\\').replace('\n', r'\n').replace(
+        '"', r'\"'
+    )
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return u'{' + u','.join(
+        u'{0}="{1}"'.format(name, _escape(value)) for name, value in pairs
+    ) + u'}'
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render(gauges=()):
+    """
+    Render all metrics in the Prometheus text exposition format.
+
+    :param gauges: extra point-in-time values, as a list of (name, help,
+                   [(label pairs, value), ...]) tuples.
+    :rtype: unicode
+    """
+    totals = collect()
+    buckets = _settings['buckets']
+    lines = []
+    for metric in _metrics:
+        lines.append(u'# HELP {0} {1}'.format(metric.name, metric.doc))
+        lines.append(u'# TYPE {0} {1}'.format(metric.name, metric.kind))
+        series = sorted(
+            (labels, value) for (name, labels), value in totals.items()
+            if name == metric.name
+        )
+        for labels, value in series:
+            pairs = list(zip(metric.labels, labels))
+            if metric.kind != 'histogram':
+                lines.append(u'{0}{1} {2}'.format(
+                    metric.name, _labels(pairs), _number(value)
+                ))
+                continue
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ['+Inf'], value[:-1]):
+                cumulative += count
+                lines.append(u'{0}_bucket{1} {2}'.format(
+                    metric.name,
+                    _labels(pairs + [('le', bound)]),
+                    cumulative
+                ))
+            lines.append(u'{0}_sum{1} {2}'.format(
+                metric.name, _labels(pairs), _number(value[-1])
+            ))
+            lines.append(u'{0}_count{1} {2}'.format(
+                metric.name, _labels(pairs), cumulative
+            ))
+    for name, doc, series in gauges:
+        lines.append(u'# HELP {0} {1}'.format(name, doc))
+        lines.append(u'# TYPE {0} gauge'.format(name))
+        for pairs, value in series:
+            lines.append(u'{0}{1} {2}'.format(
+                name, _labels(pairs), _number(value)
+            ))
+    return u'\n'.join(lines) + u'\n'
+
+worker.every(lambda: _settings['flush_interval'], flush)
@@ -18,6 +18,14 @@ NATO source: https://en.wikipedia.org/wiki/NATO_phonetic_alphabet
     'One'
     >>> NATO['blah'] # Not a known NATO word
     'blah'
+
+To spell out whole strings, use :func:`encode`, or :func:`encode_many` for
+many strings at once:
+
+    >>> encode('a1')
+    u'Alpha-One'
+    >>> encode_many(['ab', 'c'])
+    [u'Alpha-Bravo', u'Charlie']
 """
 class NATODict(dict):
     """
@@ -88,3 +96,41 @@ NATO = NATODict({
   '5': 'Five',    '6': 'Six',    '7': 'Seven',   '8': 'Eight',    '9': 'Nine',
   '.': 'Decimal', '-': 'Dash'
 })
+
+class _Table(dict):
+    """
+    A unicode.translate table mapping each character to its NATO word and a
+    dash. Characters without one map to themselves and a dash.
+    """
+    def __missing__(self, codepoint):
+        return unichr(codepoint) + u'-'
+
+_TABLE = _Table()
+for _key, _word in NATO.items():
+    _TABLE[ord(_key)] = _TABLE[ord(_key.upper())] = _word + u'-'
+# Separates the strings given to encode_many
+_SEPARATOR = u'\x00'
+_TABLE[ord(_SEPARATOR)] = _SEPARATOR
+
+def encode(text):
+    """
+    Spell text out in NATO words separated by dashes, with a single
+    translate() call rather than a lookup per character.
+
+    :rtype: unicode
+    """
+    return unicode(text).translate(_TABLE)[:-1]
+
+def encode_many(texts):
+    """
+    Spell out each of texts as :func:`encode` does, with a single translate()
+    call for all of them. texts must not contain NUL characters.
+
+    :rtype: list
+    """
+    if not texts:
+        return []
+    spelled = _SEPARATOR.join(unicode(text) for text in texts)
+    return [
+        text[:-1] for text in spelled.translate(_TABLE).split(_SEPARATOR)
+    ]
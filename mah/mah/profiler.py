@@ -0,0 +1,262 @@
+"""
+On-demand profiling of live requests.
+
+When enabled, a fraction (profiler.sample_rate) of requests, and any request
+carrying a valid X-MAH-Profile header, is profiled. Each profile is written
+to profiler.dir, along with a .json file recording the endpoint, path,
+duration and time of the request; only the newest profiler.keep profiles are
+kept.
+
+Two kinds of profile can be taken (profiler.mode):
+
+cprofile
+    A cProfile profile of the request handler, saved as a .prof file, which
+    can be read with pstats, or turned into a flame graph with tools such as
+    flameprof or snakeviz.
+sample
+    The request's stack is sampled every profiler.interval seconds, and the
+    samples are saved as a .folded file of collapsed stacks (one
+    "frame;frame;frame count" line per distinct stack), as read by
+    flamegraph.pl and speedscope. Its overhead is lower, but it misses
+    anything shorter than the interval.
+
+The header is signed with profiler.secret, and expires. To profile a
+request with curl::
+
+    curl -H "X-MAH-Profile: $(python -m mah.profiler token)" ...
+
+This is configured with the profiler section of the configuration. See the
+:doc:`configuration` section for details.
+"""
+import cProfile, hashlib, hmac, json, os, random, shutil, sys, tempfile
+import threading, time
+from mah.log import log
+
+HEADER = 'X-MAH-Profile'
+
+_settings = {
+    'enabled': False,
+    'mode': 'cprofile',
+    'sample_rate': 0.0,
+    'secret': None,
+    'dir': None, # Set by init
+    'keep': 50,
+    'interval': 0.005
+}
+_ring_lock = threading.Lock()
+
+def init(config):
+    """
+    Apply the profiler configuration.
+
+    :param config: the profiler subsection of the core configuration object,
+                   also available as **mah.config.config.profiler**. See the
+                   :doc:`configuration` section for details.
+    """
+    _settings.update(
+        enabled=config.enabled,
+        mode=config.mode,
+        sample_rate=config.sample_rate,
+        secret=config.secret,
+        dir=config.dir,
+        keep=config.keep,
+        interval=config.interval
+    )
+
+def token(secret, ttl=600):
+    """
+    Create a value for the X-MAH-Profile header, valid for ttl seconds.
+    """
+    expires = str(int(time.time() + ttl))
+    return '{expires}:{signature}'.format(
+        expires=expires,
+        signature=hmac.new(secret, expires, hashlib.sha256).hexdigest()
+    )
+
+def _valid(value):
+    secret = _settings['secret']
+    if not secret or not value or ':' not in value:
+        return False
+    expires, signature = value.split(':', 1)
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    expected = hmac.new(secret, expires, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, str(signature))
+
+def wanted(request):
+    """
+    Whether the current request should be profiled.
+    """
+    if not _settings['enabled']:
+        return False
+    if HEADER in request.headers:
+        return _valid(request.headers[HEADER])
+    return random.random() < _settings['sample_rate']
+
+def call(request, name, func, *args, **kwargs):
+    """
+    Call a request handler, profiling it if :func:`wanted`.
+
+    :param request: the current request.
+    :param name: the handler name, recorded with the profile.
+    """
+    if not wanted(request):
+        return func(*args, **kwargs)
+    profile = (
+        _Sampler(_settings['interval']) if _settings['mode'] == 'sample'
+        else _CProfile()
+    )
+    started = time.time()
+    profile.start()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profile.stop()
+        duration = time.time() - started
+        try:
+            _save(profile, {
+                'endpoint': name,
+                'method': request.method,
+                'path': request.path,
+                'started': started,
+                'duration': duration,
+                'pid': os.getpid(),
+                'mode': _settings['mode']
+            })
+        except Exception as e:
+            log.error(
+                'Failed to save profile of {name}: {err}',
+                name=name,
+                err=e
+            )
+
+class _CProfile(object):
+    suffix = '.prof'
+
+    def __init__(self):
+        self._profile = cProfile.Profile()
+
+    def start(self):
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+
+    def dump(self, path):
+        self._profile.dump_stats(path)
+
+class _Sampler(object):
+    suffix = '.folded'
+
+    def __init__(self, interval):
+        self._interval = interval
+        self._ident = None
+        self._stacks = {}
+        self._done = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._ident = threading.current_thread().ident
+        self._thread = threading.Thread(target=self._run, name='mah-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._done.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._done.wait(self._interval):
+            frame = sys._current_frames().get(self._ident)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{func} ({file}:{line})'.format(
+                    func=code.co_name,
+                    file=os.path.basename(code.co_filename),
+                    line=code.co_firstlineno
+                ))
+                frame = frame.f_back
+            if stack:
+                key = ';'.join(reversed(stack))
+                self._stacks[key] = self._stacks.get(key, 0) + 1
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            for stack, count in sorted(self._stacks.items()):
+                f.write('{stack} {count}\n'.format(stack=stack, count=count))
+
+def _save(profile, meta):
+    folder = _settings['dir']
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    name = '{time}.{millis:03d}-{pid}-{endpoint}-{ms}ms'.format(
+        time=time.strftime('%Y%m%dT%H%M%S', time.gmtime(meta['started'])),
+        millis=int(meta['started'] * 1000) % 1000,
+        pid=meta['pid'],
+        endpoint=meta['endpoint'],
+        ms=int(meta['duration'] * 1000)
+    )
+    fd, tmp = tempfile.mkstemp(dir=folder)
+    os.close(fd)
+    profile.dump(tmp)
+    shutil.move(tmp, os.path.join(folder, name + profile.suffix))
+    meta['profile'] = name + profile.suffix
+    with open(os.path.join(folder, name + '.json'), 'w') as f:
+        json.dump(meta, f)
+    log.info(
+        'Profiled {endpoint} ({ms}ms) to {name}',
+        endpoint=meta['endpoint'],
+        ms=int(meta['duration'] * 1000),
+        name=meta['profile']
+    )
+    _trim(folder)
+
+def _trim(folder):
+    with _ring_lock:
+        metas = sorted(
+            name for name in os.listdir(folder) if name.endswith('.json')
+        )
+        for name in metas[:max(len(metas) - _settings['keep'], 0)]:
+            base = name[:-len('.json')]
+            for suffix in ('.json', '.prof', '.folded'):
+                try:
+                    os.remove(os.path.join(folder, base + suffix))
+                except OSError:
+                    pass
+
+def profiles():
+    """
+    The metadata of the stored profiles, newest first.
+    """
+    folder = _settings['dir']
+    if not os.path.isdir(folder):
+        return []
+    result = []
+    for name in sorted(os.listdir(folder), reverse=True):
+        if name.endswith('.json'):
+            try:
+                with open(os.path.join(folder, name)) as f:
+                    result.append(json.load(f))
+            except (IOError, ValueError):
+                pass # Removed or being written
+    return result
+
+if __name__ == '__main__':
+    # Use the imported module, which the configuration is applied to
+    from mah import profiler
+    from mah.config import config, load
+    load()
+    if not config.ok:
+        sys.exit(config.error)
+    if sys.argv[1:] == ['token']:
+        if not config.profiler.secret:
+            sys.exit('profiler.secret is not set')
+        print(profiler.token(config.profiler.secret))
+    elif sys.argv[1:] == ['list']:
+        for meta in profiler.profiles():
+            print('{profile}  {method} {path}  {ms}ms'.format(
+                ms=int(meta['duration'] * 1000), **meta
+            ))
+    else:
+        sys.exit('usage: python -m mah.profiler token|list')
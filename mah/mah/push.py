@@ -0,0 +1,206 @@
+"""
+An in-process publish/subscribe hub used to push authentication changes to
+the browsers of the users involved, instead of having every open index page
+reload itself every few seconds.
+
+Pages subscribe by user id (see the /events route), and the /auth route
+publishes an event to both parties whenever an authentication is created or
+reciprocated. The hub also schedules an 'expired' event for the moment each
+authentication expires.
+
+Events only reach subscribers connected to the same process that published
+them, and each subscriber holds a server thread, so push is only turned on
+(see :func:`enabled`) when MAH is served by a single process with at least
+MIN_THREADS threads. Pages with a push stream also fetch their state every
+application.refresh seconds, in case an event is missed. Usually this will be
+used like so::
+
+    from mah.push import hub
+
+    hub.publish(['alice', 'bob'], 'created', auth_id=42)
+"""
+import heapq, json, threading, time
+try:
+    from Queue import Queue, Full, Empty
+except ImportError:
+    from queue import Queue, Full, Empty
+from mah.log import log
+
+#: The fewest threads per process push is turned on with, as every open
+#: index page holds one.
+MIN_THREADS = 8
+
+# (processes, threads per process) serving MAH, if known
+_deployment = None
+_warned = []
+
+class Subscription(object):
+    """
+    A single subscriber (one open page) for a user id. Events are buffered in
+    a small bounded queue; if the subscriber falls behind, events are dropped
+    and a single 'resync' event tells the page to fetch its state afresh.
+    """
+    def __init__(self, uid, size=16):
+        self.uid = uid
+        self._queue = Queue(size)
+        self._overflowed = False
+
+    def put(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except Full:
+            self._overflowed = True
+
+    def get(self, timeout):
+        """
+        Wait up to timeout seconds for the next event.
+
+        :return: an (event type, data dict) tuple, or None on timeout.
+        """
+        if self._overflowed:
+            self._overflowed = False
+            return ('resync', {})
+        try:
+            return self._queue.get(True, timeout)
+        except Empty:
+            return None
+
+class Hub(object):
+    """
+    Tracks the subscriptions of this process and delivers events to them.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+        self._timers = []
+        self._timer_cond = threading.Condition(self._lock)
+        self._timer_thread = None
+
+    def subscribe(self, uid):
+        sub = Subscription(uid)
+        with self._lock:
+            self._subscriptions.setdefault(uid, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            subs = self._subscriptions.get(sub.uid)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._subscriptions[sub.uid]
+
+    def subscribers(self):
+        """
+        The number of open subscriptions in this process.
+        """
+        with self._lock:
+            return sum(len(subs) for subs in self._subscriptions.values())
+
+    def publish(self, uids, event, **data):
+        """
+        Send an event to every subscription of the given user ids.
+
+        :param uids: an iterable of user ids.
+        :param event: the event type, for instance 'created'.
+        :param data: JSON serialisable data to send with the event.
+        """
+        with self._lock:
+            subs = [
+                sub for uid in set(uids)
+                for sub in self._subscriptions.get(uid, ())
+            ]
+        for sub in subs:
+            sub.put((event, data))
+
+    def publish_at(self, when, uids, event, **data):
+        """
+        Like :meth:`publish`, but deliver the event at a later time.
+
+        :param when: a UNIX timestamp to deliver the event at.
+        """
+        with self._lock:
+            heapq.heappush(self._timers, (when, list(uids), event, data))
+            self._timer_cond.notify()
+            if self._timer_thread is None or not self._timer_thread.is_alive():
+                self._timer_thread = threading.Thread(
+                    target=self._run_timers, name='mah-push-timers'
+                )
+                self._timer_thread.daemon = True
+                self._timer_thread.start()
+
+    def _run_timers(self):
+        while True:
+            with self._lock:
+                while not self._timers:
+                    self._timer_cond.wait()
+                delay = self._timers[0][0] - time.time()
+                if delay > 0:
+                    self._timer_cond.wait(delay)
+                    continue
+                when, uids, event, data = heapq.heappop(self._timers)
+            try:
+                self.publish(uids, event, **data)
+            except Exception:
+                log.error(
+                    'Failed to publish delayed {event} event',
+                    event=event
+                )
+
+def deployed(processes, threads):
+    """
+    Record how many processes, and threads per process, serve MAH. Called
+    from the server's post-fork hook (see mah.post_fork); under mod_wsgi
+    these are found out by :func:`enabled`.
+    """
+    global _deployment
+    _deployment = (processes, threads)
+
+def _mod_wsgi():
+    try:
+        import mod_wsgi
+        return mod_wsgi.maximum_processes, mod_wsgi.threads_per_process
+    except (ImportError, AttributeError):
+        return None # Not running under mod_wsgi
+
+def enabled():
+    """
+    Whether pages are pushed changes: application.push is set, and MAH is
+    served by a single process with at least MIN_THREADS threads, or by a
+    server that doesn't say how many it has (such as the development
+    server). Otherwise push is off, and a warning is logged once.
+    """
+    global _deployment
+    from mah.config import config
+    if not config.application.push:
+        return False
+    if _deployment is None:
+        _deployment = _mod_wsgi() or (None, None)
+    processes, threads = _deployment
+    if ((processes is None or processes <= 1) and
+        (threads is None or threads >= MIN_THREADS)):
+        return True
+    if not _warned:
+        _warned.append(True)
+        log.warning(
+            'application.push is set, but is turned off as MAH is served '
+            'by {processes} process(es) with {threads} thread(s) each; it '
+            'needs a single process with at least {min} threads',
+            processes=processes,
+            threads=threads,
+            min=MIN_THREADS
+        )
+    return False
+
+def format_event(event, data):
+    """
+    Encode an event in the text/event-stream (Server-Sent Events) format.
+    """
+    return 'event: {event}\ndata: {data}\n\n'.format(
+        event=event,
+        data=json.dumps(data)
+    )
+
+#: The hub for this process. This is imported and used in various places in
+#: MAH.
+hub = Hub()
@@ -1,13 +1,31 @@
 """
 Enable sending of suspicious authentication reports to administrators.
+
+Reports are stored in the reports table, along with a snapshot of the
+reported authentication taken when the report was submitted. They are either
+emailed one by one, or, if report.digest_interval is set, collected into a
+single digest email per interval in which repeated reports of the same
+authentication are grouped together.
+
+Unless report.queue is disabled, emails are queued in the outbox (see
+mah.mailer) rather than sent while the reporting user waits.
 """
-import smtplib
+import smtplib, random
 from email.mime.text import MIMEText
 from datetime import datetime
+from sqlalchemy import (
+    Column, Integer, String, Text, DateTime, Sequence, ForeignKey
+)
 from mah.verification import Verification
 from mah.config import config
+from mah.database import database as db
+from mah.breaker import breaker
+from mah.worker import worker
+from mah import mailer
 from mah.log import log
 
+Base = db.Base
+
 _message_body = """
 The following suspicious MAH authentication interaction has been reported:
 
@@ -25,41 +43,232 @@ Please investigate and take appropriate action.
 
 """[1:]
 
+_digest_body = """
+{count} suspicious MAH authentication interaction report(s) were received
+between {start} UTC and {end} UTC.
+
+{reports}
+Please investigate and take appropriate action.
+
+"""[1:]
+
+_digest_auth = """
+Suspicious authentication:
+{auth}
+Reported {count} time(s):
+
+{reports}
+"""[1:]
+
+_digest_report = """
+Report date: {time} UTC{repeats}
+Reported by (uid): {reporter}
+*** Start Report ***
+{report}
+*** End Report ***
+
+"""[1:]
+
+class Report(Base):
+    """
+    A suspicious interaction report. The details of the reported
+    authentication are copied in when the report is made, so that sending
+    the report needs no further lookups.
+    """
+    __tablename__ = 'reports'
+
+    report_id = Column(Integer, Sequence('report_id_seq'), primary_key=True)
+    auth_id = Column(
+        Integer, ForeignKey('authentications.auth_id'), nullable=True,
+        index=True
+    )
+    """
+    The reported authentication, or None if the reported id did not exist.
+    """
+    reporter_uid = Column(String(32), nullable=False)
+    reason = Column(Text, nullable=False)
+    created = Column(DateTime, nullable=False)
+    source_uid = Column(String(32), nullable=True)
+    source_name = Column(String(200), nullable=True)
+    dest_uid = Column(String(32), nullable=True)
+    dest_name = Column(String(200), nullable=True)
+    expiry = Column(DateTime, nullable=True)
+    digest = Column(Integer, nullable=True, index=True)
+    """
+    Identifies the email the report was sent in. None until it is sent.
+    """
+    digested = Column(DateTime, nullable=True)
+
+    def auth_string(self):
+        """
+        Describe the reported authentication as it was when reported.
+        """
+        if self.auth_id is None:
+            return 'None'
+        return u"<Authentication('{src}' -> '{dst}' @ '{exp} UTC')>".format(
+            src=self.source_uid,
+            dst=self.dest_uid,
+            exp=self.expiry
+        )
+
 def email_report(text, reporter_uid, auth):
     """
-    A email a report of a suspicious authentication interaction.
-    The destination email address, from address, subject and mail server is
-    read from a configuration file.
+    Store a report of a suspicious authentication interaction and, unless
+    reports are sent as digests, email it. The destination email address,
+    from address, subject and mail server is read from a configuration file.
+
+    The report (and, if report.queue is enabled, the email) is added to the
+    current database session, and is stored once the caller commits it.
 
     :param text: the text of the report
     :param reporter_uid: the uid (user id) of the reporter
     :param auth: the authentication id (a uniquely identifying int)
     """
-    msg = MIMEText(_message_body.format(
-        time=str(datetime.utcnow()),
+    verification = Verification.by_id(auth) if str(auth).isdigit() else None
+    report = Report(
+        reporter_uid=reporter_uid,
+        reason=text,
+        created=datetime.utcnow()
+    )
+    if verification is not None:
+        report.auth_id = verification.auth_id
+        report.source_uid = verification.source_uid
+        report.source_name = verification.source_name
+        report.dest_uid = verification.dest_uid
+        report.dest_name = verification.dest_name
+        report.expiry = verification.expiry
+    db.session.add(report) # pylint: disable=E1101
+    if config.report.digest_interval:
+        log.info('Stored suspicious interaction report for the next digest')
+        return
+    report.digest = _digest_token()
+    report.digested = report.created
+    _email(_message_body.format(
+        time=str(report.created),
         reporter=reporter_uid,
-        auth=str(Verification.by_id(auth)),
+        auth=report.auth_string(),
         report=text
     ))
+
+def send_digest():
+    """
+    Email all reports not sent yet as a single digest, grouping reports of
+    the same authentication, and reports with the same reporter and reason.
+    Run periodically by the worker if report.digest_interval is set.
+    """
+    if not config.report.digest_interval:
+        return
+    # Claim the outstanding reports first, so that other processes sending
+    # digests at the same time skip them.
+    token = _digest_token()
+    claimed = db.session.query(Report).filter( # pylint: disable=E1101
+        Report.digest == None
+    ).update(
+        {'digest': token, 'digested': datetime.utcnow()},
+        synchronize_session=False
+    )
+    db.done(True)
+    if not claimed:
+        return
+    reports = db.session.query(Report).filter( # pylint: disable=E1101
+        Report.digest == token
+    ).order_by(Report.report_id).all()
+    by_auth = {}
+    for report in reports:
+        by_auth.setdefault(report.auth_id, []).append(report)
+    sections = []
+    for auth_reports in sorted(by_auth.values(), key=lambda r: -len(r)):
+        unique = {}
+        for report in auth_reports:
+            key = (report.reporter_uid, report.reason.strip())
+            if key in unique:
+                unique[key][1] += 1
+            else:
+                unique[key] = [report, 1]
+        sections.append(_digest_auth.format(
+            auth=auth_reports[0].auth_string(),
+            count=len(auth_reports),
+            reports=''.join([
+                _digest_report.format(
+                    time=str(report.created),
+                    repeats=(
+                        '' if repeats == 1
+                        else ' (and {n} identical report(s))'.format(
+                            n=repeats - 1
+                        )
+                    ),
+                    reporter=report.reporter_uid,
+                    report=report.reason
+                ) for report, repeats in sorted(
+                    unique.values(), key=lambda u: u[0].report_id
+                )
+            ])
+        ))
+    try:
+        _email(_digest_body.format(
+            count=len(reports),
+            start=str(reports[0].created),
+            end=str(reports[-1].created),
+            reports=''.join(sections)
+        ))
+    except Exception:
+        # Release the claim so the reports go out with the next digest
+        db.done(False)
+        db.session.query(Report).filter( # pylint: disable=E1101
+            Report.digest == token
+        ).update(
+            {'digest': None, 'digested': None}, synchronize_session=False
+        )
+        db.done(True)
+        raise
+    db.done(True)
+    log.info(
+        'Sent digest of {count} suspicious interaction report(s) about '
+        '{auths} authentication(s)',
+        count=len(reports),
+        auths=len(by_auth)
+    )
+    mailer.notify()
+
+def _digest_token():
+    return random.randint(1, 2 ** 31 - 1)
+
+def _email(body):
+    msg = MIMEText(body)
     msg['Subject'] = config.report.email_subject
     msg['To'] = ', '.join(config.report.email_to)
     msg['From'] = config.report.email_from
-    try:
-        s = smtplib.SMTP(config.report.smtp_server)
-        s.sendmail(
+    if config.report.queue:
+        mailer.enqueue(
             config.report.email_from,
             config.report.email_to,
             msg.as_string()
         )
-        s.quit()
+        log.info(
+            'Queued suspicious interaction report to {dst}',
+            dst=', '.join(config.report.email_to)
+        )
+        return
+    try:
+        breaker('smtp', mailer.FAILURES).call(_send, msg)
         log.info(
             'Emailed suspicious interaction '
-            'report {src} to {dst} via {server}'.format(
-                src=config.report.email_from,
-                dst=', '.join(config.report.email_to),
-                server=config.report.smtp_server
-            )
+            'report {src} to {dst} via {server}',
+            src=config.report.email_from,
+            dst=', '.join(config.report.email_to),
+            server=config.report.smtp_server
         )
     except Exception:
         log.error('Failed to send suspicious interaction report via email.')
         raise
+
+def _send(msg):
+    s = smtplib.SMTP(config.report.smtp_server)
+    s.sendmail(
+        config.report.email_from,
+        config.report.email_to,
+        msg.as_string()
+    )
+    s.quit()
+
+worker.every(lambda: config.report.digest_interval or 60, send_digest)
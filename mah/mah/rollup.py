@@ -0,0 +1,258 @@
+"""
+Rollups of the authentications created, for the statistics pages of
+administrators (see application.admins), so that these never scan the
+authentications table.
+
+Each authentication created by /auth is counted, once it is committed, in
+two rollup tables: rollup_hourly, the number of authentications created in
+each hour and how many of them reciprocated an existing one, and
+rollup_initiators, the number created by each user on each day. The counts
+are added up in process and written by the background worker (see
+mah.worker) every few seconds, as one increment per hour and per user, so
+concurrent requests don't queue on the same rollup row. Counts not yet
+written when a process is killed outright are lost; they are written when
+it exits normally.
+
+Authentications shown in stateless mode (see authentication.mode) are not
+stored, and are not counted.
+"""
+import atexit, threading
+from datetime import datetime, timedelta
+from traceback import format_exc
+from sqlalchemy import (
+    Column, Integer, String, DateTime, Date, and_, desc, func
+)
+from sqlalchemy.exc import IntegrityError
+from mah.config import config
+from mah.database import database as db
+from mah.worker import worker
+from mah.log import log
+
+Base = db.Base
+
+class HourlyRollup(Base):
+    """
+    The authentications created in an hour (UTC).
+    """
+    __tablename__ = 'rollup_hourly'
+
+    hour = Column(DateTime, primary_key=True, autoincrement=False)
+    authentications = Column(Integer, nullable=False, default=0)
+    reciprocations = Column(Integer, nullable=False, default=0)
+    """
+    How many of the authentications were of a user who had already
+    authenticated their source.
+    """
+
+class InitiatorRollup(Base):
+    """
+    The authentications created by a user in a day (UTC).
+    """
+    __tablename__ = 'rollup_initiators'
+
+    day = Column(Date, primary_key=True, autoincrement=False)
+    source_uid = Column(String(32), primary_key=True)
+    authentications = Column(Integer, nullable=False, default=0)
+
+_lock = threading.Lock()
+_hours = {}      # hour: [authentications, reciprocations]
+_initiators = {} # (day, uid): authentications
+_stats = {'written': 0, 'failed': 0}
+
+def record(source_uid, reciprocated, now=None):
+    """
+    Count an authentication that has been committed, to be written to the
+    rollups by the worker.
+    """
+    now = now or datetime.utcnow()
+    hour = now.replace(minute=0, second=0, microsecond=0)
+    with _lock:
+        counts = _hours.setdefault(hour, [0, 0])
+        counts[0] += 1
+        counts[1] += 1 if reciprocated else 0
+        key = (hour.date(), source_uid)
+        _initiators[key] = _initiators.get(key, 0) + 1
+
+def _merge(hours, initiators):
+    # Put back counts that couldn't be written, to be tried again
+    with _lock:
+        for hour, (count, reciprocations) in hours.items():
+            counts = _hours.setdefault(hour, [0, 0])
+            counts[0] += count
+            counts[1] += reciprocations
+        for key, count in initiators.items():
+            _initiators[key] = _initiators.get(key, 0) + count
+
+def _increment(model, key, **counts):
+    table = model.__table__
+    updated = db.session.execute( # pylint: disable=E1101
+        table.update().where(and_(*[
+            table.c[column] == value for column, value in key.items()
+        ])).values(dict(
+            (column, table.c[column] + count)
+            for column, count in counts.items()
+        ))
+    ).rowcount
+    if not updated:
+        row = dict(key, **counts)
+        db.session.execute(table.insert(), row) # pylint: disable=E1101
+
+def _write(hours, initiators):
+    for hour, (count, reciprocations) in sorted(hours.items()):
+        _increment(
+            HourlyRollup, {'hour': hour},
+            authentications=count, reciprocations=reciprocations
+        )
+    for (day, uid), count in sorted(initiators.items()):
+        _increment(
+            InitiatorRollup, {'day': day, 'source_uid': uid},
+            authentications=count
+        )
+
+def flush():
+    """
+    Add the counts recorded since the last flush to the rollup tables, in
+    one transaction. Run periodically by the worker.
+    """
+    global _hours, _initiators
+    with _lock:
+        hours, initiators = _hours, _initiators
+        _hours, _initiators = {}, {}
+    if not hours:
+        return
+    for attempt in (1, 2):
+        try:
+            _write(hours, initiators)
+            db.done(True)
+        except IntegrityError:
+            db.done(False)
+            if attempt == 1:
+                continue # Another process added the same hour or user first
+            _failed(hours, initiators)
+        except Exception:
+            db.done(False)
+            _failed(hours, initiators)
+        else:
+            with _lock:
+                _stats['written'] += sum(count for count, _ in hours.values())
+        return
+
+def _failed(hours, initiators):
+    # Keep the counts, to be written by the next flush
+    log.error('Failed to write rollups: {trace}', trace=format_exc())
+    with _lock:
+        _stats['failed'] += 1
+    _merge(hours, initiators)
+
+def hourly(start, end):
+    """
+    The authentications created in each hour from start to end (exclusive),
+    read from the rollups only.
+
+    :return: a list of (hour, authentications, reciprocations) tuples, one
+             for every hour in the range, with zeros for hours without any.
+    """
+    start = start.replace(minute=0, second=0, microsecond=0)
+    query = db.session.query( # pylint: disable=E1101
+        HourlyRollup.hour,
+        HourlyRollup.authentications,
+        HourlyRollup.reciprocations
+    ).filter(HourlyRollup.hour >= start, HourlyRollup.hour < end)
+    with db.replica():
+        counts = dict((row[0], row[1:]) for row in query)
+    result = []
+    hour = start
+    while hour < end:
+        count, reciprocations = counts.get(hour, (0, 0))
+        result.append((hour, count, reciprocations))
+        hour += timedelta(hours=1)
+    return result
+
+def totals(start, end):
+    """
+    The authentications created from start to end (exclusive), read from
+    the rollups only.
+
+    :return: a tuple of the number of authentications and of reciprocations.
+    """
+    query = db.session.query( # pylint: disable=E1101
+        func.sum(HourlyRollup.authentications),
+        func.sum(HourlyRollup.reciprocations)
+    ).filter(HourlyRollup.hour >= start, HourlyRollup.hour < end)
+    with db.replica():
+        count, reciprocations = query.one()
+    return int(count or 0), int(reciprocations or 0)
+
+def top_initiators(start, end, limit=10):
+    """
+    The users who created the most authentications on the days from start
+    to end (exclusive), read from the rollups only.
+
+    :return: a list of (uid, authentications) tuples, most first.
+    """
+    total = func.sum(InitiatorRollup.authentications).label('total')
+    query = db.session.query( # pylint: disable=E1101
+        InitiatorRollup.source_uid, total
+    ).filter(
+        InitiatorRollup.day >= start, InitiatorRollup.day < end
+    ).group_by(InitiatorRollup.source_uid).order_by(
+        desc(total), InitiatorRollup.source_uid
+    ).limit(limit)
+    with db.replica():
+        return [(uid, int(count)) for uid, count in query]
+
+def summary(hours=24, days=7, top=10, now=None):
+    """
+    The statistics shown to administrators: the authentications per hour
+    for the last hours hours, and for the last days days their total,
+    reciprocation rate and the top initiators.
+
+    :rtype: dict
+    """
+    now = now or datetime.utcnow()
+    end = now.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    per_hour = hourly(end - timedelta(hours=hours), end)
+    today = now.date()
+    start_day = today - timedelta(days=days - 1)
+    count, reciprocations = totals(
+        datetime.combine(start_day, datetime.min.time()), end
+    )
+    return {
+        'hourly': [
+            {
+                'hour': hour.isoformat(),
+                'authentications': authentications,
+                'reciprocations': reciprocations
+            }
+            for hour, authentications, reciprocations in per_hour
+        ],
+        'days': days,
+        'authentications': count,
+        'reciprocations': reciprocations,
+        'reciprocation_rate': round(float(reciprocations) / count, 3)
+                              if count else None,
+        'top_initiators': [
+            {'uid': uid, 'authentications': authentications}
+            for uid, authentications in top_initiators(
+                start_day, today + timedelta(days=1), top
+            )
+        ]
+    }
+
+def stats():
+    """
+    Rollup statistics for this process, for monitoring.
+
+    :rtype: dict
+    """
+    with _lock:
+        result = dict(_stats)
+        result['pending'] = sum(count for count, _ in _hours.values())
+    return result
+
+def _flush_at_exit():
+    if _hours and config.ok:
+        flush()
+
+worker.every(5, flush)
+atexit.register(_flush_at_exit)
@@ -0,0 +1,92 @@
+from mah import app, export, rollup
+from mah.config import config
+from mah.log import log
+from mah.database import database as db
+from flask import (
+    request, session, abort, render_template, jsonify, Response,
+    stream_with_context
+)
+
+def require_admin():
+    """
+    Abort with 403 Forbidden unless the user is one of application.admins.
+    """
+    if session.get('username') not in config.application.admins:
+        log.warning(
+            u'{user} requested {endpoint} without being an administrator',
+            user=session.get('username'),
+            endpoint=request.endpoint
+        )
+        abort(403)
+
+@app.route('/admin/export')
+def admin_export():
+    """
+    Stream the history of authentications as CSV or JSON lines, to
+    administrators only. Takes the optional query parameters format (csv or
+    jsonl), start and end (YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS, UTC, selecting
+    authentications by expiry) and uid (to or from that user). See
+    mah.export.
+    """
+    require_admin()
+    fmt = request.args.get('format', 'csv')
+    if fmt not in export.FORMATS:
+        abort(400)
+    try:
+        start = export.parse_time(request.args.get('start'))
+        end = export.parse_time(request.args.get('end'))
+    except ValueError:
+        abort(400)
+    uid = request.args.get('uid') or None
+    log.info(
+        u'{user} exported authentications as {fmt} '
+        u'(start={start}, end={end}, uid={uid})',
+        user=session['username'],
+        fmt=fmt,
+        start=start,
+        end=end,
+        uid=uid
+    )
+    response = Response(
+        stream_with_context(export.lines(fmt, start, end, uid)),
+        mimetype=export.FORMATS[fmt][0]
+    )
+    response.headers['Content-Disposition'] = (
+        'attachment; filename=authentications.{ext}'.format(ext=fmt)
+    )
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+def _stats():
+    # The summary for the hours, days and top query parameters
+    limits = (('hours', 24, 744), ('days', 7, 366), ('top', 10, 100))
+    args = {}
+    for name, default, maximum in limits:
+        value = request.args.get(name, str(default))
+        if not value.isdigit() or not 1 <= int(value) <= maximum:
+            abort(400)
+        args[name] = int(value)
+    result = rollup.summary(**args)
+    db.done(True)
+    return result
+
+@app.route('/admin/stats')
+def admin_stats():
+    """
+    Authentications per hour, the reciprocation rate and the top initiators,
+    to administrators only. These are read from the rollups (see
+    mah.rollup), never from the authentications table. Takes the optional
+    query parameters hours (24), the number of hours listed, days (7), the
+    number of days the rate and initiators are for, and top (10), the
+    number of initiators listed.
+    """
+    require_admin()
+    return render_template('admin-stats.html', stats=_stats())
+
+@app.route('/admin/stats.json')
+def admin_stats_json():
+    """
+    The statistics of /admin/stats as JSON, to administrators only.
+    """
+    require_admin()
+    return jsonify(_stats())
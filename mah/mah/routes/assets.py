@@ -0,0 +1,31 @@
+from mah import app, assets
+from mah.config import config
+from flask import request, send_file, abort
+import os, mimetypes
+
+@app.unauthenticated_route('/assets/<path:filename>')
+def asset(filename):
+    """
+    Serve a fingerprinted static asset (see mah.assets), precompressed if
+    the browser accepts it, with headers allowing it to be cached forever.
+    This is available to un-authenticated users.
+    """
+    target = os.path.join(config.assets.build_dir, filename)
+    if (os.path.normpath(filename) != filename or filename.startswith('.') or
+        not os.path.isfile(target)):
+        abort(404)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    encoding, path = None, target
+    accepted = request.accept_encodings
+    for candidate, candidate_path in assets.encodings(target):
+        if accepted[candidate]:
+            encoding, path = candidate, candidate_path
+            break
+    response = send_file(path, mimetype=mimetype, conditional=True)
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.cache_control.public = True
+    response.cache_control.max_age = config.assets.max_age
+    response.headers['Cache-Control'] += ', immutable'
+    return response
@@ -0,0 +1,29 @@
+from mah import app, health
+from mah.config import config
+from flask import jsonify
+
+@app.unauthenticated_route('/healthz')
+def healthz():
+    """
+    Liveness check: answers as long as the process can serve requests. This
+    is available to un-authenticated users.
+    """
+    return jsonify(status='ok')
+
+@app.unauthenticated_route('/readyz')
+def readyz():
+    """
+    Readiness check: reports whether the database, directory and login
+    service can be reached, with 503 if any can't. Results are cached (see
+    mah.health). This is available to un-authenticated users.
+    """
+    if not config.ok:
+        response = jsonify(status='failed', error=config.error)
+        response.status_code = 503
+        return response
+    ready, checks = health.report()
+    response = jsonify(status='ok' if ready else 'failed', checks=checks)
+    if not ready:
+        response.status_code = 503
+    response.headers['Cache-Control'] = 'no-store'
+    return response
@@ -0,0 +1,44 @@
+from mah import app, breaker, mailer, metrics
+from mah.config import config
+from mah.database import database as db
+from flask import Response, abort, request
+
+_breaker_states = {breaker.CLOSED: 0, breaker.HALF_OPEN: 1, breaker.OPEN: 2}
+
+@app.unauthenticated_route('/metrics', endpoint='metrics')
+def metrics_page():
+    """
+    Serve metrics in the Prometheus text exposition format, to the addresses
+    listed in metrics.allow. See mah.metrics.
+    """
+    if not metrics.enabled():
+        abort(404)
+    if request.remote_addr not in config.metrics.allow:
+        abort(403)
+    mail = mailer.stats()
+    cached = config.cache.backend.stats()
+    db.done(True)
+    gauges = [
+        ('mah_mail_queue_depth', 'Report emails waiting to be sent.',
+         [([], mail['depth'])]),
+        ('mah_mail_queue_oldest_age_seconds',
+         'Age of the oldest report email waiting to be sent.',
+         [([], mail['oldest_age'] or 0)]),
+        ('mah_breaker_state',
+         'Circuit breaker state in the scraped process (0 closed, '
+         '1 half-open, 2 open).',
+         [([('backend', name)], _breaker_states[status['state']])
+          for name, status in sorted(breaker.status().items())]),
+        ('mah_cache_entries',
+         'Entries in the cache of the scraped process (shared by all '
+         'processes with the sqlite cache).',
+         [([], cached['entries'])]),
+        ('mah_cache_bytes',
+         'Bytes of values in the cache of the scraped process (shared by all '
+         'processes with the sqlite cache).',
+         [([], cached['bytes'])])
+    ]
+    return Response(
+        metrics.render(gauges),
+        content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
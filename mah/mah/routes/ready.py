@@ -4,15 +4,63 @@ from mah.log import log
 from mah.database import database as db
 from mah.verification import Verification
 from mah.report import email_report
+from mah import mailer, audit, rollup
+from mah import push
+from mah.push import hub, format_event
 from flask import (
-    request, session, flash, url_for, render_template, make_response, redirect
+    request, session, flash, url_for, render_template, make_response, redirect,
+    abort, Response
 )
 from traceback import format_exc
-import time, re
+from datetime import datetime
+import time, re, os, hashlib
+
+_etag_salt = None
+_help_pages = {} # Rendered help page for anonymous users, by script root
 
 def go_home():
     return redirect(url_for('index'))
 
+def page_etag(*parts):
+    """
+    Compute an ETag for a page of the current user from parts describing
+    its content. The session's CSRF token and the template modification
+    times are included, as they also affect the rendered page.
+    """
+    global _etag_salt
+    if _etag_salt is None:
+        templates = os.path.join(app.root_path, app.template_folder)
+        _etag_salt = str(max(
+            os.path.getmtime(os.path.join(templates, name))
+            for name in os.listdir(templates)
+        ))
+    return hashlib.sha1(u'\0'.join(
+        [_etag_salt, session['username'], session.get('_csrf_token', '')] +
+        [unicode(part) for part in parts]
+    ).encode('utf-8')).hexdigest()
+
+def not_modified(etag):
+    """
+    Return a 304 response if the client's cached copy of the page has the
+    given ETag, or None if the page should be rendered. Pages with pending
+    flashed messages are always rendered.
+    """
+    if (session.get('_flashes') or
+        not request.if_none_match.contains_weak(etag)):
+        return None
+    response = make_response('', 304)
+    response.set_etag(etag, weak=True)
+    return response
+
+def cache_validated(response, etag):
+    """
+    Mark a rendered page with its ETag, and require clients to revalidate
+    their cached copy on every use.
+    """
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
 @app.before_request
 def check_authentication():
     # Don't interfere with unauthenticated routes
@@ -22,19 +70,21 @@ def check_authentication():
     if 'username' not in session or not session.get('logged_in', False):
         log.debug(
             u"{endpoint} requested without a valid session. "
-            u"Redirecting to login.".format(endpoint=request.endpoint)
+            u"Redirecting to login.",
+            endpoint=request.endpoint
         )
         return redirect(url_for('login'))
     elif session.get('timeout', 0.0) < time.time():
         session['logged_in'] = False
         flash('Your session has expired, please login again.')
-        log.info(u'Session expired for user {user}.'.format(
-            user=session['username']
-        ))
+        log.info(u'Session expired for user {user}.', user=session['username'])
         return redirect(url_for('login'))
 
 @app.after_request
 def update_session(response):
+    # Cacheable static files shouldn't touch the session
+    if request.endpoint in ('static', 'asset'):
+        return response
     if 'username' in session:
         session['timeout'] = time.time() + config.application.session_timeout
     return response
@@ -54,7 +104,7 @@ def login():
     Otherwise, the users authentication credentials will be authenticated
     using the configured authentication module.
     """
-    auth = config.login.module.Authentication
+    auth = config.login.backend
     if request.method == 'GET' and session.get('logged_in', False):
         # Login attempt while logged in - just redirect home
         return go_home()
@@ -66,22 +116,20 @@ def login():
         if session['logged_in']:
             log.info(
                 "Authentication successful ({type}) for "
-                "user {user} from {ip}".format(
-                    type=config.login.type,
-                    user=session['username'],
-                    ip=request.remote_addr
-                )
+                "user {user} from {ip}",
+                type=config.login.type,
+                user=session['username'],
+                ip=request.remote_addr
             )
             flash("Welcome {user}.".format(user=session['username']))
             return go_home()
         else:
             log.info(
                 "Authentication failure ({type}) for "
-                "user {user} from {ip}".format(
-                    type=config.login.type,
-                    user=session['username'],
-                    ip=request.remote_addr
-                )
+                "user {user} from {ip}",
+                type=config.login.type,
+                user=session['username'],
+                ip=request.remote_addr
             )
             flash("Login failed.")
     return render_template(
@@ -97,25 +145,79 @@ def index():
     this user, both as the source and the destination (if they exist) and a
     search option.
 
+    With a 'fragment' argument, only the authentication lists are rendered,
+    for pages updating themselves from the /events push stream.
+
     If the configuration is bad, only display an error page
     """
-    src_auths = Verification.by_src(session['username'])
-    dst_auths = Verification.by_dst(session['username'])
+    fragment = 'fragment' in request.args
+    pushed = push.enabled()
+    etag = page_etag(
+        'index', fragment, pushed,
+        Verification.version(session['username'])
+    )
+    response = not_modified(etag)
+    if response is not None:
+        if not (fragment or pushed):
+            response.headers['Refresh'] = config.application.refresh
+        db.done(True)
+        return response
+    src_auths, dst_auths = Verification.active(
+        session['username'], datetime.utcnow()
+    )
     log.debug(
         u'index called by user {user} - auths as source '
-        u'({src}) and destination ({dst})'.format(
-            user=session['username'],
-            src=len(src_auths),
-            dst=len(dst_auths)
-        )
+        u'({src}) and destination ({dst})',
+        user=session['username'],
+        src=len(src_auths),
+        dst=len(dst_auths)
     )
-    response = make_response(
-        render_template('index.html', src_auths=src_auths, dst_auths=dst_auths)
-    )
-    response.headers['Refresh'] = config.application.refresh
+    if fragment:
+        response = make_response(render_template(
+            'auths.html', src_auths=src_auths, dst_auths=dst_auths
+        ))
+    else:
+        response = make_response(render_template(
+            'index.html', src_auths=src_auths, dst_auths=dst_auths,
+            push=pushed, refresh=config.application.refresh,
+            stateless=config.authentication.mode == 'stateless'
+        ))
+        if not pushed:
+            response.headers['Refresh'] = config.application.refresh
+    cache_validated(response, etag)
     db.done(True)
     return response
 
+@app.route('/events')
+def events():
+    """
+    A Server-Sent Events stream notifying the index page of this user when
+    an authentication to or from them is created, reciprocated or expires.
+    Only available when push is enabled (see mah.push.enabled).
+
+    The stream is closed after application.push_max_duration seconds; the
+    browser reconnects by itself.
+    """
+    if not push.enabled():
+        abort(404)
+    subscription = hub.subscribe(session['username'])
+    heartbeat = config.application.push_heartbeat
+    deadline = time.time() + config.application.push_max_duration
+    def stream():
+        try:
+            yield 'retry: {ms}\n\n'.format(ms=heartbeat * 1000)
+            while time.time() < deadline:
+                event = subscription.get(heartbeat)
+                if event is None:
+                    yield ': keepalive\n\n'
+                else:
+                    yield format_event(*event)
+        finally:
+            hub.unsubscribe(subscription)
+    response = Response(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
 @app.route('/auth', methods=['POST'])
 def authenticate():
     """
@@ -129,7 +231,9 @@ def authenticate():
     * The source and destination uid are not identical.
     * The authentication doesn't already exist, that is, a non-expired
       authentication with the same source and destination is not already
-      present.
+      present. This is decided by the database when the authentication is
+      inserted (see Verification.create), so two submissions racing each
+      other can't both create one.
     * There is also a check (within the authentication code) that will
       cause and exception if the destination is not within the staff
       directory. This should only occur if the client is tampering with
@@ -148,40 +252,75 @@ def authenticate():
     if src == dst:
         log.debug(
             u'Illegal authenication attempted with identical '
-            u'source ({src}) and destination ({dst})'.format(
-                src=src,
-                dst=dst
-            )
+            u'source ({src}) and destination ({dst})',
+            src=src,
+            dst=dst
         )
         flash(u"You can't authenticate yourself.")
         return go_home()
-    if Verification.exists(src, dst):
+    if config.authentication.mode == 'stateless':
+        return authenticate_stateless(src, dst)
+    try:
+        verification = Verification.create(src, dst)
+    except Exception:
+        log.error("Authentication creation error: {trace}", trace=format_exc())
+        db.done(False)
+        flash('Failed to create authentication! Please try again later.')
+        return go_home()
+    if verification is None:
         log.debug(
             u'Duplicate authentication attempted with '
-            u'source ({src}) and destination ({dst})'.format(
-                src=src,
-                dst=dst
-            )
+            u'source ({src}) and destination ({dst})',
+            src=src,
+            dst=dst
         )
+        db.done(False)
         flash("Authentication already exists.")
         return go_home()
-    log.info(u'Authentication created by {src} for {dst} from {ip}'.format(
+    log.info(
+        u'Authentication created by {src} for {dst} from {ip}',
         src=src,
         dst=dst,
         ip=request.remote_addr
-    ))
+    )
+    response = make_response(render_template('auth.html', auth=verification))
+    auth_id = verification.auth_id
+    event = 'reciprocated' if verification.reciprocated else 'created'
+    expiry = verification.expiry_timestamp
+    db.use_primary()
+    db.done(True)
+    Verification.invalidate(src, dst)
+    rollup.record(src, verification.reciprocated)
+    if push.enabled():
+        hub.publish([src, dst], event, auth_id=auth_id)
+        hub.publish_at(expiry, [src, dst], 'expired', auth_id=auth_id)
+    response.headers['Refresh'] = (
+        '{refresh}; {url}'.format(
+            refresh=config.application.refresh, url=url_for('index')
+        )
+    )
+    return response
+
+def authenticate_stateless(src, dst):
+    """
+    The stateless mode version of authenticate: the shared secret is
+    derived (see Verification.derive), so nothing is written to the
+    database, apart from an audit event written later by the worker.
+    """
     try:
-        verification = Verification(src, dst)
-        db.session.add(verification) # pylint: disable=E1101
+        verification = Verification.derive(src, dst)
     except Exception:
-        log.error("Authentication creation error: {trace}".format(
-            trace=format_exc()
-        ))
-        db.done(False)
+        log.error("Authentication creation error: {trace}", trace=format_exc())
         flash('Failed to create authentication! Please try again later.')
         return go_home()
+    log.info(
+        u'Authentication derived by {src} for {dst} from {ip}',
+        src=src,
+        dst=dst,
+        ip=request.remote_addr
+    )
+    audit.record(src, dst, request.remote_addr)
     response = make_response(render_template('auth.html', auth=verification))
-    db.done(True)
     response.headers['Refresh'] = (
         '{refresh}; {url}'.format(
             refresh=config.application.refresh, url=url_for('index')
@@ -199,22 +338,20 @@ def search():
     if request.method == 'POST':
         search = request.form['searchstr'].strip()
         if len(search) > 2 and re.match(r'^[a-zA-Z0-9\s]+\Z', search):
-            staff = config.directory.module.Directory()
+            staff = config.directory.backend()
             res = staff.search(search)
             log.debug(
                 u"user {user} searched for string '{search}', which "
-                u"matched {count} directory record(s)".format(
-                    user=session['username'],
-                    search=search,
-                    count=len(res)
-                )
+                u"matched {count} directory record(s)",
+                user=session['username'],
+                search=search,
+                count=len(res)
             )
         else:
             log.info(
-                u"user {user} searched for illegal string '{search}'".format(
-                    user=session['username'],
-                    search=search
-                )
+                u"user {user} searched for illegal string '{search}'",
+                user=session['username'],
+                search=search
             )
             res = []
             search = ''
@@ -245,25 +382,40 @@ def report():
                 raise Exception(
                     'non-positive integer auth_id provided to report method'
                 )
+            # The reported fields of an authentication never change, so a
+            # copy of this page is valid for as long as the session is.
+            etag = page_etag('report', rep_auth_id)
+            response = not_modified(etag)
+            if response is not None:
+                return response
             rep_auth = Verification.by_id(rep_auth_id)
         if rep_auth is None:
+            etag = page_etag(
+                'report', Verification.history_version(session['username'])
+            )
+            response = not_modified(etag)
+            if response is not None:
+                db.done(True)
+                return response
             all_auths = Verification.all(session['username'])
-        response = render_template(
+        response = cache_validated(make_response(render_template(
             'report.html', auth=rep_auth, all_auths=all_auths
-        )
+        )), etag)
     else:
         reason = request.form['reason']
         report = request.form['reported_auth_id']
         log.info(
             u"user {user} reported authentication with "
-            u"id '{report}' as suspicious with reason: {reason}".format(
-                user=session['username'],
-                report=report,
-                reason=re.sub(r'[\n\r]+', ' ', reason)
-            )
+            u"id '{report}' as suspicious with reason: {reason}",
+            user=session['username'],
+            report=report,
+            reason=re.sub(r'[\n\r]+', ' ', reason)
         )
         email_report(reason, session['username'], report)
         response = render_template('report-submitted.html')
+        db.done(True)
+        mailer.notify()
+        return response
     db.done(True)
     return response
 
@@ -278,9 +430,7 @@ def logout():
     """
     if 'username' in session:
         session['logged_in'] = False
-        log.info(u"Logout of user {user}.".format(
-            user=session.pop('username')
-        ))
+        log.info(u"Logout of user {user}.", user=session.pop('username'))
         flash('You have been logged out')
     return go_home()
 
@@ -289,5 +439,13 @@ def help():
     """
     Display the online help page. This is available to un-authenticated
     users.
+
+    The page only differs between users once they are logged in, so for
+    everyone else it is rendered once and then served from memory.
     """
-    return render_template('help.html')
+    if session.get('logged_in') or session.get('_flashes'):
+        return render_template('help.html')
+    page = _help_pages.get(request.script_root)
+    if page is None:
+        page = _help_pages[request.script_root] = render_template('help.html')
+    return page
@@ -0,0 +1,26 @@
+from mah import app, audit, breaker, compress, mailer, rollup
+from mah.database import database as db
+from mah.log import stats as log_stats
+from mah.config import config
+from flask import jsonify
+
+@app.unauthenticated_route('/status')
+def status():
+    """
+    Report the state of the backend circuit breakers, the report mail queue,
+    the audit queue, the rollups, the log queue, the cache and response
+    compression, and how long this process took to start, as JSON, for
+    monitoring. This is available to un-authenticated users.
+    """
+    response = jsonify(
+        breakers=breaker.status(),
+        mail=mailer.stats(),
+        audit=audit.stats(),
+        rollup=rollup.stats(),
+        logging=log_stats(),
+        cache=config.cache.backend.stats(),
+        compression=compress.stats(),
+        startup=app.startup
+    )
+    db.done(True)
+    return response
@@ -0,0 +1,94 @@
+/*
+ * Keeps the authentication lists on the index page current. Expiry times
+ * are counted down locally from the absolute expiry of each authentication,
+ * and if the page has a push stream (see the application.push option), new,
+ * reciprocated and expired authentications are applied as they happen. Such
+ * pages also fetch the lists every application.refresh seconds, in case an
+ * event was published by another process or lost with the connection.
+ */
+(function () {
+    var auths = document.getElementById('auths');
+    if (!auths) {
+        return;
+    }
+
+    function approxTimeDelta(seconds) {
+        var count = seconds, unit = 'second';
+        if (count > 60) {
+            count = Math.floor(count / 60);
+            unit = 'minute';
+        }
+        return count + ' ' + unit + (count === 1 ? '' : 's');
+    }
+
+    function refresh() {
+        var url = auths.getAttribute('data-fragment');
+        if (!url) {
+            window.location.reload();
+            return;
+        }
+        var xhr = new XMLHttpRequest();
+        xhr.open('GET', url);
+        xhr.onload = function () {
+            if (xhr.status === 200) {
+                auths.innerHTML = xhr.responseText;
+            }
+        };
+        xhr.send();
+    }
+
+    function remove(item) {
+        var list = item.parentNode;
+        var next = item.nextSibling;
+        while (next && next.nodeType !== 1) {
+            next = next.nextSibling;
+        }
+        if (next && next.tagName === 'BR') {
+            list.removeChild(next);
+        }
+        list.removeChild(item);
+        if (!list.querySelector('li')) {
+            refresh();
+        }
+    }
+
+    function tick() {
+        var now = Date.now() / 1000;
+        var items = auths.querySelectorAll('li[data-expiry]');
+        for (var i = 0; i < items.length; i++) {
+            var remaining = Math.floor(
+                parseFloat(items[i].getAttribute('data-expiry')) - now
+            );
+            if (remaining <= 0) {
+                remove(items[i]);
+                continue;
+            }
+            var delta = items[i].querySelector('.expiry-delta');
+            if (delta) {
+                delta.textContent = approxTimeDelta(remaining);
+            }
+        }
+    }
+
+    setInterval(tick, 1000);
+
+    var events = auths.getAttribute('data-events');
+    var every = parseInt(auths.getAttribute('data-refresh'), 10);
+    if (every > 0) {
+        setInterval(refresh, every * 1000);
+    }
+    if (events && window.EventSource) {
+        var source = new EventSource(events);
+        source.addEventListener('created', refresh);
+        source.addEventListener('reciprocated', refresh);
+        source.addEventListener('resync', refresh);
+        source.addEventListener('expired', function (e) {
+            var item = document.getElementById(
+                'auth-' + JSON.parse(e.data).auth_id
+            );
+            if (item) {
+                remove(item);
+            }
+        });
+    }
+})();
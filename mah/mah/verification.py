@@ -3,20 +3,139 @@
 # are referred to as 'Verifications' to avoid overloading with user
 # authentication.
 
-from mah.config import config
+from mah.config import config, on_reload
 from mah.log import log
 from mah.database import database as db
-from mah.nato import NATO
+from mah.nato import encode as nato_encode, encode_many as nato_encode_many
 from sqlalchemy import (
-    Table, Column, Integer, String, Boolean, DateTime, Sequence, or_, and_
+    Table, Column, Integer, String, Boolean, DateTime, Sequence, or_, and_,
+    func, cast, select, literal, exists, UniqueConstraint
 )
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime, timedelta, time
-import os, random, hashlib, binascii
+import os, random, hashlib, hmac, binascii, calendar, threading
 
-# This package should NEVER be imported without mah.database first being
-# initialised, but if it is (for instance, for Sphinx documentation), make a
-# dummy version of the db.Base base object.
-Base = object if db.Base is None else db.Base
+Base = db.Base
+
+# NATO renderings of recent shared secrets, which never change. Bounded by
+# emptying it when full, which is rare as secrets are short lived.
+_nato_codes = {}
+_NATO_CODES_MAX = 4096
+_EPOCH = datetime(1970, 1, 1)
+
+# The columns copied into cached authentications
+_COLUMNS = (
+    'auth_id', 'source_uid', 'source_name', 'dest_uid', 'dest_name',
+    'shared_secret', 'expiry', 'reciprocated'
+)
+
+class Snapshot(object):
+    """
+    A copy of an authentication, detached from the database session, with
+    the attributes the templates use. Given out by the active cache.
+    """
+    __slots__ = _COLUMNS + (
+        'expiry_delta', 'expiry_string', 'nato_code', 'expiry_timestamp',
+        'previous'
+    )
+
+    def __init__(self, row):
+        for name, value in zip(_COLUMNS, row):
+            setattr(self, name, value)
+        self.previous = None
+
+def _row(verification):
+    return tuple(getattr(verification, name) for name in _COLUMNS)
+
+class ActiveCache(object):
+    """
+    The non-expired authentications of recently seen users, as (source,
+    destination) tuples of rows kept by uid in the cache backend (see
+    mah.cache), so that refreshing the index page doesn't query the
+    database.
+
+    An entry is dropped at the earliest expiry it contains, so it never holds
+    an expired authentication; users with none are cached too. The /auth
+    route invalidates the entries of both parties, which changes their
+    generation, kept in the backend too: rows loaded while a user's
+    generation changed may be stale, and are not cached. Entries are also
+    dropped authentication.cache_ttl seconds after they were loaded. Unless
+    the backend is shared by all processes, invalidations only reach the
+    process that made them, which is why the cache is off by default with
+    the memory backend.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(uid):
+        return u'active:' + uid
+
+    def get(self, uid):
+        """
+        :return: the cached (source rows, destination rows) of uid, or None.
+        """
+        return config.cache.backend.get(self._key(uid))
+
+    def generation(self, uid):
+        """
+        A token which changes whenever the entry of uid is invalidated.
+        """
+        return config.cache.backend.get(u'generation:' + uid, 0)
+
+    def put(self, uid, src_rows, dst_rows, now, generation):
+        """
+        Cache the rows of uid loaded at now, unless its entry has been
+        invalidated since its generation was generation, as they may be
+        stale.
+        """
+        ttl = min(
+            [config.authentication.cache_ttl] +
+            [(row[6] - now).total_seconds() for row in src_rows + dst_rows]
+        )
+        with self._lock:
+            if self.generation(uid) == generation:
+                config.cache.backend.set(
+                    self._key(uid), (src_rows, dst_rows), ttl
+                )
+
+    def invalidate(self, *uids):
+        """
+        Drop the entries of the given users. With read replicas, their next
+        database.replica_lag seconds of entries are loaded from the primary,
+        which has the change that caused the invalidation.
+        """
+        backend = config.cache.backend
+        if config.database.replicas:
+            # Before the entries are dropped, so no process reloads them
+            # from a replica that lacks the change
+            for uid in uids:
+                backend.set(u'fresh:' + uid, True, config.database.replica_lag)
+        with self._lock:
+            for uid in uids:
+                # A new token, which outlives any load started before it
+                backend.set(
+                    u'generation:' + uid, binascii.hexlify(os.urandom(8)),
+                    config.authentication.cache_ttl
+                )
+            backend.delete(*[self._key(uid) for uid in uids])
+
+    def fresh(self, uid):
+        """
+        Whether uid's authentications have changed too recently for the read
+        replicas to have them.
+        """
+        return bool(config.database.replicas) and bool(
+            config.cache.backend.get(u'fresh:' + uid)
+        )
+
+#: This instance is shared by all requests of the process.
+cache = ActiveCache()
+
+@on_reload
+def _reloaded(old, new):
+    if new.database.connect != old['database'].connect:
+        new.cache.backend.clear()
 
 class Verification(Base):
     """
@@ -37,6 +156,12 @@ class Verification(Base):
     between humans it provides a reasonable solution.
     """
     __tablename__ = 'authentications'
+    __table_args__ = (
+        UniqueConstraint(
+            'source_uid', 'dest_uid', 'generation',
+            name='uq_authentications_generation'
+        ),
+    )
 
     auth_id = Column(Integer, Sequence('user_id_seq'), primary_key=True)
     """
@@ -44,7 +169,7 @@ class Verification(Base):
     the end user and is automatically incremented as authentications are
     added.
     """
-    source_uid = Column(String(32), nullable=False)
+    source_uid = Column(String(32), nullable=False, index=True)
     """
     The username/uid of the person who initiated the authentication.
     """
@@ -53,7 +178,7 @@ class Verification(Base):
     The human readable name of the source. This is looked up from the staff
     directory.
     """
-    dest_uid = Column(String(32), nullable=False)
+    dest_uid = Column(String(32), nullable=False, index=True)
     """
     The username/uid of the person who was authenticated.
     """
@@ -77,6 +202,13 @@ class Verification(Base):
     (destination user -> source user). This is primarily used to simplify
     template logic.
     """
+    generation = Column(Integer, nullable=False)
+    """
+    Counts the authentications from the source to the destination, starting
+    at 1, and is set by :meth:`create`. As (source_uid, dest_uid, generation)
+    is unique, two requests creating the next authentication of a pair at
+    the same time can't both succeed.
+    """
     expiry_string = ""
     """
     A user friendly and timezone independent string to represent the time
@@ -91,6 +223,12 @@ class Verification(Base):
     is not stored in the database, but instead generated when objected are
     queried.
     """
+    expiry_timestamp = 0
+    """
+    The expiry time as a UNIX timestamp, so that pages can count down to
+    expiry locally. This is not stored in the database, but instead
+    calculated when objects are queried.
+    """
 
     def __init__(self, source_uid, dest_uid):
         """
@@ -99,17 +237,98 @@ class Verification(Base):
         destination uid.
 
         This method also looks up the full name corresponding to each user
-        id and generates a shared secret and an expiry time.
+        id and generates a shared secret and an expiry time. Authentications
+        are only stored by :meth:`create`, which sets the rest.
 
         :param source_uid: the user who initiated the authentication
         :param dest_uid: the user who was authenticated.
         """
         self.source_uid = source_uid
         self.dest_uid = dest_uid
+        self.source_name, self.dest_name = self._names(source_uid, dest_uid)
 
-        staff = config.directory.module.Directory()
-        src = staff.user(source_uid)
-        dst = staff.user(dest_uid)
+        td = timedelta(seconds=config.authentication.timeout)
+        self.expiry = datetime.utcnow() + td
+        self.expiry_string = self._approx_time_delta(td)
+        self.expiry_timestamp = calendar.timegm(self.expiry.utctimetuple())
+        self.shared_secret = self._gen_shared_secret('{src}{exp}{dst}'.format(
+            src=source_uid.decode(),
+            exp=self.expiry_string,
+            dst=dest_uid.decode
+        ))
+        self.nato_code = self._nato_code(self.shared_secret)
+        log.debug(
+            u'New authentication created by {src} to {dst} and '
+            u'expiring at {exp}',
+            src=source_uid,
+            dst=dest_uid,
+            exp=self.expiry
+        )
+
+    @classmethod
+    def create(cls, source_uid, dest_uid):
+        """
+        Create an authentication from source_uid to dest_uid, unless there
+        already is a non-expired one, with a single INSERT ... SELECT: the
+        SELECT yields no row if the pair's latest authentication hasn't
+        expired, and otherwise the pair's next generation, so a concurrent
+        request creating the same authentication fails on the unique
+        generation instead. If the destination has authenticated the
+        source, their authentication is then marked as reciprocated.
+
+        :param source_uid: the user who initiated the authentication
+        :param dest_uid: the user who was authenticated.
+        :return: the new authentication, which is not added to the session,
+                 or None if one already exists.
+        """
+        auth = cls(source_uid, dest_uid)
+        now = datetime.utcnow()
+        table = cls.__table__
+        reverse = table.alias('reciprocal')
+        reverse_active = and_(
+            reverse.c.source_uid == dest_uid,
+            reverse.c.dest_uid == source_uid,
+            reverse.c.expiry > now
+        )
+        pair = select([
+            literal(source_uid, String), literal(auth.source_name, String),
+            literal(dest_uid, String), literal(auth.dest_name, String),
+            literal(auth.shared_secret, String), literal(auth.expiry, DateTime),
+            exists().where(reverse_active),
+            func.coalesce(func.max(table.c.generation), 0) + 1
+        ]).where(and_(
+            table.c.source_uid == source_uid,
+            table.c.dest_uid == dest_uid
+        )).having(
+            func.coalesce(func.max(table.c.expiry), _EPOCH) <= now
+        )
+        insert = table.insert().from_select([
+            'source_uid', 'source_name', 'dest_uid', 'dest_name',
+            'shared_secret', 'expiry', 'reciprocated', 'generation'
+        ], pair)
+        try:
+            result = db.session.execute(insert) # pylint: disable=E1101
+        except IntegrityError:
+            return None # Created by a concurrent request
+        if result.rowcount != 1:
+            return None
+        auth.auth_id = result.lastrowid
+        auth.reciprocated = db.session.execute( # pylint: disable=E1101
+            table.update().where(and_(
+                table.c.source_uid == dest_uid,
+                table.c.dest_uid == source_uid,
+                table.c.expiry > now
+            )).values(reciprocated=True)
+        ).rowcount > 0
+        return auth
+
+    @staticmethod
+    def _names(source_uid, dest_uid):
+        """
+        Look up the names of the source and destination in the directory,
+        raising an exception if either isn't there.
+        """
+        src, dst = config.directory.backend.lookup(source_uid, dest_uid)
         if src == None:
             message = (
                 u"Authentication source ({src}) not found in directory".format(
@@ -125,32 +344,50 @@ class Verification(Base):
             )
             log.error(message)
             raise Exception(message)
-        else:
-            self.source_name = src.attributes[1]
-            self.dest_name = dst.attributes[1]
+        return src.attributes[1], dst.attributes[1]
 
-        reciprocated_auth = self.get(dest_uid, source_uid)
-        if reciprocated_auth:
-            self.reciprocated = True
-            reciprocated_auth.reciprocated = True
-
-        td = timedelta(seconds=config.authentication.timeout)
-        self.expiry = datetime.utcnow() + td
-        self.expiry_string = self._approx_time_delta(td)
-        self.shared_secret = self._gen_shared_secret('{src}{exp}{dst}'.format(
-            src=source_uid.decode(),
-            exp=self.expiry_string,
-            dst=dest_uid.decode
-        ))
-        self.nato_code = self._nato_code(self.shared_secret)
-        log.debug(
-            u'New authentication created by {src} to {dst} and '
-            u'expiring at {exp}'.format(
-                src=source_uid,
-                dst=dest_uid,
-                exp=self.expiry
-            )
-        )
+    @classmethod
+    def derive(cls, source_uid, dest_uid, now=None):
+        """
+        The shared secret of two users in stateless mode (see
+        authentication.mode), which is computed instead of stored: an HMAC,
+        keyed with authentication.hmac_key, of the pair of user ids and a
+        window of time.
+
+        Windows last authentication.timeout seconds and a new one starts
+        every half of that, so two windows overlap at any time. The secret
+        shown is that of the newest window, which has at least half the
+        timeout left, and the secret of the previous window, which is still
+        valid, is given as its previous attribute. Whichever of the two users
+        asks, if they ask less than half the timeout apart, the later one's
+        secret or previous secret is the earlier one's secret.
+
+        :param source_uid: the user asking for the secret
+        :param dest_uid: the other user
+        :param now: the current UTC time, if the caller already has it.
+        :rtype: an authentication object which is not stored.
+        """
+        now = now or datetime.utcnow()
+        source_name, dest_name = cls._names(source_uid, dest_uid)
+        step = config.authentication.timeout // 2
+        window = int((now - _EPOCH).total_seconds()) // step
+        def secret(window):
+            message = u'\0'.join(
+                sorted([source_uid, dest_uid]) + [unicode(window)]
+            ).encode('utf-8')
+            auth = Snapshot((
+                None, source_uid, source_name, dest_uid, dest_name,
+                hmac.new(
+                    str(config.authentication.hmac_key), message,
+                    hashlib.sha512
+                ).hexdigest()[:config.authentication.length],
+                _EPOCH + timedelta(seconds=(window + 2) * step), False
+            ))
+            auth.expiry_string = cls._approx_time_delta(auth.expiry, now)
+            return cls._expand(auth, now)
+        auth = secret(window)
+        auth.previous = secret(window - 1)
+        return auth
 
     def __repr__(self):
         """
@@ -164,18 +401,20 @@ class Verification(Base):
         )
 
     @classmethod
-    def get(cls, src_uid, dst_uid):
+    def get(cls, src_uid, dst_uid, now=None):
         """
         Retreive the unexpired authentication object, given a source and a
         destination uid. This function can only ever return 1 or 0 elements.
 
         :param src_uid: the source user id
         :param dst_uid: the destination user id.
+        :param now: the current UTC time, if the caller already has it.
         :rtype: a single authentication object or None.
         """
+        now = now or datetime.utcnow()
         results = db.session.query(Verification).filter( # pylint: disable=E1101
             and_(
-                Verification.expiry > datetime.utcnow(),
+                Verification.expiry > now,
                 Verification.source_uid == src_uid,
                 Verification.dest_uid == dst_uid
             )
@@ -183,7 +422,7 @@ class Verification(Base):
         if results.count() == 0:
             return None
         elif results.count() == 1:
-            return cls._expand(results[0])
+            return cls._expand(results[0], now)
         else:
             raise Exception('database inconsistency')
 
@@ -207,42 +446,88 @@ class Verification(Base):
             raise Exception(u'Database inconsistency - identical auth_ids')
 
     @classmethod
-    def by_src(cls, uid):
+    def by_src(cls, uid, now=None):
         """
         Retrieve non-expired authentication objects with a given source uid.
 
         :param src_uid: the source user id
         :param dst_uid: the destination user id.
+        :param now: the current UTC time, if the caller already has it.
         :rtype: a list of authentication objects or None.
         """
-        results = db.session.query(Verification).filter( # pylint: disable=E1101
-            and_(
-                Verification.expiry > datetime.utcnow(),
-                Verification.source_uid == uid
-            )
-        ).all()
-        for result in results:
-            cls._expand(result)
-        return results
+        now = now or datetime.utcnow()
+        with db.replica():
+            results = db.session.query(Verification).filter( # pylint: disable=E1101
+                and_(
+                    Verification.expiry > now,
+                    Verification.source_uid == uid
+                )
+            ).all()
+        return cls._expand_all(results, now)
 
     @classmethod
-    def by_dst(cls, uid):
+    def by_dst(cls, uid, now=None):
         """
         Retrieve non-expired authentication objects with a given destination uid.
 
         :param src_uid: the source user id
         :param dst_uid: the destination user id.
+        :param now: the current UTC time, if the caller already has it.
         :rtype: a list of authentication objects or None.
         """
-        results = db.session.query(Verification).filter( # pylint: disable=E1101
-            and_(
-                Verification.expiry > datetime.utcnow(),
-                Verification.dest_uid == uid
-            )
-        ).all()
-        for result in results:
-            cls._expand(result)
-        return results
+        now = now or datetime.utcnow()
+        with db.replica():
+            results = db.session.query(Verification).filter( # pylint: disable=E1101
+                and_(
+                    Verification.expiry > now,
+                    Verification.dest_uid == uid
+                )
+            ).all()
+        return cls._expand_all(results, now)
+
+    @classmethod
+    def active(cls, uid, now=None):
+        """
+        Retrieve non-expired authentication objects with a given source uid
+        and with a given destination uid, from the active cache if it holds
+        them (see :class:`ActiveCache`).
+
+        :param uid: the user id
+        :param now: the current UTC time, if the caller already has it.
+        :rtype: a tuple of two lists of authentication objects.
+        """
+        now = now or datetime.utcnow()
+        if config.authentication.mode == 'stateless':
+            return [], [] # Nothing is stored
+        if not config.authentication.cache_ttl:
+            with db.primary() if cache.fresh(uid) else db.replica():
+                return cls.by_src(uid, now), cls.by_dst(uid, now)
+        src_rows, dst_rows = cls._active_rows(uid, now)
+        return (
+            cls._expand_all([Snapshot(row) for row in src_rows], now),
+            cls._expand_all([Snapshot(row) for row in dst_rows], now)
+        )
+
+    @classmethod
+    def _active_rows(cls, uid, now):
+        rows = cache.get(uid)
+        if rows is None:
+            generation = cache.generation(uid)
+            with db.primary() if cache.fresh(uid) else db.replica():
+                rows = (
+                    [_row(v) for v in cls.by_src(uid, now)],
+                    [_row(v) for v in cls.by_dst(uid, now)]
+                )
+            cache.put(uid, rows[0], rows[1], now, generation)
+        return rows
+
+    @staticmethod
+    def invalidate(*uids):
+        """
+        Forget the cached authentications of the given users, after one to
+        or from them has been committed.
+        """
+        cache.invalidate(*uids)
 
     @classmethod
     def all(cls, uid):
@@ -254,63 +539,135 @@ class Verification(Base):
         :param dst_uid: the destination user id.
         :rtype: a list of authentication objects or None.
         """
-        results = db.session.query(Verification).filter( # pylint: disable=E1101
-            or_(
-                Verification.source_uid == uid,
-                Verification.dest_uid == uid
+        with db.replica():
+            results = db.session.query(Verification).filter( # pylint: disable=E1101
+                or_(
+                    Verification.source_uid == uid,
+                    Verification.dest_uid == uid
+                )
+            ).all()
+        return cls._expand_all(results)
+
+    @staticmethod
+    def version(uid):
+        """
+        Compute a cheap token which changes whenever the set of non-expired
+        authentications for which the uid matches either the source or
+        destination changes, that is, when one is created, reciprocated or
+        expires. Only aggregates are queried; no objects are loaded. With
+        the active cache enabled, it is computed from the cache instead.
+
+        :param uid: the user id
+        :rtype: str
+        """
+        if config.authentication.mode == 'stateless':
+            return 'stateless'
+        if config.authentication.cache_ttl:
+            src_rows, dst_rows = Verification._active_rows(
+                uid, datetime.utcnow()
             )
-        ).all()
-        for result in results:
-            cls._expand(result)
-        return results
+            rows = src_rows + dst_rows
+            count = len(rows)
+            last = max(row[0] for row in rows) if rows else None
+            reciprocated = sum(row[7] for row in rows) if rows else None
+        else:
+            with db.primary() if cache.fresh(uid) else db.replica():
+                count, last, reciprocated = db.session.query( # pylint: disable=E1101
+                    func.count(Verification.auth_id),
+                    func.max(Verification.auth_id),
+                    func.sum(cast(Verification.reciprocated, Integer))
+                ).filter(
+                    and_(
+                        Verification.expiry > datetime.utcnow(),
+                        or_(
+                            Verification.source_uid == uid,
+                            Verification.dest_uid == uid
+                        )
+                    )
+                ).one()
+        return '{count}-{last}-{reciprocated}'.format(
+            count=count,
+            last=last,
+            reciprocated=reciprocated
+        )
 
     @staticmethod
-    def exists(src_uid, dst_uid):
+    def history_version(uid):
         """
-        Given the source and destination of a authentication, check if an
-        authentication already exists and if it does, return true.
+        Like version, but for all authentications for which the uid matches
+        either the source or destination, regardless of expiry time (see the
+        all method).
 
-        :param src_uid: the source user id
-        :param dst_uid: the destination user id.
-        :rtype: bool
+        :param uid: the user id
+        :rtype: str
         """
-        return db.session.query(Verification).filter( # pylint: disable=E1101
-            and_(
-                Verification.expiry > datetime.utcnow(),
-                Verification.source_uid == src_uid,
-                Verification.dest_uid == dst_uid
-            )
-        ).count() != 0
+        with db.replica():
+            count, last = db.session.query( # pylint: disable=E1101
+                func.count(Verification.auth_id),
+                func.max(Verification.auth_id)
+            ).filter(
+                or_(
+                    Verification.source_uid == uid,
+                    Verification.dest_uid == uid
+                )
+            ).one()
+        return '{count}-{last}'.format(count=count, last=last)
 
     @classmethod
-    def _expand(cls, result):
+    def _expand(cls, result, now=None):
         # Calculate and set the human readable time delta and NATO code
-        result.expiry_delta = cls._approx_time_delta(
-            result.expiry - datetime.utcnow()
-        )
+        result.expiry_delta = cls._approx_time_delta(result.expiry, now)
         result.nato_code = cls._nato_code(result.shared_secret)
+        result.expiry_timestamp = int(
+            (result.expiry - _EPOCH).total_seconds()
+        )
         return result
 
+    @classmethod
+    def _expand_all(cls, results, now=None):
+        # As _expand, with one clock read and one NATO translation for all
+        now = now or datetime.utcnow()
+        secrets = [
+            r.shared_secret for r in results
+            if r.shared_secret not in _nato_codes
+        ]
+        if len(_nato_codes) + len(secrets) > _NATO_CODES_MAX:
+            _nato_codes.clear()
+        _nato_codes.update(zip(secrets, nato_encode_many(secrets)))
+        for result in results:
+            cls._expand(result, now)
+        return results
+
     @staticmethod
     def _nato_code(shared_secret):
         """
         Given the shared secret, convert it into phonetic (nato) alphabetic
-        codes.
+        codes. Recent results are remembered, as a secret never changes.
 
         :param shared secret: the shared secret
         :rtype: the nato encoded string representation of the shared secret.
         """
-        return '-'.join([NATO[letter] for letter in shared_secret])
+        code = _nato_codes.get(shared_secret)
+        if code is None:
+            if len(_nato_codes) >= _NATO_CODES_MAX:
+                _nato_codes.clear()
+            code = _nato_codes[shared_secret] = nato_encode(shared_secret)
+        return code
 
     @staticmethod
-    def _approx_time_delta(delta=None):
+    def _approx_time_delta(delta=None, now=None):
         """
         Given a timedelta object, given an approximation in seconds or minutes
 
         :param delta: a timedelta object to approximate into a string
-                    representation.
+                    representation, or a UTC datetime to approximate the time
+                    until.
+        :param now: the current UTC time, if delta is a datetime and the
+                    caller already has it.
         :rtype: a string containing the approximation of the timedelta.
         """
+        if isinstance(delta, datetime):
+            delta = delta - (now or datetime.utcnow())
         delta = int(delta.seconds)
         unit = "second"
         if delta > 60:
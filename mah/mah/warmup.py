@@ -0,0 +1,54 @@
+"""
+Template warm-up, so that the first requests to a new process don't pay for
+compiling templates.
+
+On start up every template is compiled and kept in the Jinja environment's
+template cache. If application.template_cache is set, compiled templates are
+also stored on disk there, and processes started later load them instead of
+compiling them again.
+
+See the :doc:`configuration` section for details.
+"""
+import os, tempfile, shutil, time
+from jinja2 import FileSystemBytecodeCache
+from mah.log import log
+
+class BytecodeCache(FileSystemBytecodeCache):
+    """
+    A Jinja bytecode cache in a directory shared by several processes. Cache
+    files are replaced atomically, so a process never loads one that another
+    process is part way through writing.
+    """
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        FileSystemBytecodeCache.__init__(self, directory)
+
+    def dump_bytecode(self, bucket):
+        target = self._get_cache_filename(bucket)
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                bucket.write_bytecode(f)
+            shutil.move(tmp, target)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+def compile_templates(app):
+    """
+    Compile every template of app.
+
+    :return: the number of templates compiled.
+    """
+    started = time.time()
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    log.info(
+        'Compiled {count} template(s) in {ms:.1f}ms',
+        count=len(names),
+        ms=(time.time() - started) * 1000
+    )
+    return len(names)
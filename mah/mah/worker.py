@@ -0,0 +1,123 @@
+"""
+A background thread for periodic work that should not happen on the request
+path, such as delivering queued report emails.
+
+Tasks are registered once at import time, and the thread is started (or
+restarted, for instance in a freshly forked process) by :meth:`Worker.start`::
+
+    from mah.worker import worker
+
+    worker.every(5, deliver)
+    worker.start()
+
+Each task runs in the worker thread, so it gets its own database session
+through mah.database, and must finish it with db.done(). If a task raises
+instead, the hooks registered with :meth:`Worker.on_failure` (mah.database
+registers one which rolls back and removes the session) clean up after it.
+"""
+import os, threading, time
+from traceback import format_exc
+from mah.log import log
+
+class Task(object):
+    def __init__(self, interval, func):
+        self.interval = interval
+        self.func = func
+        self.due = 0
+
+class Worker(object):
+    """
+    Runs registered tasks every so often in a single daemon thread.
+    """
+    def __init__(self, name='mah-worker'):
+        self.name = name
+        self._tasks = []
+        self._failure_hooks = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def every(self, interval, func):
+        """
+        Run func every interval seconds. The interval may be a callable
+        returning the number of seconds, so that it can follow the
+        configuration.
+        """
+        with self._lock:
+            self._tasks.append(Task(interval, func))
+        self._wakeup.set()
+
+    def on_failure(self, hook):
+        """
+        Call hook, with no arguments, in the worker thread after any task
+        raises, to clean up what the task left behind.
+        """
+        with self._lock:
+            self._failure_hooks.append(hook)
+
+    def wake(self, func):
+        """
+        Run the task for func now, for instance because new work has been
+        queued for it.
+        """
+        with self._lock:
+            for task in self._tasks:
+                if task.func is func:
+                    task.due = 0
+        self._wakeup.set()
+
+    def start(self):
+        """
+        Start the worker thread for this process if it is not running.
+        """
+        with self._lock:
+            if (self._pid == os.getpid() and self._thread is not None and
+                self._thread.is_alive()):
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name=self.name)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                tasks = list(self._tasks)
+            now = time.time()
+            for task in tasks:
+                if task.due > now:
+                    continue
+                try:
+                    task.func()
+                except Exception:
+                    log.error(
+                        "Background task {name} failed: {trace}",
+                        name=task.func.__name__,
+                        trace=format_exc()
+                    )
+                    self._failed()
+                interval = task.interval
+                task.due = time.time() + (
+                    interval() if callable(interval) else interval
+                )
+            with self._lock:
+                due = min([task.due for task in self._tasks] or [now + 60])
+            self._wakeup.wait(max(due - time.time(), 0.01))
+            self._wakeup.clear()
+
+    def _failed(self):
+        with self._lock:
+            hooks = list(self._failure_hooks)
+        for hook in hooks:
+            try:
+                hook()
+            except Exception:
+                log.error(
+                    "Background task clean up failed: {trace}",
+                    trace=format_exc()
+                )
+
+#: The worker for this process. This is imported and used in various places in
+#: MAH.
+worker = Worker()
@@ -0,0 +1,11 @@
+"""
+WSGI entry point for servers that load the application by module name, such
+as gunicorn::
+
+    gunicorn -c gunicorn.conf.py mah.wsgi:application
+
+See gunicorn.conf.py and the :doc:`installation` section for details.
+"""
+from mah import create_app
+
+application = create_app()